@@ -1,7 +1,10 @@
 import tomllib
+import json
 import os
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, fields
 from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, TypeVar
 from dotenv import load_dotenv
 
 
@@ -56,6 +59,87 @@ class Server:
     receive_size:int
     # 注意：TLS 现在默认启用，不再需要配置开关
 @dataclass
+class RagFusionConfig:
+    K: int # RRF 平滑常数
+    weights: dict[str, float] # 各路召回的权重，权重为0的召回器不会执行
+@dataclass
+class RagBudgetConfig:
+    total_ms: int # 单次检索的延迟预算，<=0 表示不限时
+    rerank_min_ms: int # 剩余预算低于该值时不再发起重排序
+    decisive_margin: float # 融合分数分差占比超过该值时跳过重排序，<=0 表示从不跳过
+    context_tokens: int # 拼入提示词的检索上下文 token 预算，<=0 表示不限制
+    dedupe_threshold: float # 两个块的字符 3-gram 包含度不低于该值时视为近似重复
+@dataclass
+class RagMmrConfig:
+    enabled: bool # 是否在重排序前做 MMR 多样化
+    top_n: int # MMR 保留的候选数，不少于 rerank_top_n
+    lambda_mult: float # 相关度与多样性的权衡，1 为只看相关度，0 为只看多样性
+@dataclass
+class RagHierarchyConfig:
+    enabled: bool # 是否启用 文档 → 块 两级检索
+    candidate_docs: int # 第一级选出的候选来源数
+    min_docs: int # 来源数不超过该值时直接检索全部块
+@dataclass
+class RagVectorConfig:
+    space: str # 新建集合的距离空间 cosine / ip / l2，已有集合沿用创建时的空间
+    normalize: bool # 入库与查询前是否对向量做 L2 归一化
+    min_similarity: float # 向量召回的最低相似度（1 为完全相同），低于该值的块被丢弃
+@dataclass
+class RagHnswConfig:
+    m: int # 每个节点的邻居数，越大召回越高、内存与建索引耗时越大，只在集合创建时生效
+    construction_ef: int # 建索引时的候选队列长度，只在集合创建时生效
+    search_ef: int # 查询时的候选队列长度，越大召回越高、查询越慢，同样只在集合创建时生效
+@dataclass
+class RagFallbackConfig:
+    enabled: bool # rag_retrieve 结果为空或低于阈值时，是否在工具内依次降级重试
+    widen: int # 混合检索降级时 top_k 的放大倍数
+    max_top_k: int # 放大后 top_k 的上限
+    min_rerank_score: float # 走了重排序时，第一名的重排序分数低于该值视为不相关，<=0 表示不检查
+    rewrite: bool # 前几级都失败时，是否用 LLM 改写一次 query 再检索
+@dataclass
+class RagMultiQueryConfig:
+    enabled: bool # rag_retrieve 未指定 multi_query 时是否默认开启多 query 融合
+    variants: int # 一次 LLM 调用生成的改写数（不含原问题）
+@dataclass
+class RagProfileConfig:
+    chunk_size: int # 入库切分的块大小
+    chunk_overlap: int # 相邻块的重叠长度
+    min_similarity: float # 向量召回的最低相似度，未配置时沿用 [rag.vector]
+    rerank_threshold: float # 走了重排序时，重排序分数低于该值的块不装入上下文
+@dataclass
+class RagDedupeConfig:
+    enabled: bool # 入库前是否去掉完全重复与近似重复的块
+    threshold: float # MinHash 估计的 Jaccard 相似度不低于该值视为近似重复
+    num_perm: int # MinHash 排列数，越大估计越准、计算越慢
+    bands: int # LSH 分段数，须整除 num_perm；段越多越容易成为候选
+    shingle_size: int # 每个 shingle 包含的 jieba 词数
+@dataclass
+class RagMatryoshkaConfig:
+    dimensions: int # 新建集合存放的截断维度（取全维向量的前 dimensions 维再归一化），0 表示存放全维向量
+    candidates: int # 降维召回 top_k × candidates 个候选，再用全维向量重新打分取前 top_k
+@dataclass
+class RagWebConfig:
+    concurrency: int # 网页抓取的全局并发请求数（同时也是共享连接池的大小）
+    per_host: int # 同一主机的最大并发请求数
+    timeout_s: float # 单次请求的读写超时
+    connect_timeout_s: float # 建立连接的超时
+    retries: int # 连接失败、超时、429/5xx 后的重试次数
+    retry_backoff_s: float # 首次重试的等待时间，之后按指数增长
+    max_pages: int # crawl 时最多抓取的页面数
+    user_agent: str
+@dataclass
+class ChromaConfig:
+    mode: str # persistent：进程内嵌入式存储（DB_PATH）；http：连接独立的 Chroma 服务，多个服务进程共享
+    host: str
+    port: int
+    ssl: bool
+    timeout_s: float # 单次请求的读写超时
+    connect_timeout_s: float # 建立连接的超时
+    max_connections: int # 进程内共享的 HTTP 连接池大小
+    max_keepalive_connections: int # 连接池中保持的空闲长连接数
+    retries: int # 连接失败/超时后的重试次数
+    retry_backoff_s: float # 首次重试的等待时间，之后按指数增长
+@dataclass
 class LogLever:
     agent_lever:str
     web_lever:str
@@ -151,6 +235,201 @@ def load_rerank_model() -> RerankModelConfig:
     except KeyError as e:
         raise ValueError(f"配置文件缺少必要的字段: {e}")
 
+CONFIG_PATH = Path(__file__).parent.parent.parent.parent / "config.toml"
+_config_cache: Dict[Path, Tuple[Tuple[int, int], Dict[str, Any]]] = {}
+ConfigT = TypeVar("ConfigT")
+
+
+def _read_config(path: Path = CONFIG_PATH) -> Dict[str, Any]:
+    """
+    解析 config.toml 并按（修改时间, 大小）缓存：一次 RagEngine 构造里的多个 load_rag_* 共用一次解析，
+    文件被改写（调参工具 --write）后下一次读取重新解析。文件不存在时返回空配置
+    """
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return {}
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _config_cache.get(path)
+    if cached is None or cached[0] != key:
+        with open(path, "rb") as f:
+            cached = (key, tomllib.load(f))
+        _config_cache[path] = cached
+    return cached[1]
+
+def _config_section(section: str) -> Dict[str, Any]:
+    """按点分路径取配置节，如 rag.fusion；缺少时返回空字典"""
+    values = _read_config()
+    for key in section.split("."):
+        values = values.get(key, {}) if isinstance(values, dict) else {}
+    return values
+
+def _apply_section(config: ConfigT, values: Dict[str, Any], extra: Optional[str] = None) -> ConfigT:
+    """
+    用 values 覆盖 config 中的同名字段（按默认值的类型转换），未配置的字段保持默认值；
+    extra 为字典字段名时，不是字段的数值键写入该字典（如 [rag.fusion] 中各召回器的权重）
+    """
+    names = {f.name for f in fields(config)}
+    for key, value in values.items():
+        if key in names:
+            setattr(config, key, type(getattr(config, key))(value))
+        elif extra is not None and isinstance(value, (int, float)):
+            getattr(config, extra)[key] = float(value)
+    return config
+
+def _rag_section(path: str, default: ConfigT, collection_name: Optional[str] = None,
+                 extra: Optional[str] = None) -> ConfigT:
+    """
+    读取 [rag.<path>] 覆盖 default：collection_name 不为 None 时按集合调参，
+    先取 [rag.<path>.default] 再用 [rag.<path>.<collection_name>] 覆盖
+    """
+    section = _config_section(f"rag.{path}")
+    if collection_name is None:
+        return _apply_section(default, section, extra)
+    for name in ("default", collection_name):
+        if name:
+            _apply_section(default, section.get(name, {}), extra)
+    return default
+
+def load_rag_fusion(collection_name: str = "") -> RagFusionConfig:
+    """
+    读取 config.toml 中 [rag.fusion] 多路召回融合配置：
+    先取 [rag.fusion.default]，再用 [rag.fusion.<collection_name>] 覆盖，便于按集合单独调参。
+    未配置时使用 dense/bm25 两路的默认权重。
+    """
+    return _rag_section("fusion", RagFusionConfig(K=60, weights={"dense": 0.6, "bm25": 0.4}), collection_name,
+                        extra="weights")
+
+def load_rag_budget() -> RagBudgetConfig:
+    """
+    读取 config.toml 中 [rag.budget] 检索延迟预算配置，未配置的字段使用默认值
+    """
+    return _rag_section("budget", RagBudgetConfig(total_ms=2000, rerank_min_ms=100, decisive_margin=0.5,
+                                                  context_tokens=1024, dedupe_threshold=0.8))
+
+def load_rag_mmr() -> RagMmrConfig:
+    """
+    读取 config.toml 中 [rag.mmr] 候选多样化配置，未配置的字段使用默认值
+    """
+    return _rag_section("mmr", RagMmrConfig(enabled=True, top_n=8, lambda_mult=0.5))
+
+def load_rag_hierarchy() -> RagHierarchyConfig:
+    """
+    读取 config.toml 中 [rag.hierarchy] 两级检索配置，未配置时不启用
+    """
+    return _rag_section("hierarchy", RagHierarchyConfig(enabled=False, candidate_docs=5, min_docs=20))
+
+def load_rag_vector() -> RagVectorConfig:
+    """
+    读取 config.toml 中 [rag.vector] 向量空间配置，未配置的字段使用默认值
+    """
+    return _rag_section("vector", RagVectorConfig(space="cosine", normalize=True, min_similarity=0.3))
+
+def load_rag_hnsw() -> RagHnswConfig:
+    """
+    读取 config.toml 中 [rag.hnsw] 索引参数，未配置的字段使用 Chroma 的默认值
+    """
+    return _rag_section("hnsw", RagHnswConfig(m=16, construction_ef=100, search_ef=100))
+
+def load_rag_fallback() -> RagFallbackConfig:
+    """
+    读取 config.toml 中 [rag.fallback] 检索降级配置，未配置的字段使用默认值
+    """
+    fallback = _rag_section("fallback", RagFallbackConfig(enabled=True, widen=2, max_top_k=40, min_rerank_score=0.0,
+                                                          rewrite=True))
+    fallback.widen = max(1, fallback.widen)
+    return fallback
+
+def load_rag_multi_query() -> RagMultiQueryConfig:
+    """
+    读取 config.toml 中 [rag.multi_query] 多 query 融合配置，未配置时不默认开启
+    """
+    multi_query = _rag_section("multi_query", RagMultiQueryConfig(enabled=False, variants=3))
+    multi_query.variants = max(1, multi_query.variants)
+    return multi_query
+
+def load_rag_profile(collection_name: str = "") -> RagProfileConfig:
+    """
+    读取 config.toml 中 [rag.profile] 分块与检索阈值配置：
+    先取 [rag.profile.default]，再用 [rag.profile.<collection_name>] 覆盖（python -m agent.rag.tune --write 按集合写入）。
+    """
+    return _rag_section("profile", RagProfileConfig(chunk_size=200, chunk_overlap=20,
+                                                    min_similarity=load_rag_vector().min_similarity,
+                                                    rerank_threshold=0.1), collection_name)
+
+def load_rag_dedupe() -> RagDedupeConfig:
+    """
+    读取 config.toml 中 [rag.dedupe] 入库去重配置，未配置的字段使用默认值
+    """
+    dedupe = _rag_section("dedupe", RagDedupeConfig(enabled=True, threshold=0.8, num_perm=64, bands=16,
+                                                    shingle_size=3))
+    dedupe.shingle_size = max(1, dedupe.shingle_size)
+    return dedupe
+
+def load_rag_matryoshka() -> RagMatryoshkaConfig:
+    """
+    读取 config.toml 中 [rag.matryoshka] 降维存储配置，未配置的字段使用默认值
+    """
+    matryoshka = _rag_section("matryoshka", RagMatryoshkaConfig(dimensions=0, candidates=4))
+    matryoshka.dimensions = max(0, matryoshka.dimensions)
+    matryoshka.candidates = max(1, matryoshka.candidates)
+    return matryoshka
+
+def load_rag_web() -> RagWebConfig:
+    """
+    读取 config.toml 中 [rag.web] 网页抓取配置，未配置的字段使用默认值
+    """
+    web = _rag_section("web", RagWebConfig(concurrency=32, per_host=8, timeout_s=15.0, connect_timeout_s=5.0,
+                                           retries=2, retry_backoff_s=0.5, max_pages=500, user_agent="PgoAgent/1.0"))
+    web.concurrency = max(1, web.concurrency)
+    web.per_host = max(1, web.per_host)
+    web.retries = max(0, web.retries)
+    web.max_pages = max(1, web.max_pages)
+    return web
+
+def _toml_value(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return json.dumps(str(value), ensure_ascii=False)
+
+def update_config_section(section: str, values: Dict[str, Any], path: Optional[Path] = None) -> None:
+    """
+    把 values 写入 config.toml 的 [section]（调参工具使用）：已有的键原地替换，缺少的键追加到该节最后一个键之后，
+    没有该节时追加到文件末尾；其它内容、注释与换行符保持不变
+    """
+    path = path or CONFIG_PATH
+    raw = path.read_bytes().decode("utf-8")
+    newline = "\r\n" if "\r\n" in raw else "\n"
+    lines = raw.split(newline)
+    header = next((i for i, line in enumerate(lines) if line.strip() == f"[{section}]"), None)
+    if header is None:
+        lines = (lines[:-1] if lines and lines[-1] == "" else lines) + ["", f"[{section}]"] + \
+                [f"{key} = {_toml_value(value)}" for key, value in values.items()] + [""]
+    else:
+        end = next((i for i in range(header + 1, len(lines)) if lines[i].lstrip().startswith("[")), len(lines))
+        missing = dict(values)
+        for i in range(header + 1, end):
+            match = re.match(r"\s*(\w+)\s*=", lines[i])
+            if match and match.group(1) in missing:
+                lines[i] = f"{match.group(1)} = {_toml_value(missing.pop(match.group(1)))}"
+        last = max((i for i in range(header, end) if lines[i].strip() and not lines[i].lstrip().startswith("#")),
+                   default=header)
+        lines[last + 1:last + 1] = [f"{key} = {_toml_value(value)}" for key, value in missing.items()]
+    path.write_bytes(newline.join(lines).encode("utf-8"))
+
+def load_chroma_config() -> ChromaConfig:
+    """
+    读取 config.toml 中 [chroma] 向量库连接配置，未配置时使用进程内嵌入式存储
+    """
+    chroma = _apply_section(ChromaConfig(mode="persistent", host="127.0.0.1", port=8000, ssl=False, timeout_s=10.0,
+                                         connect_timeout_s=2.0, max_connections=32, max_keepalive_connections=16,
+                                         retries=2, retry_backoff_s=0.2), _config_section("chroma"))
+    if chroma.mode not in ("persistent", "http"):
+        raise ValueError(f"[chroma] mode 只能是 persistent 或 http: {chroma.mode}")
+    return chroma
+
 def get_dsn()->tuple[str,str]:
     """
     优先从.env文件读取DATABASE_URL，如果不存在则从config.toml读取配置
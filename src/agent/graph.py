@@ -391,7 +391,8 @@ async def answer_thinking_node(state: State) -> State:
             c = msg.content or ""
             if msg.name == "rag_retrieve":
                 has_rag_result = True # 提示词标记rag工具的使用
-            if len(c) > MAX_TOOL_RESULT_CHARS:
+            # rag_retrieve 的结果已在工具内按 token 预算打包，按字符截断会切掉分数最高的块
+            if msg.name != "rag_retrieve" and len(c) > MAX_TOOL_RESULT_CHARS:
                 c = c[:MAX_TOOL_RESULT_CHARS] + f"\n...[已截断，原{len(msg.content)}字符]"
 
             tool_results.insert(0, ToolMessage(content=c, name=msg.name, tool_call_id=msg.tool_call_id))
@@ -575,7 +576,7 @@ async def create_graph(store:Store,config: dict,max_tool_attempts:int=2,checkpoi
         if current_capability == "rag_retrieve":
             system_content += (
                 "1,必须调用 rag_retrieve 完成本步骤，不得跳过。\n"
-                "2.若返回为空/不相关：先 rag_rewrite_query，再 rag_retrieve，最多重试 2 次。\n"
+                "2.rag_retrieve 会在工具内自动降级重试（扩大检索→关键词→改写query），仍为空/不相关时最多再 rag_rewrite_query 后重试 1 次。\n"
                 "3.得到检索结果后直接回答，禁止臆测。"
             )
         elif current_capability in {"get_time", "calculate"}:
@@ -617,7 +618,7 @@ async def create_graph(store:Store,config: dict,max_tool_attempts:int=2,checkpoi
                 # RAG 工具的特殊重试提示
                 if msgs[-1].name == "rag_retrieve":
                     override = (
-                        f"\n⚠️ 检测到RAG检索结果为空或不相关，将进行重试。"
+                        f"\n⚠️ 检测到RAG检索结果为空或不相关（工具内的降级重试也未找到），将进行重试。"
                         f"当前工具尝试次数: {tool_attempts}/{max_tool_attempts}。\n"
                         "1. 请先调用rag_rewrite_query重写query（提供失败原因：检索结果为空或不相关）\n"
                         "2. 使用重写后的refined_query再次调用rag_retrieve（可调整参数）\n"
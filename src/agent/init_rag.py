@@ -14,7 +14,7 @@ def init_rag_engine(collection_name:str = "my_vector",path:str = FILE_PATH,file_
     """
     engine = RagEngine(collection_name=collection_name,base_path=path) # 默认就是file_path路径
     documents = DocumentLoader().load_file(file_name) # 专门的内容加载器
-    splitter_md = TextSplitter(mode =mode ) # 专门的分块器
+    splitter_md = TextSplitter(mode =mode, chunk_size=engine.chunk_size, chunk_overlap=engine.chunk_overlap) # 专门的分块器，大小取集合的 [rag.profile]
     documents1 = splitter_md.split_documents(documents) # 分割后的文档
     engine.embed_data(documents1) # 构建向量索引
     return engine
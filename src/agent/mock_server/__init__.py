@@ -0,0 +1,19 @@
+"""
+OpenAI 兼容的本地替身服务（chat / embeddings / rerank），用于在没有 GPU 的环境中做压测与回归测试：
+    python -m agent.mock_server --port 9000
+然后把 OPENAI_BASE_URL 设为 http://127.0.0.1:9000/v1，
+EMBEDDING_MODEL_URL / RERANK_MODEL_URL 分别设为 .../v1/embeddings 与 .../v1/rerank（API Key 任意非空值）
+"""
+from .config import EndpointConfig, MockServerConfig, load_mock_server_config
+from .app import MockOpenAIServer, BackgroundMockServer, create_app, run_mock_server, hashed_embeddings
+
+__all__ = [
+    "EndpointConfig",
+    "MockServerConfig",
+    "load_mock_server_config",
+    "MockOpenAIServer",
+    "BackgroundMockServer",
+    "create_app",
+    "run_mock_server",
+    "hashed_embeddings",
+]
@@ -0,0 +1,27 @@
+import argparse
+
+from .config import load_mock_server_config, ENDPOINTS
+from .app import run_mock_server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="启动 OpenAI 兼容的本地替身服务（chat / embeddings / rerank）")
+    parser.add_argument("--host", type=str, default=None, help="监听地址，默认读取 config.toml [mock_server]")
+    parser.add_argument("--port", type=int, default=None, help="端口号")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，固定后延迟与故障注入可复现")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="所有接口延迟的缩放系数，0 表示关闭模拟延迟")
+    args = parser.parse_args()
+
+    config = load_mock_server_config()
+    if args.host:
+        config.host = args.host
+    if args.port:
+        config.port = args.port
+    if args.seed is not None:
+        config.seed = args.seed
+    for name in ENDPOINTS:
+        endpoint = getattr(config, name)
+        endpoint.latency_ms *= args.latency_scale
+        endpoint.latency_jitter_ms *= args.latency_scale
+        endpoint.per_item_ms *= args.latency_scale
+    run_mock_server(config)
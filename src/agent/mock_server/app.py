@@ -0,0 +1,394 @@
+import asyncio
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import uvicorn
+from loguru import logger
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from .config import MockServerConfig, EndpointConfig, ENDPOINTS
+
+# 英文单词/数字按整词、其它字符（中文、标点）按单字切分，用于哈希向量与 token 估算
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+|[^\sA-Za-z0-9_]")
+_REPLY_VOCAB = ("这是", "本地", "模拟", "回复", "用于", "性能", "测试", "的", "内容", "，", "结果", "仅供", "参考", "。",
+                "mock", "reply", "token", "stream", "agent", "rag")
+
+
+def _tokens(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数（中文按字、英文按词），只用于 usage 字段"""
+    return len(_TOKEN_RE.findall(text))
+
+
+def hashed_embeddings(texts: List[str], dim: int) -> np.ndarray:
+    """
+    确定性的哈希向量：对单字/单词及相邻二元组做特征哈希（带符号），再 L2 归一化。
+    相同文本在任意进程中得到相同向量，字面越相近的文本余弦相似度越高，足够用于离线检索评测
+    """
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        tokens = _tokens(text)
+        features = tokens + [a + b for a, b in zip(tokens, tokens[1:])]
+        if not features:
+            continue
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint64, count=len(features))
+        signs = np.where((hashes >> np.uint64(31)) & np.uint64(1), -1.0, 1.0).astype(np.float32)
+        np.add.at(out[row], (hashes % np.uint64(dim)).astype(np.int64), signs)
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return out / norms
+
+
+def _error(status: int, message: str, error_type: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    return JSONResponse({"error": {"message": message, "type": error_type, "code": status}}, status_code=status,
+                        headers=headers)
+
+
+class _EndpointGate:
+    """单个接口的故障注入、并发槽位与统计"""
+
+    def __init__(self, name: str, config: EndpointConfig, rng: random.Random):
+        self.name = name
+        self.config = config
+        self.rng = rng
+        self.semaphore = asyncio.Semaphore(config.max_concurrency) if config.max_concurrency > 0 else None
+        self.in_flight = 0
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "max_in_flight": 0}
+
+    def admit(self) -> Optional[JSONResponse]:
+        """按配置注入 429/5xx，或在并发已满且配置为拒绝时返回 429；正常放行返回 None"""
+        self.stats["requests"] += 1
+        cfg = self.config
+        if cfg.rate_limit_rate and self.rng.random() < cfg.rate_limit_rate:
+            return self._rate_limited("模拟限流")
+        if cfg.reject_when_busy and self.semaphore is not None and self.semaphore.locked():
+            return self._rate_limited("并发已满")
+        if cfg.error_rate and self.rng.random() < cfg.error_rate:
+            self.stats["errors"] += 1
+            return _error(cfg.error_status, "模拟服务错误", "server_error")
+        return None
+
+    def _rate_limited(self, message: str) -> JSONResponse:
+        self.stats["rate_limited"] += 1
+        return _error(429, message, "rate_limit_exceeded", headers={"Retry-After": str(self.config.retry_after_s)})
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个并发槽位（未设置上限时不排队）"""
+        if self.semaphore is not None:
+            await self.semaphore.acquire()
+        self.in_flight += 1
+        self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+    async def wait(self, items: int = 1) -> None:
+        await asyncio.sleep(self.config.sample_latency_ms(self.rng, items) / 1000)
+
+
+class MockOpenAIServer:
+    """
+    OpenAI 兼容的本地替身服务，提供：
+    - POST /v1/chat/completions：普通/流式（SSE）回复与工具调用
+    - POST /v1/embeddings：确定性哈希向量
+    - POST /v1/rerank：与嵌入同源的相似度打分（Jina/硅基流动格式）
+    - GET /v1/models、/health、/stats（各接口请求数、限流/错误次数、最大并发）
+    """
+
+    def __init__(self, config: Optional[MockServerConfig] = None):
+        self.config = config or MockServerConfig()
+        self.rng = random.Random(self.config.seed)
+        self.gates = {name: _EndpointGate(name, getattr(self.config, name), self.rng) for name in ENDPOINTS}
+        self.app = Starlette(routes=[
+            Route("/v1/chat/completions", self.chat_completions, methods=["POST"]),
+            Route("/v1/embeddings", self.embeddings, methods=["POST"]),
+            Route("/v1/rerank", self.rerank, methods=["POST"]),
+            Route("/v1/models", self.models, methods=["GET"]),
+            Route("/health", self.health, methods=["GET"]),
+            Route("/stats", self.stats, methods=["GET"]),
+        ])
+
+    # ====================== 通用 ======================
+    @staticmethod
+    async def _json(request: Request) -> Dict[str, Any]:
+        try:
+            body = await request.json()
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise ValueError("请求体不是合法的 JSON")
+        if not isinstance(body, dict):
+            raise ValueError("请求体必须是 JSON 对象")
+        return body
+
+    async def _handle(self, name: str, request: Request, handler):
+        gate = self.gates[name]
+        try:
+            body = await self._json(request)
+        except ValueError as e:
+            return _error(400, str(e), "invalid_request_error")
+        rejected = gate.admit()
+        if rejected is not None:
+            return rejected
+        try:
+            response = await handler(gate, body)
+        except (KeyError, TypeError, ValueError) as e:
+            return _error(400, f"请求参数错误: {e}", "invalid_request_error")
+        gate.stats["ok"] += 1
+        return response
+
+    async def models(self, request: Request) -> JSONResponse:
+        return JSONResponse({"object": "list", "data": [
+            {"id": name, "object": "model", "owned_by": "mock"} for name in ("mock-chat", "mock-embedding", "mock-rerank")
+        ]})
+
+    async def health(self, request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok"})
+
+    async def stats(self, request: Request) -> JSONResponse:
+        return JSONResponse({name: dict(gate.stats, in_flight=gate.in_flight) for name, gate in self.gates.items()})
+
+    # ====================== embeddings ======================
+    async def embeddings(self, request: Request):
+        return await self._handle("embeddings", request, self._embeddings)
+
+    async def _embeddings(self, gate: _EndpointGate, body: Dict[str, Any]) -> JSONResponse:
+        texts = body["input"]
+        texts = [texts] if isinstance(texts, str) else [str(t) for t in texts]
+        dim = int(body.get("dimensions") or self.config.embedding_dim)
+        async with gate.slot():
+            await gate.wait(len(texts))
+            vectors = hashed_embeddings(texts, dim)
+        if body.get("encoding_format") == "base64":
+            encoded = [base64.b64encode(v.tobytes()).decode("ascii") for v in vectors]
+        else:
+            encoded = vectors.tolist()
+        tokens = sum(estimate_tokens(t) for t in texts)
+        return JSONResponse({
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(encoded)],
+            "model": body.get("model", "mock-embedding"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    # ====================== rerank ======================
+    async def rerank(self, request: Request):
+        return await self._handle("rerank", request, self._rerank)
+
+    async def _rerank(self, gate: _EndpointGate, body: Dict[str, Any]) -> JSONResponse:
+        query = str(body["query"])
+        documents = [d if isinstance(d, str) else d.get("text", "") for d in body["documents"]]
+        top_n = body.get("top_n") or len(documents)
+        async with gate.slot():
+            await gate.wait(len(documents))
+            if documents:
+                vectors = hashed_embeddings([query] + documents, self.config.embedding_dim)
+                scores = np.clip(vectors[1:] @ vectors[0], 0.0, 1.0)
+            else:
+                scores = np.zeros(0, dtype=np.float32)
+        order = np.argsort(-scores, kind="stable")[:top_n]
+        return_documents = body.get("return_documents", True)
+        results = []
+        for index in order:
+            item = {"index": int(index), "relevance_score": float(scores[index])}
+            if return_documents:
+                item["document"] = {"text": documents[index]}
+            results.append(item)
+        tokens = estimate_tokens(query) * len(documents) + sum(estimate_tokens(d) for d in documents)
+        return JSONResponse({"id": f"rerank-{uuid.uuid4().hex}", "model": body.get("model", "mock-rerank"),
+                             "results": results, "usage": {"total_tokens": tokens}})
+
+    # ====================== chat ======================
+    async def chat_completions(self, request: Request):
+        return await self._handle("chat", request, self._chat)
+
+    @staticmethod
+    def _message_text(message: Dict[str, Any]) -> str:
+        content = message.get("content") or ""
+        if isinstance(content, list):  # 多模态格式：只取文本部分
+            return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        return str(content)
+
+    @staticmethod
+    def _pick_tool(body: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        决定是否返回工具调用：提供了 tools 且 tool_choice 不为 none 时调用工具，
+        auto 模式下最后一条消息已经是工具结果则直接回答，模拟一轮完整的 agent 循环
+        """
+        tools = [t for t in body.get("tools") or [] if t.get("type", "function") == "function"]
+        choice = body.get("tool_choice", "auto")
+        if not tools or choice == "none":
+            return None
+        if isinstance(choice, dict):
+            name = choice.get("function", {}).get("name")
+            return next((t for t in tools if t["function"]["name"] == name), None)
+        messages = body.get("messages") or []
+        if choice != "required" and messages and messages[-1].get("role") == "tool":
+            return None
+        return tools[0]
+
+    @staticmethod
+    def _fake_arguments(parameters: Dict[str, Any], text: str) -> Dict[str, Any]:
+        """按 JSON Schema 为必填参数生成占位值，字符串参数使用用户最后一句话"""
+        properties = parameters.get("properties", {})
+        arguments = {}
+        for name in parameters.get("required", list(properties)):
+            schema = properties.get(name, {})
+            if schema.get("enum"):
+                arguments[name] = schema["enum"][0]
+                continue
+            arguments[name] = {"integer": 1, "number": 1.0, "boolean": True, "array": [], "object": {}}.get(
+                schema.get("type", "string"), text[:100])
+        return arguments
+
+    def _reply_tokens(self, prompt: str, max_tokens: Optional[int]) -> List[str]:
+        count = min(max_tokens or self.config.chat_reply_tokens, self.config.chat_reply_tokens)
+        seed = zlib.crc32(prompt.encode("utf-8"))
+        return [_REPLY_VOCAB[(seed + i * 7) % len(_REPLY_VOCAB)] for i in range(max(1, count))]
+
+    async def _chat(self, gate: _EndpointGate, body: Dict[str, Any]):
+        messages = body["messages"]
+        prompt = "\n".join(self._message_text(m) for m in messages)
+        last_user = next((self._message_text(m) for m in reversed(messages) if m.get("role") == "user"), "")
+        tool = self._pick_tool(body)
+        tool_call = None
+        if tool is not None:
+            function = tool["function"]
+            tool_call = {
+                "id": f"call_{uuid.uuid4().hex[:24]}",
+                "type": "function",
+                "function": {"name": function["name"],
+                             "arguments": json.dumps(self._fake_arguments(function.get("parameters", {}), last_user),
+                                                     ensure_ascii=False)},
+            }
+            tokens = [tool_call["function"]["arguments"]]
+        else:
+            tokens = self._reply_tokens(prompt, body.get("max_tokens") or body.get("max_completion_tokens"))
+        usage = {"prompt_tokens": estimate_tokens(prompt), "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = body.get("model", "mock-chat")
+
+        if body.get("stream"):
+            include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+            return StreamingResponse(
+                self._stream_chat(gate, completion_id, model, tokens, tool_call, usage if include_usage else None),
+                media_type="text/event-stream",
+            )
+
+        async with gate.slot():
+            await gate.wait()
+            tps = gate.config.tokens_per_second
+            if tps > 0:
+                await asyncio.sleep(len(tokens) / tps)
+        message = {"role": "assistant", "content": None if tool_call else "".join(tokens)}
+        if tool_call:
+            message["tool_calls"] = [tool_call]
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}],
+            "usage": usage,
+        })
+
+    async def _stream_chat(self, gate: _EndpointGate, completion_id: str, model: str, tokens: List[str],
+                           tool_call: Optional[Dict[str, Any]], usage: Optional[Dict[str, int]]):
+        created = int(time.time())
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                       "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+        # 并发槽位在整个流式输出期间占用，与推理服务一致
+        async with gate.slot():
+            await gate.wait()  # 首 token 延迟
+            interval = 1.0 / gate.config.tokens_per_second if gate.config.tokens_per_second > 0 else 0.0
+            if tool_call:
+                yield chunk({"role": "assistant", "content": None, "tool_calls": [{
+                    "index": 0, "id": tool_call["id"], "type": "function",
+                    "function": {"name": tool_call["function"]["name"], "arguments": ""}}]})
+                await asyncio.sleep(interval)
+                yield chunk({"tool_calls": [{"index": 0, "function": {"arguments": tool_call["function"]["arguments"]}}]})
+                yield chunk({}, "tool_calls")
+            else:
+                yield chunk({"role": "assistant", "content": ""})
+                for token in tokens:
+                    yield chunk({"content": token})
+                    if interval:
+                        await asyncio.sleep(interval)
+                yield chunk({}, "stop")
+            if usage is not None:
+                payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                           "choices": [], "usage": usage}
+                yield f"data: {json.dumps(payload)}\n\n"
+            yield "data: [DONE]\n\n"
+
+
+def create_app(config: Optional[MockServerConfig] = None) -> Starlette:
+    """创建替身服务的 ASGI 应用，可交给 uvicorn 或测试客户端使用"""
+    return MockOpenAIServer(config).app
+
+
+class BackgroundMockServer:
+    """
+    在后台线程中运行替身服务，便于基准测试脚本在同一进程中启动/关闭：
+        with BackgroundMockServer(config) as server:
+            os.environ["EMBEDDING_MODEL_URL"] = server.url("/v1/embeddings")
+    """
+
+    def __init__(self, config: Optional[MockServerConfig] = None):
+        self.config = config or MockServerConfig()
+        self._server = uvicorn.Server(uvicorn.Config(create_app(self.config), host=self.config.host,
+                                                     port=self.config.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, name="mock-openai-server", daemon=True)
+
+    def url(self, path: str = "") -> str:
+        return f"http://{self.config.host}:{self.config.port}{path}"
+
+    def start(self, timeout: float = 10.0) -> "BackgroundMockServer":
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError(f"替身服务启动失败: {self.url()}")
+            time.sleep(0.01)
+        logger.info(f"替身服务已启动: {self.url()}")
+        return self
+
+    def stop(self) -> None:
+        self._server.should_exit = True
+        self._thread.join(timeout=10)
+
+    def __enter__(self) -> "BackgroundMockServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+
+def run_mock_server(config: Optional[MockServerConfig] = None) -> None:
+    """在前台运行替身服务（阻塞）"""
+    config = config or MockServerConfig()
+    logger.info(f"替身服务监听 http://{config.host}:{config.port}")
+    uvicorn.run(create_app(config), host=config.host, port=config.port, log_level="warning")
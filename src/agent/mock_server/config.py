@@ -0,0 +1,94 @@
+import random
+import tomllib
+from dataclasses import dataclass, field, fields
+from pathlib import Path
+from typing import Optional
+
+# 与 agent.config 一样读取项目根目录的 config.toml；这里不导入 agent.config，
+# 因为那里会在导入时检查 DATABASE_URL，而替身服务需要在没有 .env 的 CI 环境里启动
+CONFIG_PATH = Path(__file__).parent.parent.parent.parent / "config.toml"
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+
+
+@dataclass
+class EndpointConfig:
+    """
+    单个接口的模拟行为：
+    - latency_*：首包/整体延迟的分布，单位毫秒；per_item_ms 为每条输入（嵌入文本/重排文档）额外增加的耗时
+    - tokens_per_second：chat 接口生成 token 的速度，0 表示一次性返回
+    - error_rate / rate_limit_rate：按概率注入 5xx 与 429
+    - max_concurrency：同时处理的请求数上限（模拟推理服务的并发槽位），0 表示不限制；
+      reject_when_busy 为 true 时超出上限直接返回 429，否则排队等待
+    """
+    latency_dist: str = "fixed"
+    latency_ms: float = 20.0
+    latency_jitter_ms: float = 5.0
+    per_item_ms: float = 0.0
+    tokens_per_second: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+    rate_limit_rate: float = 0.0
+    retry_after_s: int = 1
+    max_concurrency: int = 0
+    reject_when_busy: bool = False
+
+    def __post_init__(self):
+        if self.latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"不支持的延迟分布: {self.latency_dist}，可选 {LATENCY_DISTRIBUTIONS}")
+
+    def sample_latency_ms(self, rng: random.Random, items: int = 1) -> float:
+        """按配置的分布采样一次延迟（毫秒），结果不小于0"""
+        mean, jitter = self.latency_ms, self.latency_jitter_ms
+        if self.latency_dist == "uniform":
+            value = rng.uniform(mean - jitter, mean + jitter)
+        elif self.latency_dist == "normal":
+            value = rng.gauss(mean, jitter)
+        elif self.latency_dist == "lognormal":
+            # latency_ms 作为中位数，jitter/mean 近似为对数标准差，可模拟长尾
+            value = mean * rng.lognormvariate(0.0, jitter / mean) if mean > 0 else 0.0
+        elif self.latency_dist == "exponential":
+            value = rng.expovariate(1.0 / mean) if mean > 0 else 0.0
+        else:
+            value = mean
+        return max(0.0, value) + self.per_item_ms * max(0, items - 1)
+
+
+@dataclass
+class MockServerConfig:
+    host: str = "127.0.0.1"
+    port: int = 9000
+    seed: Optional[int] = None  # 固定随机种子后延迟与故障注入可复现
+    embedding_dim: int = 1024
+    chat_reply_tokens: int = 64
+    chat: EndpointConfig = field(default_factory=lambda: EndpointConfig(latency_ms=200.0, latency_jitter_ms=50.0,
+                                                                        tokens_per_second=50.0))
+    embeddings: EndpointConfig = field(default_factory=lambda: EndpointConfig(per_item_ms=1.0))
+    rerank: EndpointConfig = field(default_factory=lambda: EndpointConfig(latency_ms=50.0, per_item_ms=2.0))
+
+
+ENDPOINTS = ("chat", "embeddings", "rerank")
+
+
+def _apply(target, values: dict) -> None:
+    names = {f.name for f in fields(target)}
+    for key, value in values.items():
+        if key in names and not isinstance(value, dict):
+            setattr(target, key, value)
+
+
+def load_mock_server_config(config_path: Path = CONFIG_PATH) -> MockServerConfig:
+    """
+    读取 config.toml 中的 [mock_server] 与 [mock_server.chat/embeddings/rerank]，
+    未配置的字段使用默认值
+    """
+    config = MockServerConfig()
+    if not config_path.exists():
+        return config
+    with open(config_path, "rb") as f:
+        mock_cfg = tomllib.load(f).get("mock_server", {})
+    _apply(config, mock_cfg)
+    for name in ENDPOINTS:
+        endpoint = getattr(config, name)
+        _apply(endpoint, mock_cfg.get(name, {}))
+        endpoint.__post_init__()
+    return config
@@ -1,10 +1,14 @@
 import asyncio
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
 import requests
-from typing import List, Dict, TypedDict, NotRequired
+from typing import List, Dict, TypedDict, NotRequired, Optional, Tuple
 from loguru import logger
 
+from agent.utils.token_utils import truncate_tokens
+
 class RerankRequest(TypedDict):
     model: str
     query: str
@@ -25,12 +29,44 @@ class RerankResponse(TypedDict):
     usage: NotRequired[dict]  # token 使用信息
     model: str
 
+def _split_batches(total: int, batch_size: int) -> List[Tuple[int, int]]:
+    """把 total 个文档均匀切成若干个不超过 batch_size 的子批次，返回 [(start, end), ...]"""
+    if total <= 0:
+        return []
+    parts = math.ceil(total / max(1, batch_size))
+    size = math.ceil(total / parts)
+    return [(start, min(start + size, total)) for start in range(0, total, size)]
+
+
+def _merge_results(parts: List[Tuple[int, Dict]], top_n: Optional[int], model: str) -> Dict:
+    """
+    合并各子批次的重排序结果：index 加上子批次的偏移还原为全局下标，按分数取全局 top_n；
+    每个文档的分数只与查询有关，不同子批次之间可以直接比较
+    """
+    results, usage = [], {}
+    for offset, part in parts:
+        for item in part.get("results", []):
+            results.append({**item, "index": item["index"] + offset})
+        for key, value in (part.get("usage") or {}).items():
+            if isinstance(value, (int, float)):
+                usage[key] = usage.get(key, 0) + value
+    results.sort(key=lambda item: item["relevance_score"], reverse=True)
+    merged = {"results": results[:top_n] if top_n else results, "model": model}
+    if usage:
+        merged["usage"] = usage
+    return merged
+
+
 class RerankModel: 
     """同步版 Rerank 模型类 
     - 仅支持Jina AI 重排序模型
     - 这里的token不是标准类型的，建议从rerank_documents获取token值
+    - 候选文档超过 batch_size 时拆成子批次并发请求（最多 max_concurrency 个），再合并出全局 top_n；
+      单个请求内的文档在服务端串行打分，拆分后耗时约按并发数下降
+    - 文档先截断到 max_doc_tokens，避免长文档在服务端再被切成多段打分
     """
-    def __init__(self,model_name:str = "BAAI/bge-reranker-v2-m3", api_url: str = "https://api.openai.com/v1/rerank", api_key: str = None,timeout: int = 30, max_retries: int = 3):
+    def __init__(self,model_name:str = "BAAI/bge-reranker-v2-m3", api_url: str = "https://api.openai.com/v1/rerank", api_key: str = None,timeout: int = 30, max_retries: int = 3,
+                 batch_size: int = 16, max_concurrency: int = 4, max_doc_tokens: int = 512):
         if not api_key:
             raise ValueError("请提供API密钥")
         self.api_url = api_url
@@ -38,13 +74,17 @@ class RerankModel:
         self.model_name = model_name
         self.timeout = timeout
         self.max_retries = max_retries
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_doc_tokens = max_doc_tokens
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
 
     def rerank_documents(self, query: str, documents: List[str], instruction: str = "Please rerank the documents based on the query.", top_n: int = 4,
-                    return_documents: bool = True, max_chunks_per_doc: int = 123, overlap_tokens: int = 79) -> Dict:
+                    return_documents: bool = True, max_chunks_per_doc: int = 123, overlap_tokens: int = 79,
+                    timeout: Optional[float] = None, max_retries: Optional[int] = None) -> Dict:
         """
         同步：根据查询和文档重新排序
         :param query: 查询文本
@@ -54,32 +94,49 @@ class RerankModel:
         :param return_documents: 是否返回文档
         :param max_chunks_per_doc: 每个文档的最大块数
         :param overlap_tokens: 重叠的tokens数
+        :param timeout: 本次调用的 HTTP 超时（秒），默认 self.timeout；带延迟预算的检索传入剩余预算，超时后线程立即释放
+        :param max_retries: 本次调用的最多尝试次数，默认 self.max_retries
         :return: 排序后的文档及其相关度分数
         """
-        data: RerankRequest = {
-            "model": self.model_name,
-            "query": query,
-            "documents": documents,
-            "instruction": instruction,
-            "top_n": top_n,
-            "return_documents": return_documents,
-            "max_chunks_per_doc": max_chunks_per_doc,
-            "overlap_tokens": overlap_tokens
-        }
-        # 因为这里获取的文本比较少-所以不用batch来分批次处理
-        for attempt in range(self.max_retries):
+        if self.max_doc_tokens > 0:
+            documents = [truncate_tokens(doc, self.max_doc_tokens) for doc in documents]
+        batches = _split_batches(len(documents), self.batch_size)
+
+        def request(start: int, end: int) -> Dict:
+            data: RerankRequest = {
+                "model": self.model_name,
+                "query": query,
+                "documents": documents[start:end],
+                "instruction": instruction,
+                "top_n": min(top_n, end - start) if top_n else end - start, # 全局 top_n 一定在各子批次的 top_n 之中
+                "return_documents": return_documents,
+                "max_chunks_per_doc": max_chunks_per_doc,
+                "overlap_tokens": overlap_tokens
+            }
+            return self._post(data, timeout, max_retries)
+
+        if len(batches) <= 1:
+            return request(0, len(documents))
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            futures = [(start, executor.submit(request, start, end)) for start, end in batches]
+            return _merge_results([(start, future.result()) for start, future in futures], top_n, self.model_name)
+
+    def _post(self, data: RerankRequest, timeout: Optional[float] = None, max_retries: Optional[int] = None) -> Dict:
+        timeout = self.timeout if timeout is None else timeout
+        max_retries = max(1, self.max_retries if max_retries is None else max_retries)
+        for attempt in range(max_retries):
             try:
-                response = requests.post(self.api_url, headers=self.headers, json=data, timeout=self.timeout)
+                response = requests.post(self.api_url, headers=self.headers, json=data, timeout=timeout)
                 response.raise_for_status()  # 如果返回的状态码是4xx或5xx，会抛出异常
                 result: RerankResponse = response.json()
                 return result  # 返回 API 返回的完整结果和token信息
             except requests.exceptions.Timeout:
-                logger.warning(f"请求超时 (尝试 {attempt + 1}/{self.max_retries})")
-                if attempt == self.max_retries - 1:
+                logger.warning(f"请求超时 (尝试 {attempt + 1}/{max_retries})")
+                if attempt == max_retries - 1:
                     raise
             except requests.exceptions.RequestException as e:
-                logger.error(f"请求失败: {e} (尝试 {attempt + 1}/{self.max_retries})")
-                if attempt == self.max_retries - 1:
+                logger.error(f"请求失败: {e} (尝试 {attempt + 1}/{max_retries})")
+                if attempt == max_retries - 1:
                     raise
 
 
@@ -87,7 +144,7 @@ class RerankModelAsync:
     """异步版 Rerank 模型类"""
 
     def __init__(self, model_name:str = "BAAI/bge-reranker-v2-m3",api_url: str = "https://api.siliconflow.cn/v1/rerank", api_key: str = None, timeout: int = 30,
-                 max_retries: int = 3):
+                 max_retries: int = 3, batch_size: int = 16, max_concurrency: int = 4, max_doc_tokens: int = 512):
         if not api_key:
             raise ValueError("请提供API密钥")
         self.api_url = api_url
@@ -95,6 +152,9 @@ class RerankModelAsync:
         self.timeout = timeout
         self.max_retries = max_retries
         self.model_name = model_name
+        self.batch_size = batch_size # 拆分子批次的规则与同步版一致
+        self.max_concurrency = max_concurrency
+        self.max_doc_tokens = max_doc_tokens
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
@@ -114,25 +174,39 @@ class RerankModelAsync:
         :param overlap_tokens: 重叠的tokens数
         :return: 排序后的文档及其相关度分数和token信息
         """
-        data: RerankRequest = {
-            "model": self.model_name,
-            "query": query,
-            "documents": documents,
-            "instruction": instruction,
-            "top_n": top_k,
-            "return_documents": return_documents,
-            "max_chunks_per_doc": max_chunks_per_doc,
-            "overlap_tokens": overlap_tokens
-        }
-
+        if self.max_doc_tokens > 0:
+            documents = [truncate_tokens(doc, self.max_doc_tokens) for doc in documents]
+        batches = _split_batches(len(documents), self.batch_size)
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+
+        async def request(session: aiohttp.ClientSession, start: int, end: int) -> Dict:
+            data: RerankRequest = {
+                "model": self.model_name,
+                "query": query,
+                "documents": documents[start:end],
+                "instruction": instruction,
+                "top_n": min(top_k, end - start) if top_k else end - start,
+                "return_documents": return_documents,
+                "max_chunks_per_doc": max_chunks_per_doc,
+                "overlap_tokens": overlap_tokens
+            }
+            async with semaphore:
+                return await self._post(session, data)
+
+        async with aiohttp.ClientSession() as session:
+            if len(batches) <= 1:
+                return await request(session, 0, len(documents))
+            parts = await asyncio.gather(*(request(session, start, end) for start, end in batches))
+        return _merge_results([(start, part) for (start, _), part in zip(batches, parts)], top_k, self.model_name)
+
+    async def _post(self, session: aiohttp.ClientSession, data: RerankRequest) -> Dict:
         for attempt in range(self.max_retries):
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(self.api_url, headers=self.headers, json=data,
-                                            timeout=self.timeout) as response:
-                        response.raise_for_status()  # 如果返回的状态码是4xx或5xx，会抛出异常
-                        result: RerankResponse = await response.json()
-                        return result  # 返回 API 返回的完整结果和token信息
+                async with session.post(self.api_url, headers=self.headers, json=data,
+                                        timeout=self.timeout) as response:
+                    response.raise_for_status()  # 如果返回的状态码是4xx或5xx，会抛出异常
+                    result: RerankResponse = await response.json()
+                    return result  # 返回 API 返回的完整结果和token信息
             except asyncio.TimeoutError:
                 logger.warning(f"请求超时 (尝试 {attempt + 1}/{self.max_retries})")
                 if attempt == self.max_retries - 1:
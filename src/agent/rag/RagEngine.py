@@ -1,11 +1,33 @@
-import uuid
-from typing import List, Optional, Sequence, Dict, Iterator, Any, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from dataclasses import replace
+from functools import partial
+from itertools import islice
+from typing import List, Optional, Sequence, Dict, Iterator, Any, Tuple, Iterable
 from langchain_core.documents import Document
 from agent.config import *
 from agent.rag.database import get_chroma_collection,close_chroma
 from agent.rag.loader import DocumentLoader
 from .spliter import TextSplitter
 from agent.rag.indexer import BM25Indexer
+from agent.rag.records import ChunkTable
+from agent.rag.fusion import FusionEngine, RetrieverSpec, weighted_rrf, extract_keywords
+from agent.config.config import (load_rag_fusion, load_rag_budget, load_rag_mmr, load_rag_hierarchy, load_rag_vector,
+                                 load_rag_hnsw, load_rag_profile, load_rag_dedupe, load_rag_matryoshka, RagBudgetConfig,
+                                 RagVectorConfig, RagHnswConfig, RagDedupeConfig)
+from agent.rag.dedupe import Deduplicator, listed_sources, merge_duplicate_sources, release_source
+from agent.rag.timing import stage
+from agent.rag.packer import ChunkAnnotator, PackedChunk, pack_context
+from agent.rag.adjacency import EXPAND_NONE, expand_results, expansion_query, merge_expansion
+from agent.rag.mmr import mmr_select
+from agent.rag.hierarchy import DocumentIndex, sources_of, source_filter
+from agent.rag.alias import resolve_alias
+from agent.rag.snapshot import load_bm25_snapshot
+from agent.rag.vector_space import collection_metadata, normalize_embeddings
+from agent.rag.matryoshka import dense_query, open_matryoshka
+from agent.rag.web_loader import WebPage, WebRefreshReport, fetch_web_pages, summarize
+from agent.rag.budget import (LatencyBudget, RetrievalOutcome, rerank_plan, fallback, apply_rerank,
+                              RERANK_TIMEOUT, RERANK_ERROR)
+import threading
 from .instance import embedder, reranker,async_reranker,async_embedder
 # 这里是chromadb数据库
 # 与测试脚本一致的分隔符设置（兼容递归切分）
@@ -25,11 +47,180 @@ SEPARATORS: list[str] = [
     "",
 ]
 # === RAG参数 ===
-query_distance_threshold = 0.3 # 距离阈值-越小要求越高
-rerank_distance_threshold = 0.1 # 重排序距离阈值-越大要求越高
 K= 60
+EMBED_BATCH_SIZE = 10 # 每次请求嵌入模型的文档块数量
+# 同步引擎的重排序放到独立线程池里等待，超过预算直接退回融合顺序（线程数有限，重排序服务拥塞时排队的请求同样会超时）
+_RERANK_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-rerank")
 #
 
+def _batched(items: Iterable[Any], batch_size: int) -> Iterator[List[Any]]:
+    """把任意可迭代对象按 batch_size 分批，流式数据不需要先整体读入内存"""
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+def _split_per_source(splitter: TextSplitter, docs: List[Document]) -> List[Document]:
+    """
+    按来源分组后再切分：markdown/html/semantic 模式会把传入的文档拼在一起并统一沿用第一个文档的 source，
+    一批里混有多个文件时按 metadata["source"] 分组（保持首次出现的顺序），每个文件的块只带自己的来源
+    """
+    groups: Dict[Any, List[Document]] = {}
+    for doc in docs:
+        groups.setdefault((doc.metadata or {}).get("source"), []).append(doc)
+    return [chunk for group in groups.values() for chunk in splitter.split_documents(group)]
+
+_EMPTY_GET = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}  # 召回为空时不再请求 Chroma（空 ids 会报错）
+
+def _new_deduplicator(config: RagDedupeConfig, dedupe: Optional[bool]) -> Optional[Deduplicator]:
+    """一次入库共用一个去重器；dedupe 为 None 时按 [rag.dedupe] enabled"""
+    return Deduplicator(config) if (config.enabled if dedupe is None else dedupe) else None
+
+def _annotated_batches(docs: Iterable[Document], annotator: ChunkAnnotator,
+                       deduplicator: Optional[Deduplicator]) -> Iterator[List[Document]]:
+    """
+    先按切分后的真实顺序标注 id / chunk_index / 前后指针，再去掉重复块：
+    被去掉的块在前后指针中留下空位，合并相邻块与扩展上下文时不会把原本不相连的正文拼在一起
+    """
+    for batch in _batched(annotator(docs), EMBED_BATCH_SIZE):
+        kept = batch if deduplicator is None else deduplicator.filter(batch)
+        if kept:
+            yield kept
+
+def _log_dedupe(deduplicator: Deduplicator, merged: int) -> None:
+    stats = deduplicator.stats
+    if stats.dropped:
+        logger.info(f"入库去重：{stats.seen} 个块中完全重复 {stats.exact} 个、近似重复 {stats.near} 个，"
+                    f"{merged} 个保留块并入了其它来源")
+
+def _rank_scores(ids: List[str]) -> List[Tuple[str, float]]:
+    """没有分数的召回（关键词）按名次给分 1/(名次+1)，供 MMR 与重排序跳过判断使用"""
+    return [(doc_id, 1.0 / (rank + 1)) for rank, doc_id in enumerate(ids)]
+
+def _retrieve_path(use_hybrid: bool, keyword_only: bool, multi_query: bool = False) -> str:
+    if keyword_only:
+        return "keyword"
+    path = "hybrid" if use_hybrid else "vector"
+    return f"multi_{path}" if multi_query else path
+
+def _query_variants(question: str, variants: Sequence[str]) -> List[str]:
+    """原问题放在第一个（两级检索按它路由），去掉空串与重复的改写"""
+    return list(dict.fromkeys(q.strip() for q in [question, *variants] if q and q.strip()))
+
+def _fuse_multi_query(query_result: dict, min_similarity: Optional[float], sparse_lists: List[List[str]],
+                      weights: Dict[str, float], k: int, top_k: int) -> List[Tuple[str, float]]:
+    """
+    多 query 召回的融合：一次批量向量查询得到每个改写的 dense 列表（min_similarity 不为 None 时按相似度过滤），
+    与各改写的 BM25 列表一起做加权 RRF，同一个块被多个改写召回时分数累加
+    """
+    dense_lists = query_result["ids"]
+    if min_similarity is not None:
+        dense_lists = [[doc_id for doc_id, sim in zip(ids, similarities) if sim >= min_similarity]
+                       for ids, similarities in zip(query_result["ids"], query_result["similarities"])]
+    ranked_lists = list(dense_lists) + sparse_lists
+    list_weights = [weights.get("dense", 1.0)] * len(dense_lists) + [weights.get("bm25", 0.0)] * len(sparse_lists)
+    with stage("fusion"):
+        return weighted_rrf(ranked_lists, list_weights, [k] * len(ranked_lists), top_k)
+
+def _order_by_ids(ids: List[str], got: dict) -> List[Tuple[str, dict]]:
+    """collection.get 不保证按传入 id 的顺序返回，这里按融合后的排名重新排列"""
+    by_id = {doc_id: (doc, _with_id(meta, doc_id)) for doc_id, doc, meta in zip(got["ids"], got["documents"], got["metadatas"])}
+    return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+def _embeddings_by_ids(ids: List[str], got: dict) -> List[Any]:
+    """与 _order_by_ids 对齐的向量"""
+    by_id = dict(zip(got["ids"], got["embeddings"]))
+    return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+def _with_id(meta: Optional[dict], doc_id: str) -> dict:
+    """把 chroma id 注入返回的 metadata（与 iterate_vector_store 一致），便于评测与后续按 id 处理"""
+    meta = dict(meta or {})
+    meta["chroma_id"] = doc_id
+    return meta
+
+def _sanitize_metadata(doc: Document) -> dict:
+    """Chroma 的 metadata 只支持基本类型，列表拼接为字符串，其它对象转为字符串"""
+    meta = (doc.metadata or {}).copy()
+    meta.setdefault("source", meta.get('source', ''))
+    for key, value in meta.items():
+        if isinstance(value, list):
+            meta[key] = ",".join(str(v) for v in value)
+        elif not isinstance(value, (str, int, float, bool, type(None))):
+            meta[key] = str(value)
+    return meta
+
+def _diversify(outcome: RetrievalOutcome, embeddings: List[Any], top_n: int, lambda_mult: float) -> None:
+    """重排序前用 MMR 从候选中选出 top_n 条互不重复的块，减少送去重排序与拼入提示词的近似重复内容"""
+    if len(outcome.results) <= top_n or len(embeddings) != len(outcome.results):
+        return
+    with stage("mmr"):
+        keep = mmr_select(embeddings, outcome.scores, top_n, lambda_mult)
+    outcome.results = [outcome.results[i] for i in keep]
+    outcome.scores = [outcome.scores[i] for i in keep]
+    outcome.mark("mmr", f"{len(embeddings)}->{len(keep)}")
+
+def _open_doc_index(collection, collection_name: str, enabled: bool) -> Optional[DocumentIndex]:
+    """开启两级检索时打开文档级索引；已有块数据但文档级索引为空时先全量重建"""
+    if not enabled:
+        return None
+    doc_index = DocumentIndex(collection_name)
+    if doc_index.count() == 0 and collection.count() > 0:
+        logger.info(f"集合 {collection_name} 的文档级索引为空，开始全量重建...")
+        doc_index.rebuild(collection)
+    return doc_index
+
+def _switch_collection(engine, physical: str) -> None:
+    """
+    别名已指向新的物理集合（蓝绿重建完成）：换用新集合，并重置依赖集合内容的 BM25 索引、来源集合与文档级索引。
+    BM25 在下一次混合检索时按新集合重建，切换期间正在进行的查询继续使用旧集合对象
+    """
+    with engine._alias_lock:
+        if physical == engine._physical_name:
+            return
+        logger.info(f"集合别名 {engine.collection_name} 已切换: {engine._physical_name} -> {physical}")
+        engine._collection = get_chroma_collection(physical)
+        engine._physical_name = physical
+        engine.indexer = BM25Indexer()
+        engine._sources = set()
+        engine.matryoshka = open_matryoshka(engine._collection, physical, engine.matryoshka_config.candidates)
+        engine.doc_index = _open_doc_index(engine._collection, physical, engine.hierarchy_config.enabled)
+
+def _sync_alias(engine) -> None:
+    """
+    每次检索/入库/删除开始时解析一次别名（一次 stat），蓝绿重建切换别名后换用新集合；
+    同一次调用内后续的集合访问直接使用已解析的集合
+    """
+    if engine._closed:
+        return
+    physical = resolve_alias(engine.collection_name)
+    if physical != engine._physical_name:
+        _switch_collection(engine, physical)
+
+def _pages_to_embed(collection, pages: Sequence[WebPage]) -> List[WebPage]:
+    """
+    新增、正文变化的页面，以及缓存显示未变化但集合中还没有块的页面（例如同一站点首次写入另一个集合）；
+    内容全部并入其它页面的块、只出现在合并块 sources 中的页面也算已入库
+    """
+    merged = listed_sources(collection)
+    def indexed(url: str) -> bool:
+        return url in merged or bool(collection.get(where={"source": url}, limit=1, include=[])["ids"])
+    return [page for page in pages if page.document is not None and page.document.page_content
+            and (page.changed or not indexed(page.url))]
+
+def _web_splitter(engine, splitter: Optional[TextSplitter]) -> TextSplitter:
+    return splitter or TextSplitter(mode="recursive", chunk_size=engine.chunk_size, chunk_overlap=engine.chunk_overlap)
+
+def _prepare_vectors(embeddings: Sequence[Any], config: RagVectorConfig) -> Any:
+    """按 [rag.vector] 配置在入库/查询前对整批向量做一次 L2 归一化"""
+    return normalize_embeddings(embeddings) if config.normalize else embeddings
+
+def _pack_outcome(outcome: RetrievalOutcome, config: RagBudgetConfig, rerank_threshold: float) -> List[PackedChunk]:
+    """检索结果去重、合并相邻块后按分数装入 context_tokens 预算"""
+    kept = [(item, score) for item, score in zip(outcome.results, outcome.scores)
+            if not outcome.reranked or score >= rerank_threshold] # 只有重排序分数才按阈值过滤（越大要求越高）
+    return pack_context([item for item, _ in kept], [score for _, score in kept],
+                        config.context_tokens, config.dedupe_threshold)
+
+
 class RagEngine:
     """
     结合 loader 与 splitter 的 RAG 引擎：
@@ -44,23 +235,59 @@ class RagEngine:
             base_path: Optional[str] = None,
             use_semantic_split: bool = True,
             collection_name: str = COLLECTION_NAME,
-            chunk_size: int = 200,
-            chunk_overlap: int = 20,
+            chunk_size: Optional[int] = None,
+            chunk_overlap: Optional[int] = None,
             hybrid_alpha: float = 0.5,
+            hnsw: Optional[RagHnswConfig] = None,
     ):
         self.base_path = base_path or FILE_PATH
-        self.collection = get_chroma_collection(collection_name)
+        # collection_name 可以是别名，实际读写别名当前指向的物理集合
+        self.collection_name = collection_name
+        self._physical_name = resolve_alias(collection_name)
+        # 新建集合使用 [rag.vector] 的距离空间、hnsw（默认 [rag.hnsw]）的索引参数与 [rag.matryoshka] 的截断维度，
+        # 已有集合沿用创建时的参数
+        self.vector_config = load_rag_vector()
+        self.hnsw_config = hnsw or load_rag_hnsw()
+        self.matryoshka_config = load_rag_matryoshka()
+        self._collection = get_chroma_collection(
+            self._physical_name, collection_metadata(self.vector_config.space, self.hnsw_config,
+                                                     self.matryoshka_config.dimensions))
+        # 集合存放截断向量时，全维向量另存用于召回后的重打分
+        self.matryoshka = open_matryoshka(self._collection, self._physical_name, self.matryoshka_config.candidates)
+        self._alias_lock = threading.Lock()
         self.embedding_model = embedder
         self.reranker = reranker
 
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+        # 分块大小与阈值按集合读取 [rag.profile]（可由调参工具写入），显式传入的分块参数优先
+        self.profile = load_rag_profile(collection_name)
+        self.dedupe_config = load_rag_dedupe()
+        self.vector_config.min_similarity = self.profile.min_similarity
+        self.chunk_size = self.profile.chunk_size if chunk_size is None else chunk_size
+        self.chunk_overlap = self.profile.chunk_overlap if chunk_overlap is None else chunk_overlap
         self.use_semantic_split = use_semantic_split
         self._closed = False
         # 混合检索相关
         self.hybrid_alpha = hybrid_alpha
         self.indexer = BM25Indexer()
-
+        self._bm25_lock = threading.Lock()
+        self._sources: set[str] = set() # 知识库中出现过的来源文件，用于文件名精确召回
+        # 多路召回融合：权重与K按集合从 config.toml 读取，也可以 register_retriever 注册额外召回器
+        self.fusion_config = load_rag_fusion(collection_name)
+        self.fusion = FusionEngine()
+        self.extra_retrievers: List[RetrieverSpec] = []
+        self.budget_config = load_rag_budget()
+        self.mmr_config = load_rag_mmr()
+        # 文档 → 块 两级检索：每个来源一条质心向量，先选候选来源再检索块
+        self.hierarchy_config = load_rag_hierarchy()
+        self.doc_index = _open_doc_index(self._collection, self._physical_name, self.hierarchy_config.enabled)
+
+
+    @property
+    def collection(self):
+        """别名当前指向的集合；别名在每次检索/入库/删除开始时解析一次（_sync_alias），属性访问本身不再 stat 别名文件"""
+        if self._closed:
+            return None
+        return self._collection
 
     def __enter__(self): # 不用管
         return self
@@ -71,10 +298,12 @@ class RagEngine:
 
     def cleanup(self):  # 保证其被清理
         if not self._closed:
-            self.collection = None
+            self._collection = None
             self.embedding_model = None
             self.reranker = None
             self.indexer = None
+            self.doc_index = None
+            self.matryoshka = None
             self._closed = True
 
     def __del__(self): # 析构函数在被删除时调用
@@ -84,14 +313,72 @@ class RagEngine:
     def embed_data(
         self,
         input_data: List[Document],
+        dedupe: Optional[bool] = None,
     ) -> int:
-        """嵌入对应的文件。"""
+        """嵌入对应的文件。dedupe 为 None 时按 [rag.dedupe] 配置先去掉重复块，来源并入保留块"""
+        _sync_alias(self)
         try:
-            return self._add_to_vector_store(input_data)
+            deduplicator = _new_deduplicator(self.dedupe_config, dedupe)
+            total_added = self._add_to_vector_store(input_data, deduplicator=deduplicator)
+            if deduplicator is not None:
+                self._finish_dedupe(deduplicator)
+            return total_added
         except Exception as e:
             logger.error(f"Failed to embed data: {e}")
             raise
 
+    def embed_stream(
+        self,
+        documents: Iterable[Document],
+        splitter: Optional[TextSplitter] = None,
+        batch_size: int = 1000,
+        dedupe: Optional[bool] = None,
+    ) -> int:
+        """
+        流式嵌入：按 batch_size 从迭代器中取文档（可选先分块）后写入向量库，
+        配合 DocumentLoader.lazy_load_file 使用时内存占用与文件大小无关。
+        dedupe 为 None 时按 [rag.dedupe] 配置在嵌入前去掉与本次已入库块重复的块，来源在结束时并入保留块
+        """
+        _sync_alias(self)
+        total_added = 0
+        annotator = ChunkAnnotator() # 整个流共用，保证同一来源的 chunk_index 跨批次连续
+        deduplicator = _new_deduplicator(self.dedupe_config, dedupe)
+        try:
+            for batch in _batched(documents, batch_size):
+                chunks = _split_per_source(splitter, batch) if splitter is not None else batch
+                total_added += self._add_to_vector_store(chunks, annotator, deduplicator)
+            if deduplicator is not None:
+                self._finish_dedupe(deduplicator)
+        except Exception as e:
+            logger.error(f"Failed to embed stream: {e}")
+            raise
+        return total_added
+
+    def _finish_dedupe(self, deduplicator: Deduplicator) -> None:
+        merged = merge_duplicate_sources(self.collection, deduplicator)
+        _log_dedupe(deduplicator, merged)
+
+    def refresh_web_pages(self, urls: Iterable[str], crawl: bool = False, css_selector: Optional[str] = None,
+                          max_pages: Optional[int] = None, splitter: Optional[TextSplitter] = None) -> WebRefreshReport:
+        """
+        网页增量入库：并发抓取（条件请求 + 磁盘缓存，见 web_loader.py），只把需要更新的页面重新切分与嵌入，
+        页面原有的块先删除；未变化的页面不请求嵌入服务。不能在运行中的事件循环里调用，异步场景用 AsyncRagEngine
+        :param crawl: 从 urls 出发发现同站、同路径前缀的链接
+        :param splitter: 默认按集合 [rag.profile] 的块大小递归切分
+        """
+        _sync_alias(self)
+        start = time.perf_counter()
+        pages = asyncio.run(fetch_web_pages(urls, crawl, css_selector, max_pages))
+        updated = _pages_to_embed(self.collection, pages)
+        for page in updated:
+            self.delete_vector_store(source=page.url)
+        chunks = 0
+        if updated:
+            chunks = self.embed_data(_web_splitter(self, splitter).split_documents([page.document for page in updated]))
+        report = summarize(pages, chunks, time.perf_counter() - start)
+        logger.info(f"网页增量入库：{report}")
+        return report
+
     def query_embedded_store(
             self,
             question: str,
@@ -103,25 +390,108 @@ class RagEngine:
         :param question: 用户问题
         :param top_k: 返回条数
         :param include: chroma include 参数，默认 documents / metadatas / distances
-        :return: List[Tuple[str, float,str]]返回一个列表，包含(文档内容, 相似度分数, 元数据)
+        :return: List[Tuple[str, dict]]返回一个列表，包含(文档内容, 元数据)
         """
+        _sync_alias(self)
+        return self._query_vector_scored(question, top_k, include)[0]
+
+    def _query_vector_scored(self, question: str, top_k: int, include: Optional[List[str]] = None
+                             ) -> Tuple[List[Tuple[str, dict]], List[float], List[Any]]:
+        """向量检索并返回与结果对齐的相似度分数（按集合距离空间换算，越大越相关），低于 min_similarity 的块被丢弃；include 含 embeddings 时一并返回对齐的向量"""
         k = top_k
-        query_embedding = self.embedding_model.embed_query(question)
-        query_result = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=k,
-            include=include or ["documents", "metadatas", "distances"],
-        )
+        with stage("embed"):
+            query_embedding = _prepare_vectors([self.embedding_model.embed_query(question)], self.vector_config)[0]
+        where = source_filter(self._route(query_embedding))
+        with stage("dense"):
+            # 相似度由距离按集合实际的空间换算（截断向量的集合为全维重打分的结果），阈值以相似度表达，与距离空间无关
+            query_result = dense_query(self.collection, self.matryoshka, [query_embedding], k,
+                                       include or ["documents", "metadatas", "distances"], where)
         docs = query_result["documents"][0]
-        distances = query_result["distances"][0]
-        metadatas = query_result["metadatas"][0]
-        filtered = [(doc,metadata) for doc,dist,metadata in zip(docs,distances,metadatas) if dist >= query_distance_threshold]
-        if not filtered:
-            return []
-        return filtered
+        similarities = query_result["similarities"][0]
+        metadatas = [_with_id(meta, doc_id) for meta, doc_id in zip(query_result["metadatas"][0], query_result["ids"][0])]
+        embeddings = query_result["embeddings"][0] if query_result.get("embeddings") is not None else [None] * len(docs)
+        kept = [((doc,metadata), float(sim), emb) for doc,sim,metadata,emb in zip(docs,similarities,metadatas,embeddings)
+                if sim >= self.vector_config.min_similarity]
+        return ([item for item, _, _ in kept], [score for _, score, _ in kept],
+                [emb for _, _, emb in kept if emb is not None])
+
+    def retrieve(self, question: str, top_k: int = 10, use_hybrid: bool = False, alpha: Optional[float] = None,
+                 use_rerank: bool = True, rerank_top_n: int = 3, budget_ms: Optional[int] = None,
+                 expand: str = EXPAND_NONE, use_mmr: Optional[bool] = None,
+                 keyword_only: bool = False, variants: Optional[Sequence[str]] = None) -> RetrievalOutcome:
+        """
+        带延迟预算的检索：召回(向量/混合) → MMR 多样化 → 按需重排序 → 按需扩展上下文
+        - 召回时一并取回向量，用 MMR 把候选缩减到 [rag.mmr] top_n 条互不重复的块
+        - 前 rerank_top_n 名的融合分数已经拉开差距时跳过重排序
+        - 重排序只在剩余预算内等待，超时或失败时退回融合顺序，保证尾延迟有上界
+        - 扩展按入库时记录的邻接关系一次批量取回相邻块(neighbors)或所在小节(parent)，沿用命中块的分数
+        Args:
+            budget_ms: 本次检索的延迟预算（毫秒），None 时使用 [rag.budget] 配置，<=0 表示不限时
+            expand: none / neighbors / parent
+            use_mmr: 是否做 MMR 多样化，None 时使用 [rag.mmr] 配置
+            keyword_only: 只用关键词召回（文件名/接口名/引号内的词），用于向量与混合检索都落空时的降级
+            variants: 问题的多个改写，不为空时原问题与改写一次批量嵌入、批量召回后 RRF 融合为一个候选集，
+                      重排序仍按原问题打分
+        Returns:
+            RetrievalOutcome: 最终结果、对齐的分数以及每个阶段走的路径
+        """
+        _sync_alias(self)
+        config = self.budget_config
+        budget = LatencyBudget(config.total_ms if budget_ms is None else budget_ms)
+        outcome = RetrievalOutcome()
+        mmr = self.mmr_config.enabled if use_mmr is None else use_mmr
+        include = ["documents", "metadatas"] + (["embeddings"] if mmr else [])
+        if use_hybrid or keyword_only or variants:
+            if variants:
+                id_scores = self._multi_query_ids(_query_variants(question, variants), top_k, use_hybrid, alpha)
+            elif keyword_only:
+                id_scores = _rank_scores(self._query_keyword_search(question, top_k))
+            else:
+                id_scores = self.fusion.fuse(question, self._routed_specs(question, alpha), top_k)
+            ids = [doc_id for doc_id, _ in id_scores]
+            with stage("fetch"):
+                got = self.collection.get(ids=ids, include=include) if ids else _EMPTY_GET
+            outcome.results = _order_by_ids(ids, got)
+            embeddings = _embeddings_by_ids(ids, got) if mmr else []
+            score_of = dict(id_scores)
+            outcome.scores = [score_of[meta["chroma_id"]] for _, meta in outcome.results]
+        else:
+            outcome.results, outcome.scores, embeddings = self._query_vector_scored(question, top_k, include + ["distances"])
+        outcome.mark("retrieve", _retrieve_path(use_hybrid, keyword_only, bool(variants)))
+        if mmr:
+            _diversify(outcome, embeddings, max(self.mmr_config.top_n, rerank_top_n), self.mmr_config.lambda_mult)
+
+        if outcome.results and rerank_plan(outcome, use_rerank, self.reranker is not None, budget, rerank_top_n,
+                                           config.decisive_margin, config.rerank_min_ms):
+            contents = [doc for doc, _ in outcome.results]
+            # 剩余预算同时作为 HTTP 超时：超时后请求本身结束，不会继续占用重排序线程
+            future = _RERANK_EXECUTOR.submit(self.rerank, question, contents, rerank_top_n,
+                                             timeout=budget.remaining_s())
+            try:
+                with stage("rerank"):
+                    apply_rerank(outcome, future.result(timeout=budget.remaining_s()))
+            except FuturesTimeoutError:
+                future.cancel()
+                logger.warning(f"重排序超过延迟预算 {budget.total_ms}ms，退回融合顺序")
+                fallback(outcome, RERANK_TIMEOUT, rerank_top_n)
+            except Exception as e:
+                logger.warning(f"重排序失败，退回融合顺序: {e}")
+                fallback(outcome, RERANK_ERROR, rerank_top_n)
+        if expand != EXPAND_NONE and outcome.results:
+            with stage("expand"):
+                outcome.results, outcome.scores = expand_results(self.collection, outcome.results, outcome.scores, expand)
+            outcome.mark("expand", expand)
+        outcome.elapsed_ms = budget.elapsed_ms()
+        return outcome
+
+    def pack_outcome(self, outcome: RetrievalOutcome) -> List[PackedChunk]:
+        """把检索结果打包到 [rag.budget] context_tokens 预算内（去重、合并相邻块），按分数排序"""
+        return _pack_outcome(outcome, self.budget_config, self.profile.rerank_threshold)
+
     # 构建llm提示词
     def build_answer_prompt(self, question: str, top_k: Optional[int] = 10, use_rerank: bool = True,
-                            rerank_top_n: int = 3, use_hybrid:bool = False, hybrid_alpha:float = 0.6) -> str:
+                            rerank_top_n: int = 3, use_hybrid:bool = False, hybrid_alpha:float = 0.6,
+                            expand: str = EXPAND_NONE) -> str:
         """直接返回拼好的 RAG Prompt，方便接入任意 LLM。
         用户问题 → 向量检索(召回) → Rerank(精排) → 构建提示词 → LLM 生成答案
         Args:
@@ -131,71 +501,32 @@ class RagEngine:
             rerank_top_n: rerank后保留的文档数量，默认为3
             use_hybrid : 使用混合检索
             hybrid_alpha: 混合检索的alpha参数
+            expand: 命中块的上下文扩展方式 none / neighbors(前后相邻块) / parent(所在小节)
         Returns:
             str: 构建好的RAG提示词
         """
-        if use_hybrid:
-            search_results = self.query_hybrid_search(question, top_k=top_k, alpha = hybrid_alpha)
-        else:
-            search_results = self.query_embedded_store(question, top_k=top_k)
-        #  实际的search_results是两个数值
-        if not search_results:
-            return self.build_rag_prompt(question, ["rag无相关检索内容"])
-
-        # 构建文档内容和元数据的映射-构建两个哈希表来映射
-        doc_to_metadata = {doc: metadata for doc, metadata in search_results}
-        contents = list(doc_to_metadata.keys())
-
-        if use_rerank:
-            rerank_result = self.rerank(question, contents, top_n=rerank_top_n)
-            reranked_docs = rerank_result.get("results", [])
-
-            if not reranked_docs:
-                return self.build_rag_prompt(question, ["rag无相关检索内容"])
-
-            # 根据rerank结果构建contexts，同时保留metadata
-            contexts = []
-            for doc in reranked_docs:
-                text = doc["document"]["text"]
-                score = doc["relevance_score"]
-                if score >= rerank_distance_threshold:
-                    metadata = doc_to_metadata.get(text, {})  # 获取对应的metadata
-                    contexts.append(f"内容: {text}| 来源: {os.path.basename(metadata["source"])}\n")
-        else:
-            # 不使用rerank时，直接使用原始结果
-            contexts = [f"内容: {doc}| 来源: {os.path.basename( metadata["source"])}\n" for doc, metadata in search_results]
-
+        # 召回与重排序都在延迟预算内完成，重排序超时会退回融合顺序
+        outcome = self.retrieve(question, top_k=top_k, use_hybrid=use_hybrid, alpha=hybrid_alpha,
+                                use_rerank=use_rerank, rerank_top_n=rerank_top_n, expand=expand)
+        contexts = [f"内容: {chunk.text}| 来源: {os.path.basename(chunk.source)}\n" for chunk in self.pack_outcome(outcome)]
         if not contexts:
             return self.build_rag_prompt(question, ["rag无相关检索内容"])
 
         return self.build_rag_prompt(question, contexts)
 
-    def _add_to_vector_store(self, docs: List[Document]) -> int:
-        if not docs:
-            return 0
-
-        batch_size = 10
+    def _add_to_vector_store(self, docs: Iterable[Document], annotator: Optional[ChunkAnnotator] = None,
+                             deduplicator: Optional[Deduplicator] = None) -> int:
         total_added = 0
-        # 双层保险分批次
-        for i in range(0, len(docs), batch_size): # 外batch的处理
-            batch_docs = docs[i:i + batch_size]
+        # 双层保险分批次，docs 可以是列表也可以是生成器；入库前写入 token_count / chunk_index，标注后再去重
+        for batch_docs in _annotated_batches(docs, annotator or ChunkAnnotator(), deduplicator): # 外batch的处理
             texts = [doc.page_content for doc in batch_docs]
 
-            embeddings = self.embedding_model.embed_documents(texts)
-
-            ids = [str(uuid.uuid4()) for _ in batch_docs]
-            metadatas = []
-            for doc in batch_docs:
-                meta = (doc.metadata or {}).copy()
-                meta.setdefault("source", meta.get('source', ''))
+            embeddings = _prepare_vectors(self.embedding_model.embed_documents(texts), self.vector_config) # 整批一次归一化
 
-                for key, value in meta.items():
-                    if isinstance(value, list):
-                        meta[key] = ",".join(str(v) for v in value)
-                    elif not isinstance(value, (str, int, float, bool, type(None))):
-                        meta[key] = str(value)
-
-                metadatas.append(meta)
+            ids = [doc.id for doc in batch_docs] # ChunkAnnotator 分配，与 prev_id / next_id 对应
+            metadatas = [_sanitize_metadata(doc) for doc in batch_docs]
+            if self.matryoshka is not None:
+                embeddings = self.matryoshka.add(ids, embeddings) # 全维向量另存，集合与文档级索引只存截断向量
 
             self.collection.add(
                 ids=ids,
@@ -203,19 +534,27 @@ class RagEngine:
                 documents=texts,
                 metadatas=metadatas,
             )
+            if self.doc_index is not None:
+                self.doc_index.add(metadatas, embeddings) # 并入所属来源的质心
             total_added += len(batch_docs)
-            logger.info(f"已嵌入 {total_added}/{len(docs)} 个文档块")
+            logger.info(f"已嵌入 {total_added} 个文档块")
 
         return total_added
 
     def delete_vector_store(self,ids: Optional[List[str]] = None, source: Optional[str] = None, **metadata_filters) -> int:
         """删除文档的便捷方法
         :param ids: 删除的文档ID
-        :param source: 删除的文档来源
+        :param source: 删除的文档来源；只按来源删除时，去重合并块中还列有其它来源的块改归其它来源，不随之删除
         :param metadata_filters: 删除的文档元数据过滤条件
         """
+        _sync_alias(self)
         if ids:
+            affected = sources_of(self.collection, ids=ids) if self.doc_index is not None else []
             self.collection.delete(ids=ids)
+            if self.matryoshka is not None:
+                self.matryoshka.delete(ids)
+            if self.doc_index is not None:
+                self.doc_index.refresh(self.collection, affected) # 删除后重新计算受影响来源的质心
             return len(ids)
 
         where_conditions = {}
@@ -224,7 +563,13 @@ class RagEngine:
         where_conditions.update(metadata_filters)
 
         if where_conditions:
+            owners = release_source(self.collection, source) if source and not metadata_filters else []
+            affected = sources_of(self.collection, where=where_conditions) + owners if self.doc_index is not None else []
+            if self.matryoshka is not None:
+                self.matryoshka.delete(self.collection.get(where=where_conditions, include=[])["ids"])
             self.collection.delete(where=where_conditions)
+            if self.doc_index is not None:
+                self.doc_index.refresh(self.collection, affected)
             return 1  # 实际应用中可以返回删除的文档数量
         return 0
 
@@ -247,6 +592,7 @@ class RagEngine:
         Yields:
             Document: 每次迭代返回一个Document对象
         """
+        _sync_alias(self)
         if include is None:
             include = ['documents', 'metadatas']
 
@@ -314,7 +660,7 @@ class RagEngine:
         ))
 
     def rerank(self, question: str, data: List[str],top_n: Optional[int] = None,max_chunks_per_doc: int = 123,
-                    overlap_tokens: int = 40) -> dict:
+                    overlap_tokens: int = 40, timeout: Optional[float] = None) -> dict:
         """根据列举的列表数据和查询问题重排序，该函数只支持单问题循环
         Args:
         question (str): 用于重排序的查询问题
@@ -322,6 +668,7 @@ class RagEngine:
         top_n (Optional[int], optional): 返回前n个最相关的结果。默认为None，表示返回全部结果
         max_chunks_per_doc (int, optional): 每个文档的最大分块数量。默认为123
         overlap_tokens (int, optional): 文档分块时的重叠token数量。默认为40
+        timeout (Optional[float], optional): 延迟预算内的 HTTP 超时（秒），给定时不再重试，None 使用重排序模型的默认超时与重试
 
     Returns:
         Dict[str, Any]: 包含重排序结果的字典，通常包含：
@@ -329,36 +676,47 @@ class RagEngine:
             - tokens: token使用情况
             - id: 请求ID（如果API返回）
         """
-
-        return self.reranker.rerank_documents(query=question, documents=data, top_n=top_n, max_chunks_per_doc=max_chunks_per_doc,overlap_tokens=overlap_tokens)
+        with stage("rerank"):
+            budget = {} if timeout is None else {"timeout": timeout, "max_retries": 1}
+            return self.reranker.rerank_documents(query=question, documents=data, top_n=top_n, max_chunks_per_doc=max_chunks_per_doc,overlap_tokens=overlap_tokens,
+                                                  **budget)
 
     def build_bm25_index(self,force:bool = False):
         """构建 BM25 索引，需要先获取所有文档，它不支持增量更新
             Args:
             Force(bool): 参数用于强制重新构建索引，即使索引已经存在
         """
-        if self.indexer.is_built() and not force:
-            logger.info("BM25 索引已存在，无需重新构建")
-            return
-        logger.info("开始构建 BM25 索引...")
-        all_docs = self.get_all_documents()
-
-        if not all_docs:
-            logger.warning("知识库里没有文档可用于构建 BM25 索引")
-            return
-
-        self.indexer.build_index(all_docs) # 将文档传进去
-        logger.info("BM25 索引构建完成")
-
-    def _query_bm25_search(self, question: str, top_k: int) -> list[Any] | list[tuple[str, float]]:
-        """使用问题通过BM25库进行稀疏检索"""
+        _sync_alias(self)
+        with self._bm25_lock: # 多路召回并发时只允许一个线程构建索引
+            if self.indexer.is_built() and not force:
+                logger.info("BM25 索引已存在，无需重新构建")
+                return
+            snapshot = None if force else load_bm25_snapshot(self.collection, self._physical_name)
+            if snapshot is not None: # 导入快照时附带的索引，不用重新分词
+                self.indexer, self._sources = snapshot, snapshot.sources()
+                return
+            logger.info("开始构建 BM25 索引...")
+            table = ChunkTable.from_collection(self.collection) # 列式读入 id/正文/来源，不为每个块创建 Document
+
+            if not len(table):
+                logger.warning("知识库里没有文档可用于构建 BM25 索引")
+                return
+
+            self.indexer.build_table(table)
+            self._sources = set(table.sources) - {""}
+            logger.info("BM25 索引构建完成")
+
+    def _query_bm25_search(self, question: str, top_k: int, sources: Optional[List[str]] = None
+                           ) -> list[Any] | list[tuple[str, float]]:
+        """使用问题通过BM25库进行稀疏检索，sources 不为空时只对这些来源的块打分"""
         if self.indexer is None or not self.indexer.is_built():
             logger.warning("BM25 索引未构建，正在构建...")
             self.build_bm25_index()
             if self.indexer is None or not self.indexer.is_built():
                 return []
 
-        return self.indexer.search_index(question, top_k=top_k) # 直接返回对应的文档
+        with stage("bm25"):
+            return self.indexer.search_index(question, top_k=top_k, sources=sources) # 直接返回对应的文档
 
     def query_hybrid_search(
             self,
@@ -366,30 +724,111 @@ class RagEngine:
             top_k: int,
             alpha: float = 0.6,
     ) -> List[Tuple[str, dict]]:
-        """混合检索：返回结合Dense向量检索和BM25稀疏检索的结果
+        """混合检索：返回结合Dense向量检索、BM25稀疏检索以及其它已启用召回器的融合结果
         Args:
             question: 查询问题
             top_k: 返回的文档数量
-            alpha: 混合检索的权重
+            alpha: dense 的权重（BM25 为 1-alpha），None 时使用集合配置中的权重
         Returns:
-            List[Tuple[str, float, dict]]: (文档内容, 融合分数, 元数据)
+            List[Tuple[str, dict]]: (文档内容, 元数据)，按融合分数从高到低
 
         """
+        _sync_alias(self)
+        # 各路召回（dense/BM25/关键词/自定义）并发执行，再做加权RRF融合
+        result_ids = self.fusion.fuse(question, self._routed_specs(question, alpha), top_k)
 
+        return self.search_by_id(result_ids)
 
-        query_embedding = self.embedding_model.embed_query(question) # 获取嵌入向量
-        # 用的就是原始的数据，不要进行距离过滤-易错
-        dense_results  = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=top_k,
-            include=["documents"]
-        ) # 这里自带索引ids
-
-        sparse_results = self._query_bm25_search(question, top_k)
-        # 实际上每个2k融合4k，但是这里直接返回k
-        result_ids = self.rrf_fusion(dense_results, sparse_results , top_k,hybrid_alpha=alpha)
+    def register_retriever(self, spec: RetrieverSpec) -> None:
+        """注册额外的召回器（如元数据过滤召回），参与 query_hybrid_search 的融合"""
+        self.extra_retrievers = [r for r in self.extra_retrievers if r.name != spec.name] + [spec]
 
-        return self.search_by_id(result_ids)
+    def build_retriever_specs(self, alpha: Optional[float] = None) -> List[RetrieverSpec]:
+        """
+        组装本次混合检索的召回器列表：alpha 不为空时 dense/BM25 的权重为 alpha/1-alpha，
+        否则使用集合配置中的权重；其它召回器的权重都来自配置
+        """
+        weights = dict(self.fusion_config.weights)
+        if alpha is not None:
+            weights["dense"], weights["bm25"] = alpha, 1.0 - alpha
+        k = self.fusion_config.K
+        specs = [
+            RetrieverSpec("dense", self._query_dense_ids, weights.get("dense", 0.0), k),
+            RetrieverSpec("bm25", self._query_bm25_search, weights.get("bm25", 0.0), k),
+            RetrieverSpec("keyword", self._query_keyword_search, weights.get("keyword", 0.0), k),
+        ]
+        return specs + self.extra_retrievers
+
+    def _route(self, query_embedding: List[float]) -> Optional[List[str]]:
+        """两级检索的第一级：选出候选来源；未开启或来源数不超过 min_docs 时返回 None（检索全部块）"""
+        if self.doc_index is None:
+            return None
+        if self.matryoshka is not None:
+            query_embedding = self.matryoshka.reduce(query_embedding) # 质心由集合中的截断向量算出
+        with stage("route"):
+            if self.doc_index.count() <= self.hierarchy_config.min_docs:
+                return None
+            return self.doc_index.select(query_embedding, self.hierarchy_config.candidate_docs)
+
+    def _routed_specs(self, question: str, alpha: Optional[float] = None) -> List[RetrieverSpec]:
+        """两级检索开启时先路由到候选来源，dense/BM25 两路只在候选来源的块中召回"""
+        specs = self.build_retriever_specs(alpha)
+        if self.doc_index is None:
+            return specs
+        with stage("embed"):
+            query_embedding = _prepare_vectors([self.embedding_model.embed_query(question)], self.vector_config)[0]
+        sources = self._route(query_embedding)
+        routed = {
+            "dense": partial(self._query_dense_ids, where=source_filter(sources), query_embedding=query_embedding),
+            "bm25": partial(self._query_bm25_search, sources=sources),
+        }
+        return [replace(spec, retrieve=routed[spec.name]) if spec.name in routed else spec for spec in specs]
+
+    def _query_dense_ids(self, question: str, top_k: int, where: Optional[Dict] = None,
+                         query_embedding: Optional[List[float]] = None) -> List[str]:
+        """dense 召回：只取 id，不做距离过滤（融合前过滤会破坏排名）；两级检索时复用路由阶段算好的问题向量"""
+        if query_embedding is None:
+            with stage("embed"):
+                query_embedding = _prepare_vectors([self.embedding_model.embed_query(question)], self.vector_config)[0]
+        with stage("dense"):
+            return dense_query(self.collection, self.matryoshka, [query_embedding], top_k, [], where)["ids"][0]
+
+    def _multi_query_ids(self, questions: Sequence[str], top_k: int, use_hybrid: bool,
+                         alpha: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        多 query 召回：所有 query 一次批量嵌入、一次批量向量查询（Chroma 在一个请求里并行检索），
+        混合检索时每个 query 再各走一路本地 BM25，全部结果加权 RRF 融合；两级检索按第一个 query（原问题）路由
+        """
+        with stage("embed"):
+            embeddings = _prepare_vectors(self.embedding_model.embed_documents(list(questions)), self.vector_config)
+        sources = self._route(embeddings[0])
+        where = source_filter(sources)
+        with stage("dense"):
+            result = dense_query(self.collection, self.matryoshka, embeddings, top_k,
+                                 [] if use_hybrid else ["distances"], where)
+        sparse = [self._query_bm25_search(q, top_k, sources=sources) for q in questions] if use_hybrid else []
+        weights = {spec.name: spec.weight for spec in self.build_retriever_specs(alpha)} if use_hybrid else {}
+        # 混合检索与单 query 一致，融合前不按距离过滤；纯向量时按 min_similarity 过滤
+        min_similarity = None if use_hybrid else self.vector_config.min_similarity
+        return _fuse_multi_query(result, min_similarity, sparse, weights, self.fusion_config.K, top_k)
+
+    def _query_keyword_search(self, question: str, top_k: int) -> List[str]:
+        """关键词召回：问题里的文件名按来源精确匹配，接口名/引号内的词按原文包含匹配"""
+        filenames, keywords = extract_keywords(question)
+        ids: List[str] = []
+        if filenames and not self._sources:
+            self.build_bm25_index()
+        with stage("keyword"):
+            if filenames:
+                wanted = {name.lower() for name in filenames}
+                sources = [src for src in self._sources if os.path.basename(src).lower() in wanted]
+                if sources:
+                    ids.extend(self.collection.get(where={"source": {"$in": sources}}, limit=top_k, include=[])["ids"])
+            for keyword in keywords:
+                if len(ids) >= top_k:
+                    break
+                ids.extend(self.collection.get(where_document={"$contains": keyword}, limit=top_k, include=[])["ids"])
+        return list(dict.fromkeys(ids))[:top_k]
 
     def search_by_id(self, id_score_list: List[Tuple[str, float]] ) -> List[
         Tuple[str, Dict[str, Any]]]:
@@ -400,13 +839,12 @@ class RagEngine:
         Returns:
             Tuple[str, Dict[str, Any]]: 第一个为数据，第二个为metadata字典
         """
+        _sync_alias(self)
         ids = [doc_id for doc_id, _ in id_score_list]
         # 从集合中获取文档内容和元数据
-        got = self.collection.get(ids=ids, include=["documents", "metadatas"])
-        result = []
-        for doc_data,doc_metadata in zip(got["documents"], got["metadatas"]):
-            result.append((doc_data, doc_metadata))
-        return result
+        with stage("fetch"):
+            got = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return _order_by_ids(ids, got)
 
     def get_all_file(self) -> tuple[list[Any], str | None ]:
         """
@@ -454,21 +892,9 @@ class RagEngine:
         Returns:
             List[Tuple[str, float, dict]]: 融合后的结果
         """
-        doc_scores = {}
-        dense_ids =dense_results["ids"][0] # 支持多轮对话
-        for rank, doc_id in enumerate(dense_ids, 1):
-            if doc_id not in doc_scores:
-                doc_scores[doc_id] = 0.0
-            doc_scores[doc_id] += hybrid_alpha * (1.0 / (rank + K))
-
-        for rank, doc_id in enumerate(sparse_results, 1):
-            if doc_id not in doc_scores:
-                doc_scores[doc_id] = 0.0
-            doc_scores[doc_id] += (1.0 - hybrid_alpha) * (1.0 / (rank + K))
-
-        sorted_results = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
-
-        return sorted_results # 返回的是id和分数
+        dense_ids =dense_results["ids"][0] if isinstance(dense_results, dict) else dense_results # 支持多轮对话
+        # 两路召回的特例，通用的多路融合见 FusionEngine
+        return weighted_rrf([dense_ids, sparse_results], [hybrid_alpha, 1.0 - hybrid_alpha], [K, K], top_k) # 返回的是id和分数
 
 
 class AsyncRagEngine:
@@ -485,22 +911,57 @@ class AsyncRagEngine:
             base_path: Optional[str] = None,
             use_semantic_split: bool = True,
             collection_name: str = COLLECTION_NAME,
-            chunk_size: int = 200,
-            chunk_overlap: int = 20,
+            chunk_size: Optional[int] = None,
+            chunk_overlap: Optional[int] = None,
             hybrid_alpha: float = 0.5,
+            hnsw: Optional[RagHnswConfig] = None,
     ):
         self.base_path = base_path or FILE_PATH
-        self.collection = get_chroma_collection(collection_name)
+        # collection_name 可以是别名，实际读写别名当前指向的物理集合
+        self.collection_name = collection_name
+        self._physical_name = resolve_alias(collection_name)
+        # 新建集合使用 [rag.vector] 的距离空间、hnsw（默认 [rag.hnsw]）的索引参数与 [rag.matryoshka] 的截断维度，
+        # 已有集合沿用创建时的参数
+        self.vector_config = load_rag_vector()
+        self.hnsw_config = hnsw or load_rag_hnsw()
+        self.matryoshka_config = load_rag_matryoshka()
+        self._collection = get_chroma_collection(
+            self._physical_name, collection_metadata(self.vector_config.space, self.hnsw_config,
+                                                     self.matryoshka_config.dimensions))
+        # 集合存放截断向量时，全维向量另存用于召回后的重打分
+        self.matryoshka = open_matryoshka(self._collection, self._physical_name, self.matryoshka_config.candidates)
+        self._alias_lock = threading.Lock()
 
         self.embedding_model = async_embedder
         self.reranker = async_reranker
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+        # 分块大小与阈值按集合读取 [rag.profile]（可由调参工具写入），显式传入的分块参数优先
+        self.profile = load_rag_profile(collection_name)
+        self.dedupe_config = load_rag_dedupe()
+        self.vector_config.min_similarity = self.profile.min_similarity
+        self.chunk_size = self.profile.chunk_size if chunk_size is None else chunk_size
+        self.chunk_overlap = self.profile.chunk_overlap if chunk_overlap is None else chunk_overlap
         self.use_semantic_split = use_semantic_split
         self._closed = False
 
         self.hybrid_alpha = hybrid_alpha
         self.indexer = BM25Indexer()
+        self._bm25_lock = asyncio.Lock()
+        self._sources: set[str] = set()
+        self.fusion_config = load_rag_fusion(collection_name)
+        self.fusion = FusionEngine()
+        self.extra_retrievers: List[RetrieverSpec] = []
+        self.budget_config = load_rag_budget()
+        self.mmr_config = load_rag_mmr()
+        # 文档 → 块 两级检索：每个来源一条质心向量，先选候选来源再检索块
+        self.hierarchy_config = load_rag_hierarchy()
+        self.doc_index = _open_doc_index(self._collection, self._physical_name, self.hierarchy_config.enabled)
+
+    @property
+    def collection(self):
+        """别名当前指向的集合；别名在每次检索/入库/删除开始时解析一次（_sync_alias），属性访问本身不再 stat 别名文件"""
+        if self._closed:
+            return None
+        return self._collection
 
     async def __aenter__(self):
         return self
@@ -511,23 +972,79 @@ class AsyncRagEngine:
 
     async def cleanup(self):
         if not self._closed:
-            self.collection = None
+            self._collection = None
             self.embedding_model = None
             self.reranker = None
             self.indexer = None
+            self.doc_index = None
+            self.matryoshka = None
             self._closed = True
 
     async def embed_data(
             self,
             input_data: List[Document],
+            dedupe: Optional[bool] = None,
     ) -> int:
-        """异步嵌入文档"""
+        """异步嵌入文档，去重规则与同步版一致"""
+        _sync_alias(self)
         try:
-            return await self._add_to_vector_store(input_data)
+            deduplicator = _new_deduplicator(self.dedupe_config, dedupe)
+            total_added = await self._add_to_vector_store(input_data, deduplicator=deduplicator)
+            if deduplicator is not None:
+                await self._finish_dedupe(deduplicator)
+            return total_added
         except Exception as e:
             logger.error(f"Failed to embed data: {e}")
             raise
 
+    async def embed_stream(
+            self,
+            documents: Iterable[Document],
+            splitter: Optional[TextSplitter] = None,
+            batch_size: int = 1000,
+            dedupe: Optional[bool] = None,
+    ) -> int:
+        """异步流式嵌入，按 batch_size 分批读取、分块、去重并写入向量库"""
+        _sync_alias(self)
+        total_added = 0
+        annotator = ChunkAnnotator() # 整个流共用，保证同一来源的 chunk_index 跨批次连续
+        deduplicator = _new_deduplicator(self.dedupe_config, dedupe)
+        try:
+            for batch in _batched(documents, batch_size):
+                chunks = _split_per_source(splitter, batch) if splitter is not None else batch
+                total_added += await self._add_to_vector_store(chunks, annotator, deduplicator)
+            if deduplicator is not None:
+                await self._finish_dedupe(deduplicator)
+        except Exception as e:
+            logger.error(f"Failed to embed stream: {e}")
+            raise
+        return total_added
+
+    async def _finish_dedupe(self, deduplicator: Deduplicator) -> None:
+        loop = asyncio.get_running_loop()
+        merged = await loop.run_in_executor(None, merge_duplicate_sources, self.collection, deduplicator)
+        _log_dedupe(deduplicator, merged)
+
+    async def refresh_web_pages(self, urls: Iterable[str], crawl: bool = False, css_selector: Optional[str] = None,
+                                max_pages: Optional[int] = None, splitter: Optional[TextSplitter] = None
+                                ) -> WebRefreshReport:
+        """异步网页增量入库，规则与同步版一致"""
+        _sync_alias(self)
+        start = time.perf_counter()
+        pages = await fetch_web_pages(urls, crawl, css_selector, max_pages)
+        loop = asyncio.get_running_loop()
+        updated = await loop.run_in_executor(None, _pages_to_embed, self.collection, pages)
+        for page in updated:
+            await self.delete_vector_store(source=page.url)
+        chunks = 0
+        if updated:
+            documents = await loop.run_in_executor(None, _web_splitter(self, splitter).split_documents,
+                                                   [page.document for page in updated])
+            chunks = await self.embed_data(documents)
+        report = summarize(pages, chunks, time.perf_counter() - start)
+        logger.info(f"网页增量入库：{report}")
+        return report
+
     async def query_embedded_store(
             self,
             question: str,
@@ -537,27 +1054,95 @@ class AsyncRagEngine:
         """
         异步询问检索相似内容
         """
+        _sync_alias(self)
+        return (await self._query_vector_scored(question, top_k, include))[0]
+
+    async def _query_vector_scored(self, question: str, top_k: int, include: Optional[List[str]] = None
+                                   ) -> Tuple[List[Tuple[str, dict]], List[float], List[Any]]:
+        """异步向量检索并返回与结果对齐的相似度分数与向量（include 含 embeddings 时）"""
         k = top_k
-        query_embedding = await self.embedding_model.embed_query(question)
+        with stage("embed"):
+            query_embedding = _prepare_vectors([await self.embedding_model.embed_query(question)], self.vector_config)[0]
+        where = source_filter(await self._route(query_embedding))
 
         loop = asyncio.get_running_loop()
-        query_result = await loop.run_in_executor(
-            None,
-            lambda: self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=k,
-                include=include or ["documents", "metadatas", "distances"],
+        with stage("dense"):
+            query_result = await loop.run_in_executor(
+                None,
+                lambda: dense_query(self.collection, self.matryoshka, [query_embedding], k,
+                                    include or ["documents", "metadatas", "distances"], where)
             )
-        )
 
         docs = query_result["documents"][0]
-        distances = query_result["distances"][0]
-        metadatas = query_result["metadatas"][0]
-        filtered = [(doc, metadata) for doc, dist, metadata in zip(docs, distances, metadatas)
-                    if dist >= query_distance_threshold]
-        if not filtered:
-            return []
-        return filtered
+        similarities = query_result["similarities"][0]
+        metadatas = [_with_id(meta, doc_id) for meta, doc_id in zip(query_result["metadatas"][0], query_result["ids"][0])]
+        embeddings = query_result["embeddings"][0] if query_result.get("embeddings") is not None else [None] * len(docs)
+        kept = [((doc, metadata), float(sim), emb) for doc, sim, metadata, emb in zip(docs, similarities, metadatas, embeddings)
+                if sim >= self.vector_config.min_similarity]
+        return ([item for item, _, _ in kept], [score for _, score, _ in kept],
+                [emb for _, _, emb in kept if emb is not None])
+
+    async def retrieve(self, question: str, top_k: int = 10, use_hybrid: bool = False, alpha: Optional[float] = None,
+                       use_rerank: bool = True, rerank_top_n: int = 3,
+                       budget_ms: Optional[int] = None, expand: str = EXPAND_NONE,
+                       use_mmr: Optional[bool] = None, keyword_only: bool = False,
+                       variants: Optional[Sequence[str]] = None) -> RetrievalOutcome:
+        """异步带延迟预算的检索，规则与同步版一致；重排序超时会被取消"""
+        _sync_alias(self)
+        config = self.budget_config
+        budget = LatencyBudget(config.total_ms if budget_ms is None else budget_ms)
+        outcome = RetrievalOutcome()
+        mmr = self.mmr_config.enabled if use_mmr is None else use_mmr
+        include = ["documents", "metadatas"] + (["embeddings"] if mmr else [])
+        if use_hybrid or keyword_only or variants:
+            if variants:
+                id_scores = await self._multi_query_ids(_query_variants(question, variants), top_k, use_hybrid, alpha)
+            elif keyword_only:
+                id_scores = _rank_scores(await self._query_keyword_search(question, top_k))
+            else:
+                id_scores = await self.fusion.afuse(question, await self._routed_specs(question, alpha), top_k)
+            ids = [doc_id for doc_id, _ in id_scores]
+            loop = asyncio.get_running_loop()
+            with stage("fetch"):
+                got = await loop.run_in_executor(None, lambda: self.collection.get(ids=ids, include=include)) \
+                    if ids else _EMPTY_GET
+            outcome.results = _order_by_ids(ids, got)
+            embeddings = _embeddings_by_ids(ids, got) if mmr else []
+            score_of = dict(id_scores)
+            outcome.scores = [score_of[meta["chroma_id"]] for _, meta in outcome.results]
+        else:
+            outcome.results, outcome.scores, embeddings = await self._query_vector_scored(
+                question, top_k, include + ["distances"])
+        outcome.mark("retrieve", _retrieve_path(use_hybrid, keyword_only, bool(variants)))
+        if mmr:
+            _diversify(outcome, embeddings, max(self.mmr_config.top_n, rerank_top_n), self.mmr_config.lambda_mult)
+
+        if outcome.results and rerank_plan(outcome, use_rerank, self.reranker is not None, budget, rerank_top_n,
+                                           config.decisive_margin, config.rerank_min_ms):
+            contents = [doc for doc, _ in outcome.results]
+            try:
+                apply_rerank(outcome, await asyncio.wait_for(self.rerank(question, contents, top_n=rerank_top_n),
+                                                             timeout=budget.remaining_s()))
+            except asyncio.TimeoutError:
+                logger.warning(f"重排序超过延迟预算 {budget.total_ms}ms，退回融合顺序")
+                fallback(outcome, RERANK_TIMEOUT, rerank_top_n)
+            except Exception as e:
+                logger.warning(f"重排序失败，退回融合顺序: {e}")
+                fallback(outcome, RERANK_ERROR, rerank_top_n)
+        if expand != EXPAND_NONE and outcome.results:
+            query = expansion_query(outcome.results, expand)
+            if query is not None:
+                loop = asyncio.get_running_loop()
+                with stage("expand"):
+                    got = await loop.run_in_executor(None, lambda: self.collection.get(**query))
+                outcome.results, outcome.scores = merge_expansion(outcome.results, outcome.scores, got, expand)
+            outcome.mark("expand", expand)
+        outcome.elapsed_ms = budget.elapsed_ms()
+        return outcome
+
+    def pack_outcome(self, outcome: RetrievalOutcome) -> List[PackedChunk]:
+        """把检索结果打包到 [rag.budget] context_tokens 预算内（去重、合并相邻块），按分数排序"""
+        return _pack_outcome(outcome, self.budget_config, self.profile.rerank_threshold)
 
     async def build_answer_prompt(
             self,
@@ -566,72 +1151,34 @@ class AsyncRagEngine:
             use_rerank: bool = True,
             rerank_top_n: Optional[int] = 3,
             use_hybrid: bool = False,
-            hybrid_alpha: float = 0.6
+            hybrid_alpha: float = 0.6,
+            expand: str = EXPAND_NONE,
     ) -> str:
         """异步构建 RAG Prompt"""
-        if use_hybrid:
-            search_results = await self.query_hybrid_search(question, top_k=top_k, alpha=hybrid_alpha)
-        else:
-            search_results = await self.query_embedded_store(question, top_k=top_k)
-
-        if not search_results:
-            return self.build_rag_prompt(question, ["rag无相关检索内容"])
-
-        doc_to_metadata = {doc: metadata for doc, metadata in search_results}
-        contents = list(doc_to_metadata.keys())
-
-        if use_rerank:
-            rerank_result = await self.rerank(question, contents, top_n=rerank_top_n)
-            reranked_docs = rerank_result.get("results", [])
-
-            if not reranked_docs:
-                return self.build_rag_prompt(question, ["rag无相关检索内容"])
-
-            contexts = []
-            for doc in reranked_docs:
-                text = doc["document"]["text"]
-                score = doc["relevance_score"]
-                if score >= rerank_distance_threshold:
-                    metadata = doc_to_metadata.get(text, {})
-                    contexts.append(f"内容: {text}| 来源: {os.path.basename(metadata['source'])}\n")
-        else:
-            contexts = [f"内容: {doc}| 来源: {os.path.basename(metadata['source'])}\n"
-                        for doc, metadata in search_results]
-
+        outcome = await self.retrieve(question, top_k=top_k, use_hybrid=use_hybrid, alpha=hybrid_alpha,
+                                      use_rerank=use_rerank, rerank_top_n=rerank_top_n, expand=expand)
+        contexts = [f"内容: {chunk.text}| 来源: {os.path.basename(chunk.source)}\n" for chunk in self.pack_outcome(outcome)]
         if not contexts:
             return self.build_rag_prompt(question, ["rag无相关检索内容"])
 
         return self.build_rag_prompt(question, contexts)
 
-    async def _add_to_vector_store(self, docs: List[Document]) -> int:
-        """异步批量嵌入文档"""
-        if not docs:
-            return 0
-
-        batch_size = 10
+    async def _add_to_vector_store(self, docs: Iterable[Document], annotator: Optional[ChunkAnnotator] = None,
+                                   deduplicator: Optional[Deduplicator] = None) -> int:
+        """异步批量嵌入文档，入库前写入 token_count / chunk_index，标注后再去重"""
         total_added = 0
 
-        for i in range(0, len(docs), batch_size):
-            batch_docs = docs[i:i + batch_size]
+        for batch_docs in _annotated_batches(docs, annotator or ChunkAnnotator(), deduplicator):
             texts = [doc.page_content for doc in batch_docs]
 
-            embeddings = await self.embedding_model.embed_documents(texts)
-
-            ids = [str(uuid.uuid4()) for _ in batch_docs]
-            metadatas = []
-            for doc in batch_docs:
-                meta = (doc.metadata or {}).copy()
-                meta.setdefault("source", meta.get('source', ''))
+            embeddings = _prepare_vectors(await self.embedding_model.embed_documents(texts), self.vector_config)
 
-                for key, value in meta.items():
-                    if isinstance(value, list):
-                        meta[key] = ",".join(str(v) for v in value)
-                    elif not isinstance(value, (str, int, float, bool, type(None))):
-                        meta[key] = str(value)
-
-                metadatas.append(meta)
+            ids = [doc.id for doc in batch_docs] # ChunkAnnotator 分配，与 prev_id / next_id 对应
+            metadatas = [_sanitize_metadata(doc) for doc in batch_docs]
 
             loop = asyncio.get_running_loop()
+            if self.matryoshka is not None:
+                embeddings = await loop.run_in_executor(None, self.matryoshka.add, ids, embeddings)
             await loop.run_in_executor(
                 None,
                 lambda: self.collection.add(
@@ -641,8 +1188,10 @@ class AsyncRagEngine:
                     metadatas=metadatas,
                 )
             )
+            if self.doc_index is not None:
+                await loop.run_in_executor(None, self.doc_index.add, metadatas, embeddings)
             total_added += len(batch_docs)
-            logger.info(f"已嵌入 {total_added}/{len(docs)} 个文档块")
+            logger.info(f"已嵌入 {total_added} 个文档块")
 
         return total_added
 
@@ -652,11 +1201,18 @@ class AsyncRagEngine:
             source: Optional[str] = None,
             **metadata_filters
     ) -> int:
-        """异步删除文档"""
+        """异步删除文档，合并块的处理与同步版一致"""
+        _sync_alias(self)
         loop = asyncio.get_running_loop()
 
         if ids:
+            affected = await loop.run_in_executor(None, lambda: sources_of(self.collection, ids=ids)) \
+                if self.doc_index is not None else []
             await loop.run_in_executor(None, lambda: self.collection.delete(ids=ids))
+            if self.matryoshka is not None:
+                await loop.run_in_executor(None, self.matryoshka.delete, ids)
+            if self.doc_index is not None:
+                await loop.run_in_executor(None, self.doc_index.refresh, self.collection, affected)
             return len(ids)
 
         where_conditions = {}
@@ -665,7 +1221,17 @@ class AsyncRagEngine:
         where_conditions.update(metadata_filters)
 
         if where_conditions:
+            owners = await loop.run_in_executor(None, release_source, self.collection, source) \
+                if source and not metadata_filters else []
+            affected = await loop.run_in_executor(None, lambda: sources_of(self.collection, where=where_conditions)) \
+                + owners if self.doc_index is not None else []
+            if self.matryoshka is not None:
+                doomed = await loop.run_in_executor(
+                    None, lambda: self.collection.get(where=where_conditions, include=[])["ids"])
+                await loop.run_in_executor(None, self.matryoshka.delete, doomed)
             await loop.run_in_executor(None, lambda: self.collection.delete(where=where_conditions))
+            if self.doc_index is not None:
+                await loop.run_in_executor(None, self.doc_index.refresh, self.collection, affected)
             return 1
         return 0
 
@@ -680,6 +1246,7 @@ class AsyncRagEngine:
         遍历向量数据库（保持同步，因为是生成器）
         如需异步遍历，请使用 get_all_documents_async
         """
+        _sync_alias(self)
         if include is None:
             include = ['documents', 'metadatas']
 
@@ -746,32 +1313,43 @@ class AsyncRagEngine:
             overlap_tokens: int = 40
     ) -> dict:
         """异步重排序"""
-        return await self.reranker.rerank_documents(
-            query=question,
-            documents=data,
-            top_k=top_n,
-            max_chunks_per_doc=max_chunks_per_doc,
-            overlap_tokens=overlap_tokens
-        )
+        with stage("rerank"):
+            return await self.reranker.rerank_documents(
+                query=question,
+                documents=data,
+                top_k=top_n,
+                max_chunks_per_doc=max_chunks_per_doc,
+                overlap_tokens=overlap_tokens
+            )
 
     async def build_bm25_index_async(self, force: bool = False):
         """异步构建 BM25 索引"""
-        if self.indexer.is_built() and not force:
-            logger.info("BM25 索引已存在，无需重新构建")
-            return
+        _sync_alias(self)
+        async with self._bm25_lock:
+            if self.indexer.is_built() and not force:
+                logger.info("BM25 索引已存在，无需重新构建")
+                return
 
-        logger.info("开始构建 BM25 索引...")
-        all_docs = await self.get_all_documents_async()
+            loop = asyncio.get_running_loop()
+            snapshot = None if force else await loop.run_in_executor(
+                None, load_bm25_snapshot, self.collection, self._physical_name)
+            if snapshot is not None:
+                self.indexer, self._sources = snapshot, snapshot.sources()
+                return
 
-        if not all_docs:
-            logger.warning("知识库里没有文档可用于构建 BM25 索引")
-            return
+            logger.info("开始构建 BM25 索引...")
+            table = await loop.run_in_executor(None, ChunkTable.from_collection, self.collection)
 
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, lambda: self.indexer.build_index(all_docs))
-        logger.info("BM25 索引构建完成")
+            if not len(table):
+                logger.warning("知识库里没有文档可用于构建 BM25 索引")
+                return
 
-    async def _query_bm25_search(self, question: str, top_k: int) -> list[Any] | list[tuple[str, float]]:
+            await loop.run_in_executor(None, self.indexer.build_table, table)
+            self._sources = set(table.sources) - {""}
+            logger.info("BM25 索引构建完成")
+
+    async def _query_bm25_search(self, question: str, top_k: int, sources: Optional[List[str]] = None
+                                 ) -> list[Any] | list[tuple[str, float]]:
         """异步 BM25 稀疏检索"""
         if self.indexer is None or not self.indexer.is_built():
             logger.warning("BM25 索引未构建，正在构建...")
@@ -780,10 +1358,11 @@ class AsyncRagEngine:
                 return []
 
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(
-            None,
-            lambda: self.indexer.search_index(question, top_k=top_k)
-        )
+        with stage("bm25"):
+            return await loop.run_in_executor(
+                None,
+                lambda: self.indexer.search_index(question, top_k=top_k, sources=sources)
+            )
 
     async def query_hybrid_search(
             self,
@@ -791,46 +1370,126 @@ class AsyncRagEngine:
             top_k: int,
             alpha: float = 0.6,
     ) -> List[Tuple[str, dict]]:
-        """异步混合检索：并发执行 Dense 和 BM25 检索"""
-        query_embedding_task = self.embedding_model.embed_query(question)
-        bm25_search_task = self._query_bm25_search(question, top_k)
+        """异步混合检索：并发执行各路召回（dense/BM25/关键词/自定义），再做加权RRF融合"""
+        _sync_alias(self)
+        result_ids = await self.fusion.afuse(question, await self._routed_specs(question, alpha), top_k)
 
-        query_embedding, sparse_results = await asyncio.gather(
-            query_embedding_task,
-            bm25_search_task
-        )
+        return await self.search_by_id_async(result_ids)
 
+    def register_retriever(self, spec: RetrieverSpec) -> None:
+        """注册额外的召回器，参与 query_hybrid_search 的融合"""
+        self.extra_retrievers = [r for r in self.extra_retrievers if r.name != spec.name] + [spec]
+
+    def build_retriever_specs(self, alpha: Optional[float] = None) -> List[RetrieverSpec]:
+        """组装本次混合检索的召回器列表，规则与同步版一致"""
+        weights = dict(self.fusion_config.weights)
+        if alpha is not None:
+            weights["dense"], weights["bm25"] = alpha, 1.0 - alpha
+        k = self.fusion_config.K
+        specs = [
+            RetrieverSpec("dense", self._query_dense_ids, weights.get("dense", 0.0), k),
+            RetrieverSpec("bm25", self._query_bm25_search, weights.get("bm25", 0.0), k),
+            RetrieverSpec("keyword", self._query_keyword_search, weights.get("keyword", 0.0), k),
+        ]
+        return specs + self.extra_retrievers
+
+    async def _route(self, query_embedding: List[float]) -> Optional[List[str]]:
+        """两级检索的第一级：选出候选来源，规则与同步版一致"""
+        if self.doc_index is None:
+            return None
+        if self.matryoshka is not None:
+            query_embedding = self.matryoshka.reduce(query_embedding)
+        loop = asyncio.get_running_loop()
+        with stage("route"):
+            if await loop.run_in_executor(None, self.doc_index.count) <= self.hierarchy_config.min_docs:
+                return None
+            return await loop.run_in_executor(None, self.doc_index.select, query_embedding,
+                                              self.hierarchy_config.candidate_docs)
+
+    async def _routed_specs(self, question: str, alpha: Optional[float] = None) -> List[RetrieverSpec]:
+        """两级检索开启时先路由到候选来源，dense/BM25 两路只在候选来源的块中召回"""
+        specs = self.build_retriever_specs(alpha)
+        if self.doc_index is None:
+            return specs
+        with stage("embed"):
+            query_embedding = _prepare_vectors([await self.embedding_model.embed_query(question)], self.vector_config)[0]
+        sources = await self._route(query_embedding)
+        routed = {
+            "dense": partial(self._query_dense_ids, where=source_filter(sources), query_embedding=query_embedding),
+            "bm25": partial(self._query_bm25_search, sources=sources),
+        }
+        return [replace(spec, retrieve=routed[spec.name]) if spec.name in routed else spec for spec in specs]
+
+    async def _query_dense_ids(self, question: str, top_k: int, where: Optional[Dict] = None,
+                               query_embedding: Optional[List[float]] = None) -> List[str]:
+        """异步 dense 召回：只取 id"""
+        if query_embedding is None:
+            with stage("embed"):
+                query_embedding = _prepare_vectors([await self.embedding_model.embed_query(question)], self.vector_config)[0]
+        loop = asyncio.get_running_loop()
+        with stage("dense"):
+            result = await loop.run_in_executor(
+                None, lambda: dense_query(self.collection, self.matryoshka, [query_embedding], top_k, [], where))
+        return result["ids"][0]
+
+    async def _multi_query_ids(self, questions: Sequence[str], top_k: int, use_hybrid: bool,
+                               alpha: Optional[float] = None) -> List[Tuple[str, float]]:
+        """异步多 query 召回：一次批量嵌入、一次批量向量查询，BM25 各路在线程池中并发，规则与同步版一致"""
+        with stage("embed"):
+            embeddings = _prepare_vectors(await self.embedding_model.embed_documents(list(questions)), self.vector_config)
+        sources = await self._route(embeddings[0])
+        where = source_filter(sources)
+        loop = asyncio.get_running_loop()
+        with stage("dense"):
+            result = await loop.run_in_executor(None, lambda: dense_query(
+                self.collection, self.matryoshka, embeddings, top_k, [] if use_hybrid else ["distances"], where))
+        sparse = []
+        if use_hybrid:
+            if self.indexer is None or not self.indexer.is_built():
+                await self.build_bm25_index_async()  # 先建好索引，避免并发的各路同时触发构建
+            sparse = list(await asyncio.gather(*(self._query_bm25_search(q, top_k, sources=sources) for q in questions)))
+        weights = {spec.name: spec.weight for spec in self.build_retriever_specs(alpha)} if use_hybrid else {}
+        min_similarity = None if use_hybrid else self.vector_config.min_similarity
+        return _fuse_multi_query(result, min_similarity, sparse, weights, self.fusion_config.K, top_k)
+
+    async def _query_keyword_search(self, question: str, top_k: int) -> List[str]:
+        """异步关键词召回：文件名按来源精确匹配，接口名/引号内的词按原文包含匹配"""
+        filenames, keywords = extract_keywords(question)
+        if filenames and not self._sources:
+            await self.build_bm25_index_async()
         loop = asyncio.get_running_loop()
-        dense_results = await loop.run_in_executor(
-            None,
-            lambda: self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k,
-                include=["documents"]
-            )
-        )
-
-        result_ids = self.rrf_fusion(dense_results, sparse_results, top_k, hybrid_alpha=alpha)
 
-        return await self.search_by_id_async(result_ids)
+        def keyword_ids() -> List[str]:
+            ids: List[str] = []
+            if filenames:
+                wanted = {name.lower() for name in filenames}
+                sources = [src for src in self._sources if os.path.basename(src).lower() in wanted]
+                if sources:
+                    ids.extend(self.collection.get(where={"source": {"$in": sources}}, limit=top_k, include=[])["ids"])
+            for keyword in keywords:
+                if len(ids) >= top_k:
+                    break
+                ids.extend(self.collection.get(where_document={"$contains": keyword}, limit=top_k, include=[])["ids"])
+            return list(dict.fromkeys(ids))[:top_k]
+
+        with stage("keyword"):
+            return await loop.run_in_executor(None, keyword_ids)
 
     async def search_by_id_async(
             self,
             id_score_list: List[Tuple[str, float]]
     ) -> List[Tuple[str, Dict[str, Any]]]:
         """异步通过 ID 获取文档"""
+        _sync_alias(self)
         ids = [doc_id for doc_id, _ in id_score_list]
 
         loop = asyncio.get_running_loop()
-        got = await loop.run_in_executor(
-            None,
-            lambda: self.collection.get(ids=ids, include=["documents", "metadatas"])
-        )
-
-        result = []
-        for doc_data, doc_metadata in zip(got["documents"], got["metadatas"]):
-            result.append((doc_data, doc_metadata))
-        return result
+        with stage("fetch"):
+            got = await loop.run_in_executor(
+                None,
+                lambda: self.collection.get(ids=ids, include=["documents", "metadatas"])
+            )
+        return _order_by_ids(ids, got)
 
     async def get_all_file_async(self) -> tuple[list[Any], str | None]:
         """异步获取文件列表"""
@@ -868,21 +1527,8 @@ class AsyncRagEngine:
             hybrid_alpha: float = 0.6
     ) -> list[tuple[Any, set[float] | float]]:
         """RRF (Reciprocal Rank Fusion) 融合算法"""
-        doc_scores = {}
-        dense_ids = dense_results["ids"][0]
-        for rank, doc_id in enumerate(dense_ids, 1):
-            if doc_id not in doc_scores:
-                doc_scores[doc_id] = 0.0
-            doc_scores[doc_id] += hybrid_alpha * (1.0 / (rank + K))
-
-        for rank, doc_id in enumerate(sparse_results, 1):
-            if doc_id not in doc_scores:
-                doc_scores[doc_id] = 0.0
-            doc_scores[doc_id] += (1.0 - hybrid_alpha) * (1.0 / (rank + K))
-
-        sorted_results = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
-
-        return sorted_results
+        dense_ids = dense_results["ids"][0] if isinstance(dense_results, dict) else dense_results
+        return weighted_rrf([dense_ids, sparse_results], [hybrid_alpha, 1.0 - hybrid_alpha], [K, K], top_k)
 
 
 # ====================== 简单运行示例 ======================
@@ -0,0 +1,112 @@
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# 检索命中后的上下文扩展方式
+EXPAND_NONE = "none"            # 不扩展
+EXPAND_NEIGHBORS = "neighbors"  # 补上同一来源中紧邻的前后块
+EXPAND_PARENT = "parent"        # 补上命中块所在小节（parent_id 相同）的其它块
+EXPAND_MODES = (EXPAND_NONE, EXPAND_NEIGHBORS, EXPAND_PARENT)
+MAX_PARENT_CHUNKS = 8  # 小节扩展时每个命中块最多补充的块数，只在其前后该范围内就近选取
+
+# 小节的划分依据：markdown/html 的标题路径，其次是 pdf 等分页文档的页码
+_SECTION_KEYS = ("header_path", "page")
+
+
+def section_id(source: str, meta: Dict[str, Any]) -> Optional[str]:
+    """根据来源与标题路径/页码计算小节 id，没有可用的划分依据时返回 None"""
+    for key in _SECTION_KEYS:
+        value = meta.get(key)
+        if value not in (None, ""):
+            return hashlib.md5(f"{source}\x1f{key}\x1f{value}".encode("utf-8")).hexdigest()[:16]
+    return None
+
+
+def expansion_query(results: Sequence[Tuple[str, Dict[str, Any]]], mode: str,
+                    max_parent_chunks: int = MAX_PARENT_CHUNKS) -> Optional[Dict[str, Any]]:
+    """
+    根据命中块 metadata 中入库时写入的 prev_id / next_id / parent_id，生成一次批量 collection.get 的参数；
+    不需要扩展或旧数据没有邻接信息时返回 None。小节扩展只取命中块前后 max_parent_chunks 范围内的块，
+    避免长小节整体读出
+    """
+    if mode not in EXPAND_MODES:
+        raise ValueError(f"未知的扩展方式: {mode}，可选 {EXPAND_MODES}")
+    known = {meta.get("chroma_id") for _, meta in results}
+    if mode == EXPAND_NEIGHBORS:
+        ids = []
+        for _, meta in results:
+            for key in ("prev_id", "next_id"):
+                neighbor = meta.get(key)
+                if neighbor and neighbor not in known and neighbor not in ids:
+                    ids.append(neighbor)
+        return {"ids": ids, "include": ["documents", "metadatas"]} if ids else None
+    if mode == EXPAND_PARENT:
+        conditions = []
+        for _, meta in results:
+            if not meta.get("parent_id") or meta.get("chunk_index") in (None, ""):
+                continue
+            index = int(meta["chunk_index"])
+            condition = {"$and": [{"parent_id": meta["parent_id"]},
+                                  {"chunk_index": {"$gte": index - max_parent_chunks}},
+                                  {"chunk_index": {"$lte": index + max_parent_chunks}}]}
+            if condition not in conditions:
+                conditions.append(condition)
+        if conditions:
+            where = conditions[0] if len(conditions) == 1 else {"$or": conditions}
+            return {"where": where, "include": ["documents", "metadatas"]}
+    return None
+
+
+def merge_expansion(
+        results: Sequence[Tuple[str, Dict[str, Any]]],
+        scores: Sequence[float],
+        got: Dict[str, Any],
+        mode: str,
+        max_parent_chunks: int = MAX_PARENT_CHUNKS,
+) -> Tuple[List[Tuple[str, Dict[str, Any]]], List[float]]:
+    """
+    把扩展取回的块并入结果：扩展块沿用触发它的命中块的分数（多个命中块触发时取最高），
+    排在命中块之后；打包时同一来源的相邻块会被合并成一段连续上下文
+    """
+    known = {meta.get("chroma_id") for _, meta in results}
+    fetched = {}
+    for doc_id, doc, meta in zip(got["ids"], got["documents"], got["metadatas"]):
+        if doc_id not in known:
+            meta = dict(meta or {})
+            meta["chroma_id"] = doc_id
+            fetched[doc_id] = (doc, meta)
+
+    extra_scores: Dict[str, float] = {}
+    if mode == EXPAND_NEIGHBORS:
+        for (_, meta), score in zip(results, scores):
+            for key in ("prev_id", "next_id"):
+                neighbor = meta.get(key)
+                if neighbor in fetched:
+                    extra_scores[neighbor] = max(extra_scores.get(neighbor, score), score)
+    elif mode == EXPAND_PARENT:
+        by_parent: Dict[str, List[str]] = {}
+        for doc_id, (_, meta) in fetched.items():
+            by_parent.setdefault(meta.get("parent_id"), []).append(doc_id)
+        for (_, meta), score in zip(results, scores):
+            members = by_parent.get(meta.get("parent_id"), [])
+            hit_index = int(meta.get("chunk_index") or 0)
+            nearest = sorted(members, key=lambda i: abs(int(fetched[i][1].get("chunk_index") or 0) - hit_index))
+            for doc_id in nearest[:max_parent_chunks]:
+                extra_scores[doc_id] = max(extra_scores.get(doc_id, score), score)
+
+    extras = sorted(extra_scores.items(), key=lambda item: item[1], reverse=True)
+    return (list(results) + [fetched[doc_id] for doc_id, _ in extras],
+            list(scores) + [score for _, score in extras])
+
+
+def expand_results(
+        collection,
+        results: Sequence[Tuple[str, Dict[str, Any]]],
+        scores: Sequence[float],
+        mode: str,
+        max_parent_chunks: int = MAX_PARENT_CHUNKS,
+) -> Tuple[List[Tuple[str, Dict[str, Any]]], List[float]]:
+    """按 mode 把命中块扩展到相邻块或所在小节，只发起一次批量 get"""
+    query = expansion_query(results, mode, max_parent_chunks)
+    if query is None:
+        return list(results), list(scores)
+    return merge_expansion(results, scores, collection.get(**query), mode, max_parent_chunks)
@@ -0,0 +1,371 @@
+"""
+集合别名与蓝绿重建：
+    python -m agent.rag.alias list
+    python -m agent.rag.alias rebuild --alias my_vector                      # 从当前集合重新嵌入（换嵌入模型/维度/截断维度）
+    python -m agent.rag.alias rebuild --alias my_vector --from-files ./file   # 从源文件重新切分并嵌入（换分块策略）
+    python -m agent.rag.alias rollback --alias my_vector
+
+引擎按别名打开集合（没有别名时别名即物理集合名，与旧数据兼容）。重建任务把数据流式写入一个新的物理集合
+<别名>__<时间戳>_<随机后缀>，校验块数与抽样自召回率通过后原子地切换别名；切换前查询一直由旧集合服务，
+切换后各引擎在下一次访问集合时改用新集合。旧集合默认保留，可以 rollback。
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+from agent.config import DB_PATH, logger
+from agent.config.config import load_rag_vector, load_rag_hnsw, load_rag_matryoshka
+from agent.rag.database import get_chroma_client, get_chroma_collection, delete_chroma_collection
+from agent.rag.matryoshka import dense_query, full_vectors_path, open_matryoshka
+from agent.rag.packer import ChunkAnnotator
+from agent.rag.vector_space import collection_metadata as space_metadata, normalize_embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+ALIAS_FILE = "collection_aliases.json"
+
+
+class RebuildError(RuntimeError):
+    """重建后的集合没有通过校验，别名保持不变"""
+
+
+@contextmanager
+def _file_lock(path: Path):
+    """跨进程的排他锁（fcntl.flock，Windows 上用 msvcrt.locking），持有锁的进程退出时由系统释放"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # 约 10 秒内拿不到锁会抛出 OSError，继续等待
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class AliasRegistry:
+    """
+    别名 → 物理集合名的映射，保存在向量库目录下的 JSON 文件中：
+    - 写入先写临时文件再 os.replace，切换是原子的，进程崩溃也不会留下半个文件
+    - 读-改-写在同一进程内由线程锁、跨进程由 <别名文件>.lock 上的文件锁保护（重建 CLI 与快照导入同时切换不会丢更新）
+    - 读取按文件 mtime 缓存，resolve 在查询热路径上只多一次 stat
+    - previous 记录切换前的物理集合，用于回滚
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        self.path = Path(db_path) / ALIAS_FILE
+        self.lock_path = self.path.with_name(ALIAS_FILE + ".lock")
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._data: Dict[str, Dict[str, str]] = {"aliases": {}, "previous": {}}
+
+    def _load(self, force: bool = False) -> Dict[str, Dict[str, str]]:
+        """force 时忽略 mtime 缓存重新读取（持有文件锁修改前，避免 mtime 精度不足读到旧内容）"""
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._mtime, self._data = None, {"aliases": {}, "previous": {}}
+            return self._data
+        if force or mtime != self._mtime:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._data = {"aliases": data.get("aliases", {}), "previous": data.get("previous", {})}
+            self._mtime = mtime
+        return self._data
+
+    def _save(self, data: Dict[str, Dict[str, str]]) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=".aliases-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def resolve(self, name: str) -> str:
+        """别名对应的物理集合名，没有别名时返回原名"""
+        return self._load()["aliases"].get(name, name)
+
+    def aliases(self) -> Dict[str, str]:
+        return dict(self._load()["aliases"])
+
+    def previous(self, alias: str) -> Optional[str]:
+        return self._load()["previous"].get(alias)
+
+    def _swap_locked(self, data: Dict[str, Dict[str, str]], alias: str, physical: str) -> str:
+        old = data["aliases"].get(alias, alias)
+        new_data = {"aliases": {**data["aliases"], alias: physical}, "previous": {**data["previous"], alias: old}}
+        self._save(new_data)
+        logger.info(f"集合别名 {alias}: {old} -> {physical}")
+        return old
+
+    def swap(self, alias: str, physical: str) -> str:
+        """把别名指向新的物理集合，返回切换前的物理集合名"""
+        with self._lock, _file_lock(self.lock_path):
+            return self._swap_locked(self._load(force=True), alias, physical)
+
+    def rollback(self, alias: str) -> str:
+        """切回上一次的物理集合"""
+        with self._lock, _file_lock(self.lock_path):
+            data = self._load(force=True)
+            previous = data["previous"].get(alias)
+            if previous is None:
+                raise ValueError(f"别名 {alias} 没有可回滚的集合")
+            return self._swap_locked(data, alias, previous)
+
+
+_registry: Optional[AliasRegistry] = None
+
+
+def get_alias_registry() -> AliasRegistry:
+    global _registry
+    if _registry is None:
+        _registry = AliasRegistry()
+    return _registry
+
+
+def resolve_alias(name: str) -> str:
+    return get_alias_registry().resolve(name)
+
+
+@dataclass
+class RebuildReport:
+    alias: str
+    old_collection: str
+    new_collection: str
+    chunks: int
+    sample_recall: float
+    elapsed_s: float
+    swapped: bool
+
+
+def iter_collection_documents(collection, batch_size: int = 500) -> Iterator[Document]:
+    """分页读出集合中的块，保留原 id 与 metadata（相邻块指针、token 数等都不需要重算）"""
+    offset = 0
+    while True:
+        got = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+        if not got["ids"]:
+            return
+        for doc_id, text, meta in zip(got["ids"], got["documents"], got["metadatas"]):
+            yield Document(id=doc_id, page_content=text, metadata=dict(meta or {}))
+        offset += len(got["ids"])
+
+
+def iter_file_documents(path: str, mode: Optional[str] = "recursive", chunk_size: int = 200,
+                        chunk_overlap: int = 20) -> Iterator[Document]:
+    """从源文件重新加载并切分（分块策略变化时使用）"""
+    from agent.rag.loader import DocumentLoader, get_files_in_folder
+    from agent.rag.spliter import TextSplitter
+
+    base = Path(path)
+    base, files = (base, get_files_in_folder(str(base))[0]) if base.is_dir() else (base.parent, [base.name])
+    loader = DocumentLoader(str(base))
+    splitter = TextSplitter(mode=mode, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    for file in files:
+        yield from splitter.split_documents(list(loader.lazy_load_file(file)))
+
+
+def _sanitize(meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: (value if isinstance(value, (str, int, float, bool)) else str(value))
+            for key, value in meta.items() if value is not None}
+
+
+def write_collection(collection, documents: Iterable[Document], embedding_model, batch_size: int = 64,
+                     concurrency: int = 4, normalize: bool = True) -> int:
+    """
+    并发嵌入、顺序写入：最多 concurrency 个批次同时在嵌入，写入按批次顺序在当前线程执行，
+    在途批次数有上限，内存占用与语料大小无关；集合存放截断向量时全维向量另存
+    """
+    pending: deque = deque()
+    written = 0
+    matryoshka = open_matryoshka(collection, collection.name, candidates=1)
+
+    def embed(texts: List[str]):
+        embeddings = embedding_model.embed_documents(texts)
+        return normalize_embeddings(embeddings) if normalize else embeddings
+
+    def flush_one() -> None:
+        nonlocal written
+        batch, future = pending.popleft()
+        ids = [doc.id for doc in batch]
+        embeddings = future.result() if matryoshka is None else matryoshka.add(ids, future.result())
+        collection.add(ids=ids, embeddings=embeddings,
+                       documents=[doc.page_content for doc in batch],
+                       metadatas=[_sanitize(doc.metadata or {}) for doc in batch])
+        written += len(batch)
+        logger.info(f"重建：已写入 {written} 个文档块")
+
+    batch: List[Document] = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for doc in ChunkAnnotator()(documents):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                pending.append((batch, executor.submit(embed, [d.page_content for d in batch])))
+                batch = []
+                if len(pending) >= concurrency * 2:
+                    flush_one()
+        if batch:
+            pending.append((batch, executor.submit(embed, [d.page_content for d in batch])))
+        while pending:
+            flush_one()
+    return written
+
+
+def sample_recall(collection, embedding_model, sample_size: int = 20, k: int = 5, seed: int = 0,
+                  normalize: bool = True) -> float:
+    """抽样自召回率：用抽到的块的原文做查询，块本身出现在前 k 条中的比例（截断向量的集合按线上方式召回并重打分）"""
+    total = collection.count()
+    if total == 0:
+        return 0.0
+    rng = random.Random(seed)
+    offsets = rng.sample(range(total), min(sample_size, total))
+    ids, texts = [], []
+    for offset in offsets:
+        got = collection.get(include=["documents"], limit=1, offset=offset)
+        ids.append(got["ids"][0])
+        texts.append(got["documents"][0])
+    embeddings = embedding_model.embed_documents(texts)
+    if normalize:
+        embeddings = normalize_embeddings(embeddings)
+    matryoshka = open_matryoshka(collection, collection.name, load_rag_matryoshka().candidates)
+    result = dense_query(collection, matryoshka, embeddings, min(k, total), [])
+    hits = sum(1 for doc_id, found in zip(ids, result["ids"]) if doc_id in found)
+    return hits / len(ids)
+
+
+def rebuild_collection(
+        alias: str,
+        embedding_model,
+        documents: Optional[Iterable[Document]] = None,
+        batch_size: int = 64,
+        concurrency: int = 4,
+        sample_size: int = 20,
+        min_recall: float = 0.9,
+        collection_metadata: Optional[Dict[str, Any]] = None,
+        swap: bool = True,
+        registry: Optional[AliasRegistry] = None,
+) -> RebuildReport:
+    """
+    蓝绿重建：把数据写入新的物理集合，校验通过后切换别名
+    :param documents: 要写入的块，None 时从别名当前指向的集合读出并重新嵌入（块数必须一致）
+    :param min_recall: 抽样自召回率的下限，低于该值视为嵌入异常，不切换
+    :param collection_metadata: 新集合的 metadata，None 时使用 [rag.vector] 的距离空间、[rag.hnsw] 的索引参数与
+        [rag.matryoshka] 的截断维度（换距离空间、调整 HNSW 参数、改存截断向量也走重建）
+    :param swap: False 时只构建与校验，不切换别名
+    """
+    registry = registry or get_alias_registry()
+    vector_config = load_rag_vector()
+    if collection_metadata is None:
+        collection_metadata = space_metadata(vector_config.space, load_rag_hnsw(), load_rag_matryoshka().dimensions)
+    start = time.perf_counter()
+    old_name = registry.resolve(alias)
+    new_name = f"{alias}__{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}"  # 同一秒内多次重建也不会撞名
+    expected = None
+    if documents is None:
+        old_collection = get_chroma_collection(old_name)
+        expected = old_collection.count()
+        documents = iter_collection_documents(old_collection)
+    new_collection = get_chroma_collection(new_name, metadata=collection_metadata)
+    logger.info(f"开始重建 {alias}: {old_name} -> {new_name}")
+
+    try:
+        written = write_collection(new_collection, documents, embedding_model, batch_size, concurrency,
+                                   vector_config.normalize)
+        count = new_collection.count()
+        if count != written or (expected is not None and count != expected):
+            raise RebuildError(f"块数校验失败: 写入 {written}，新集合 {count}，期望 {expected}")
+        if count == 0:
+            raise RebuildError("新集合为空")
+        recall = sample_recall(new_collection, embedding_model, sample_size, normalize=vector_config.normalize)
+        if recall < min_recall:
+            raise RebuildError(f"抽样自召回率 {recall:.2f} 低于 {min_recall}")
+    except Exception:
+        logger.error(f"重建 {alias} 失败，删除未完成的集合 {new_name}，别名保持 {old_name}")
+        delete_chroma_collection(new_name)
+        full_vectors_path(new_name).unlink(missing_ok=True)
+        raise
+
+    if swap:
+        registry.swap(alias, new_name)
+    return RebuildReport(alias=alias, old_collection=old_name, new_collection=new_name, chunks=count,
+                         sample_recall=recall, elapsed_s=time.perf_counter() - start, swapped=swap)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="向量集合别名与蓝绿重建")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="列出别名与物理集合")
+    rebuild = sub.add_parser("rebuild", help="重建到新集合并切换别名")
+    rebuild.add_argument("--alias", required=True)
+    rebuild.add_argument("--from-files", default=None, help="从源文件重新切分；默认从当前集合重新嵌入")
+    rebuild.add_argument("--mode", default="recursive", help="切分模式（仅 --from-files）")
+    rebuild.add_argument("--chunk-size", type=int, default=200)
+    rebuild.add_argument("--chunk-overlap", type=int, default=20)
+    rebuild.add_argument("--batch-size", type=int, default=64)
+    rebuild.add_argument("--concurrency", type=int, default=4, help="同时进行的嵌入批次数")
+    rebuild.add_argument("--sample-size", type=int, default=20)
+    rebuild.add_argument("--min-recall", type=float, default=0.9)
+    rebuild.add_argument("--no-swap", action="store_true", help="只构建与校验，不切换别名")
+    rebuild.add_argument("--embedding-url", default=None, help="新的嵌入服务地址，默认使用配置中的嵌入模型")
+    rebuild.add_argument("--api-key", default=None)
+    rollback = sub.add_parser("rollback", help="别名切回上一次的集合")
+    rollback.add_argument("--alias", required=True)
+    args = parser.parse_args(argv)
+
+    registry = get_alias_registry()
+    if args.command == "list":
+        physical = {c.name for c in get_chroma_client().list_collections()}
+        for alias, name in registry.aliases().items():
+            print(f"{alias} -> {name}（上一次: {registry.previous(alias)}）")
+        print("物理集合:", ", ".join(sorted(physical)))
+    elif args.command == "rollback":
+        replaced = registry.rollback(args.alias)
+        print(f"{args.alias} 已从 {replaced} 切回 {registry.resolve(args.alias)}")
+    else:
+        if args.embedding_url:
+            from agent.model import EmbeddingModel
+            embedder = EmbeddingModel(api_url=args.embedding_url, api_key=args.api_key, request_interval=0)
+        else:
+            from agent.rag.instance import embedder
+        documents = iter_file_documents(args.from_files, args.mode, args.chunk_size, args.chunk_overlap) \
+            if args.from_files else None
+        report = rebuild_collection(args.alias, embedder, documents, args.batch_size, args.concurrency,
+                                    args.sample_size, args.min_recall, swap=not args.no_swap)
+        print(json.dumps(asdict(report), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+离线检索评测：
+    python -m agent.rag.benchmark --queries queries.jsonl --configs vector,hybrid,hybrid_rerank --k 1,5,10
+
+标注集为 JSONL，每行一个问题，相关内容用来源文件名或 chunk id 标注（二选一即可）：
+    {"id": "q1", "question": "懒羊羊的道具是什么", "sources": ["test.md"], "chunk_ids": []}
+- 标注了 chunk_ids 时按 chunk 判定相关，否则按来源文件（basename）判定
+- 指标：recall@k、MRR、nDCG@k（二值相关度，同一个相关单元只计一次）
+- 耗时：每个阶段（embed / dense / bm25 / keyword / fusion / fetch / rerank）以及整体的 p50/p95/p99
+- hybrid_budget 走 RagEngine.retrieve 的延迟预算路径，报告中 paths 统计重排序实际走的路径（完成/跳过/超时退回）
+
+嵌入和重排序服务通过 --embedding-url / --rerank-url 指向本地替身服务即可完全离线运行，
+--corpus 可以先把语料导入一个评测专用的集合，避免污染线上集合。
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from agent.config.log import logger
+from agent.rag.RagEngine import RagEngine, AsyncRagEngine
+from agent.rag.timing import StageTimer
+
+CONFIGS = ("vector", "hybrid", "hybrid_rerank", "hybrid_budget")
+PERCENTILES = (50, 95, 99)
+
+
+@dataclass
+class LabeledQuery:
+    """一条标注好的评测问题"""
+    qid: str
+    question: str
+    sources: List[str] = field(default_factory=list)
+    chunk_ids: List[str] = field(default_factory=list)
+
+    @property
+    def relevant(self) -> set:
+        """相关单元：优先使用 chunk id，否则使用来源文件名"""
+        if self.chunk_ids:
+            return set(self.chunk_ids)
+        return {os.path.basename(src) for src in self.sources}
+
+    def unit_of(self, metadata: Dict[str, Any]) -> str:
+        """把一条检索结果映射为与标注同粒度的单元"""
+        if self.chunk_ids:
+            return metadata.get("chroma_id", "")
+        return os.path.basename(metadata.get("source", ""))
+
+
+def load_query_set(path: str) -> List[LabeledQuery]:
+    """读取 JSONL 标注集，跳过空行与没有标注的问题"""
+    queries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            query = LabeledQuery(
+                qid=str(item.get("id", line_no)),
+                question=item["question"],
+                sources=list(item.get("sources", [])),
+                chunk_ids=list(item.get("chunk_ids", [])),
+            )
+            if not query.relevant:
+                logger.warning(f"评测问题 {query.qid} 没有标注相关内容，已跳过")
+                continue
+            queries.append(query)
+    return queries
+
+
+# ====================== 指标 ======================
+def _hit_flags(units: Sequence[str], relevant: set) -> List[bool]:
+    """每个位置是否命中一个“尚未命中过”的相关单元（同一个文件的多个 chunk 只算一次）"""
+    seen = set()
+    flags = []
+    for unit in units:
+        hit = unit in relevant and unit not in seen
+        if hit:
+            seen.add(unit)
+        flags.append(hit)
+    return flags
+
+
+def recall_at_k(units: Sequence[str], relevant: set, k: int) -> float:
+    if not relevant:
+        return 0.0
+    return sum(_hit_flags(units[:k], relevant)) / len(relevant)
+
+
+def reciprocal_rank(units: Sequence[str], relevant: set) -> float:
+    for rank, unit in enumerate(units, 1):
+        if unit in relevant:
+            return 1.0 / rank
+    return 0.0
+
+
+def ndcg_at_k(units: Sequence[str], relevant: set, k: int) -> float:
+    dcg = sum(1.0 / math.log2(rank + 1) for rank, hit in enumerate(_hit_flags(units[:k], relevant), 1) if hit)
+    ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def _latency_summary(samples: Sequence[float]) -> Dict[str, float]:
+    values = np.asarray(samples, dtype=np.float64)
+    summary = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+    summary["mean"] = round(float(values.mean()), 2)
+    summary["count"] = int(values.size)
+    return summary
+
+
+@dataclass
+class QueryResult:
+    query: LabeledQuery
+    units: List[str]
+    stages: Dict[str, float]
+    total_ms: float
+    error: Optional[str] = None
+    paths: Dict[str, str] = field(default_factory=dict)
+
+
+def summarize(results: Sequence[QueryResult], ks: Sequence[int]) -> Dict[str, Any]:
+    """汇总一个配置下所有问题的指标与各阶段耗时分位数（出错的问题计入 errors，不参与指标）"""
+    ok = [r for r in results if r.error is None]
+    metrics: Dict[str, float] = {}
+    if ok:
+        for k in ks:
+            metrics[f"recall@{k}"] = round(float(np.mean([recall_at_k(r.units, r.query.relevant, k) for r in ok])), 4)
+            metrics[f"ndcg@{k}"] = round(float(np.mean([ndcg_at_k(r.units, r.query.relevant, k) for r in ok])), 4)
+        metrics["mrr"] = round(float(np.mean([reciprocal_rank(r.units, r.query.relevant) for r in ok])), 4)
+
+    stage_samples: Dict[str, List[float]] = {}
+    for r in ok:
+        for name, elapsed in r.stages.items():
+            stage_samples.setdefault(name, []).append(elapsed)
+    latency = {name: _latency_summary(samples) for name, samples in sorted(stage_samples.items())}
+    if ok:
+        latency["total"] = _latency_summary([r.total_ms for r in ok])
+    paths: Dict[str, Dict[str, int]] = {}
+    for r in ok:
+        for name, path in r.paths.items():
+            counter = paths.setdefault(name, {})
+            counter[path] = counter.get(path, 0) + 1
+    return {"queries": len(results), "errors": len(results) - len(ok), "metrics": metrics, "latency": latency,
+            "paths": paths}
+
+
+# ====================== 执行 ======================
+def _rerank_order(results: List[Tuple[str, dict]], rerank_result: dict) -> List[Tuple[str, dict]]:
+    return [results[item["index"]] for item in rerank_result.get("results", [])]
+
+
+def retrieve(engine: RagEngine, config: str, question: str, top_k: int, alpha: Optional[float]) -> List[Tuple[str, dict]]:
+    """按评测配置走一遍引擎的检索路径，返回 (文档内容, 元数据)"""
+    if config == "vector":
+        return engine.query_embedded_store(question, top_k=top_k)
+    if config == "hybrid_budget":
+        return engine.retrieve(question, top_k=top_k, use_hybrid=True, alpha=alpha, rerank_top_n=top_k).results
+    results = engine.query_hybrid_search(question, top_k=top_k, alpha=alpha)
+    if config == "hybrid_rerank" and results:
+        rerank_result = engine.rerank(question, [doc for doc, _ in results], top_n=len(results))
+        results = _rerank_order(results, rerank_result)
+    return results
+
+
+async def aretrieve(engine: AsyncRagEngine, config: str, question: str, top_k: int,
+                    alpha: Optional[float]) -> List[Tuple[str, dict]]:
+    """异步版 retrieve"""
+    if config == "vector":
+        return await engine.query_embedded_store(question, top_k=top_k)
+    if config == "hybrid_budget":
+        return (await engine.retrieve(question, top_k=top_k, use_hybrid=True, alpha=alpha, rerank_top_n=top_k)).results
+    results = await engine.query_hybrid_search(question, top_k=top_k, alpha=alpha)
+    if config == "hybrid_rerank" and results:
+        rerank_result = await engine.rerank(question, [doc for doc, _ in results], top_n=len(results))
+        results = _rerank_order(results, rerank_result)
+    return results
+
+
+def run_benchmark(
+        engine: RagEngine,
+        queries: Sequence[LabeledQuery],
+        configs: Sequence[str] = CONFIGS,
+        ks: Sequence[int] = (1, 5, 10),
+        alpha: Optional[float] = None,
+        warmup: int = 2,
+) -> Dict[str, Any]:
+    """
+    同步评测：逐个问题顺序执行，耗时不受并发干扰
+    :param alpha: 混合检索 dense 权重，None 时使用集合的融合配置
+    :param warmup: 每个配置正式计时前的预热问题数（不计入结果）
+    """
+    top_k = max(ks)
+    if any(config != "vector" for config in configs):
+        engine.build_bm25_index()  # 索引构建不计入查询耗时
+    report = {}
+    for config in configs:
+        for query in queries[:warmup]:
+            retrieve(engine, config, query.question, top_k, alpha)
+        results = []
+        for query in queries:
+            results.append(_timed(lambda: retrieve(engine, config, query.question, top_k, alpha), query))
+        report[config] = summarize(results, ks)
+        logger.info(f"评测配置 {config} 完成: {report[config]['metrics']}")
+    return report
+
+
+def _timed(call, query: LabeledQuery) -> QueryResult:
+    with StageTimer() as timer:
+        try:
+            hits = call()
+            error = None
+        except Exception as e:
+            hits, error = [], str(e)
+            logger.error(f"评测问题 {query.qid} 执行失败: {e}")
+    return QueryResult(query, [query.unit_of(meta) for _, meta in hits], timer.stages, timer.total_ms, error,
+                       timer.paths)
+
+
+async def run_benchmark_async(
+        engine: AsyncRagEngine,
+        queries: Sequence[LabeledQuery],
+        configs: Sequence[str] = CONFIGS,
+        ks: Sequence[int] = (1, 5, 10),
+        alpha: Optional[float] = None,
+        warmup: int = 2,
+        concurrency: int = 8,
+) -> Dict[str, Any]:
+    """
+    异步评测：同一配置下的问题以 concurrency 并发执行，用于观察并发下的尾延迟
+    """
+    top_k = max(ks)
+    if any(config != "vector" for config in configs):
+        await engine.build_bm25_index_async()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(config: str, query: LabeledQuery) -> QueryResult:
+        async with semaphore:
+            # 每个任务有独立的上下文，计时器互不干扰
+            with StageTimer() as timer:
+                try:
+                    hits = await aretrieve(engine, config, query.question, top_k, alpha)
+                    error = None
+                except Exception as e:
+                    hits, error = [], str(e)
+                    logger.error(f"评测问题 {query.qid} 执行失败: {e}")
+            return QueryResult(query, [query.unit_of(meta) for _, meta in hits], timer.stages, timer.total_ms, error,
+                       timer.paths)
+
+    report = {}
+    for config in configs:
+        for query in queries[:warmup]:
+            await aretrieve(engine, config, query.question, top_k, alpha)
+        results = await asyncio.gather(*(one(config, query) for query in queries))
+        report[config] = summarize(results, ks)
+        logger.info(f"评测配置 {config} 完成: {report[config]['metrics']}")
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """把评测报告渲染为便于在终端对比的文本表格"""
+    lines = []
+    for config, summary in report.items():
+        lines.append(f"== {config}  (queries={summary['queries']}, errors={summary['errors']})")
+        lines.append("  " + "  ".join(f"{name}={value:.4f}" for name, value in summary["metrics"].items()))
+        for name, lat in summary["latency"].items():
+            lines.append(f"  {name:<8} p50={lat['p50']:>8.2f}ms  p95={lat['p95']:>8.2f}ms  "
+                         f"p99={lat['p99']:>8.2f}ms  n={lat['count']}")
+        for name, counter in summary.get("paths", {}).items():
+            lines.append(f"  path.{name}: " + ", ".join(f"{path}={count}" for path, count in counter.items()))
+    return "\n".join(lines)
+
+
+# ====================== 命令行 ======================
+def ingest_corpus(engine: RagEngine, corpus: str, chunk_size: int, chunk_overlap: int) -> int:
+    """把语料目录（或单个文件）切分后写入评测集合，集合非空时跳过"""
+    from agent.rag.loader import DocumentLoader, get_files_in_folder
+    from agent.rag.spliter import TextSplitter
+
+    if engine.collection.count() > 0:
+        logger.info(f"集合 {engine.collection_name} 已有 {engine.collection.count()} 个文档块，跳过导入")
+        return 0
+    path = Path(corpus)
+    base, files = (path, get_files_in_folder(str(path))[0]) if path.is_dir() else (path.parent, [path.name])
+    loader = DocumentLoader(str(base))
+    splitter = TextSplitter(mode="recursive", chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    total = 0
+    for file in files:
+        try:
+            total += engine.embed_stream(loader.lazy_load_file(file), splitter=splitter)
+        except Exception as e:
+            logger.warning(f"导入评测语料 {file} 失败，已跳过: {e}")
+    return total
+
+
+def _override_models(engine, args, is_async: bool) -> None:
+    """把引擎的嵌入/重排序模型指向指定的（本地替身）服务"""
+    from agent.model import EmbeddingModel, EmbeddingModelAsync, RerankModel, RerankModelAsync
+    if args.embedding_url:
+        cls = EmbeddingModelAsync if is_async else EmbeddingModel
+        engine.embedding_model = cls(api_url=args.embedding_url, api_key=args.api_key, request_interval=0)
+    if args.rerank_url:
+        cls = RerankModelAsync if is_async else RerankModel
+        engine.reranker = cls(api_url=args.rerank_url, api_key=args.api_key)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="RAG 离线检索评测（召回质量与分阶段耗时）")
+    parser.add_argument("--queries", required=True, help="JSONL 标注集路径")
+    parser.add_argument("--collection", default="rag_benchmark", help="评测使用的集合名")
+    parser.add_argument("--corpus", default=None, help="语料目录或文件，集合为空时先导入")
+    parser.add_argument("--configs", default=",".join(CONFIGS), help=f"评测配置，逗号分隔，可选 {CONFIGS}")
+    parser.add_argument("--k", default="1,5,10", help="recall/nDCG 的 k，逗号分隔，检索数量取最大值")
+    parser.add_argument("--alpha", type=float, default=None, help="混合检索 dense 权重，默认使用集合配置")
+    parser.add_argument("--warmup", type=int, default=2, help="每个配置的预热问题数")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="使用 AsyncRagEngine 并发评测")
+    parser.add_argument("--concurrency", type=int, default=8, help="异步评测的并发数")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--chunk-overlap", type=int, default=20)
+    parser.add_argument("--embedding-url", default=None, help="嵌入服务地址，如本地替身 http://127.0.0.1:9000/v1/embeddings")
+    parser.add_argument("--rerank-url", default=None, help="重排序服务地址")
+    parser.add_argument("--api-key", default="EMPTY", help="替身服务使用的 API Key")
+    parser.add_argument("--output", default=None, help="把 JSON 报告写入文件")
+    args = parser.parse_args(argv)
+
+    configs = [c.strip() for c in args.configs.split(",") if c.strip()]
+    unknown = set(configs) - set(CONFIGS)
+    if unknown:
+        parser.error(f"未知的评测配置: {sorted(unknown)}")
+    ks = sorted({int(k) for k in args.k.split(",")})
+    queries = load_query_set(args.queries)
+    if not queries:
+        parser.error("标注集中没有可用的问题")
+
+    engine = RagEngine(collection_name=args.collection)
+    _override_models(engine, args, is_async=False)
+    if args.corpus:
+        ingest_corpus(engine, args.corpus, args.chunk_size, args.chunk_overlap)
+
+    if args.use_async:
+        async_engine = AsyncRagEngine(collection_name=args.collection)
+        _override_models(async_engine, args, is_async=True)
+        report = asyncio.run(run_benchmark_async(async_engine, queries, configs, ks, args.alpha,
+                                                 args.warmup, args.concurrency))
+    else:
+        report = run_benchmark(engine, queries, configs, ks, args.alpha, args.warmup)
+
+    print(format_report(report))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from agent.rag.timing import mark_path
+
+# rerank 阶段可能走的路径
+RERANK_DISABLED = "disabled"              # 调用方关闭了重排序或没有配置重排序模型
+RERANK_USED = "reranked"                  # 重排序在截止时间内完成
+RERANK_SKIPPED_MARGIN = "skipped_margin"  # 融合分数已经足够区分前 n 名，不需要重排序
+RERANK_SKIPPED_BUDGET = "skipped_budget"  # 召回阶段已用掉大部分预算，剩余时间不够重排序
+RERANK_TIMEOUT = "timeout_fallback"       # 重排序超时，退回融合顺序
+RERANK_ERROR = "error_fallback"           # 重排序失败，退回融合顺序
+
+
+class LatencyBudget:
+    """单次检索请求的延迟预算，total_ms 为 None 或 <=0 时表示不限时"""
+
+    def __init__(self, total_ms: Optional[float]):
+        self.total_ms = total_ms if total_ms and total_ms > 0 else None
+        self._start = time.perf_counter()
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self._start) * 1000
+
+    def remaining_ms(self) -> Optional[float]:
+        """剩余预算（毫秒），不限时返回 None"""
+        if self.total_ms is None:
+            return None
+        return max(0.0, self.total_ms - self.elapsed_ms())
+
+    def remaining_s(self) -> Optional[float]:
+        remaining = self.remaining_ms()
+        return None if remaining is None else remaining / 1000
+
+
+@dataclass
+class RetrievalOutcome:
+    """
+    带预算检索的结果：
+    - results 为最终保留的 (文档内容, 元数据)，按相关度排序；最多 rerank_top_n 条，关闭重排序时为全部召回结果
+    - scores 与 results 对齐：走了重排序时为重排序分数，否则为召回/融合分数
+    - path 记录每个阶段实际走的路径，如 {"retrieve": "hybrid", "rerank": "skipped_margin"}
+    """
+    results: List[Tuple[str, Dict[str, Any]]] = field(default_factory=list)
+    scores: List[float] = field(default_factory=list)
+    path: Dict[str, str] = field(default_factory=dict)
+    elapsed_ms: float = 0.0
+
+    @property
+    def reranked(self) -> bool:
+        return self.path.get("rerank") == RERANK_USED
+
+    def mark(self, stage_name: str, path: str) -> None:
+        self.path[stage_name] = path
+        mark_path(stage_name, path)
+
+
+def is_decisive(scores: Sequence[float], top_n: int, margin: float) -> bool:
+    """
+    判断召回/融合分数是否已经能确定前 top_n 名：
+    第 top_n 名与第 top_n+1 名之间的分差占整体分数跨度的比例不小于 margin 时，
+    重排序基本不会改变进入上下文的文档集合，可以跳过。margin <= 0 表示从不跳过
+    """
+    if margin <= 0 or top_n <= 0 or len(scores) <= top_n:
+        return False
+    spread = scores[0] - scores[-1]
+    if spread <= 0:
+        return False
+    return (scores[top_n - 1] - scores[top_n]) / spread >= margin
+
+
+def rerank_plan(outcome: RetrievalOutcome, use_rerank: bool, has_reranker: bool, budget: LatencyBudget,
+                rerank_top_n: int, decisive_margin: float, rerank_min_ms: float) -> bool:
+    """决定是否执行重排序；因分差或预算跳过时记录原因并把结果截到 rerank_top_n"""
+    if not use_rerank or not has_reranker:
+        outcome.mark("rerank", RERANK_DISABLED)  # 关闭重排序时保留全部召回结果
+        return False
+    if is_decisive(outcome.scores, rerank_top_n, decisive_margin):
+        skip = RERANK_SKIPPED_MARGIN
+    elif budget.remaining_ms() is not None and budget.remaining_ms() < rerank_min_ms:
+        skip = RERANK_SKIPPED_BUDGET
+    else:
+        return True
+    fallback(outcome, skip, rerank_top_n)
+    return False
+
+
+def fallback(outcome: RetrievalOutcome, path: str, rerank_top_n: int) -> None:
+    """不使用重排序结果：保留召回/融合顺序的前 rerank_top_n 条"""
+    outcome.results = outcome.results[:rerank_top_n]
+    outcome.scores = outcome.scores[:rerank_top_n]
+    outcome.mark("rerank", path)
+
+
+def apply_rerank(outcome: RetrievalOutcome, rerank_result: dict) -> None:
+    """按重排序返回的 index 重排候选，分数换成重排序分数"""
+    items = rerank_result.get("results", [])
+    outcome.results = [outcome.results[item["index"]] for item in items]
+    outcome.scores = [float(item["relevance_score"]) for item in items]
+    outcome.mark("rerank", RERANK_USED)
@@ -1,22 +1,89 @@
+import os
+import threading
+import time
 import chromadb
+import httpx
+from chromadb.config import Settings
 from agent.config import DB_PATH,COLLECTION_NAME,logger
+from agent.config.config import load_chroma_config, ChromaConfig
 
 # 全局变量-这里用于数据库的测试使用
 _chroma_client = None
-_chroma_collection = None
+_chroma_collections: dict = {} # 按集合名缓存，不同集合的引擎互不覆盖
+_chroma_config: ChromaConfig = None
+_client_pid = None # 创建客户端的进程，fork 出的子进程不能复用父进程的连接池
+_client_lock = threading.Lock()
 
-def get_chroma_client(db_path:str = DB_PATH) -> chromadb.PersistentClient:
-    global _chroma_client
-    if _chroma_client is None:
-        _chroma_client = chromadb.PersistentClient(path=db_path)
+
+class RetryingCollection:
+    """
+    http 模式下包装 Collection：连接失败、超时等传输层错误按指数退避重试，其它属性与方法直接透传。
+    add 重试时 Chroma 会忽略已写入的 id，其余操作本身是幂等的
+    """
+    _RETRIED = frozenset({"add", "upsert", "update", "delete", "get", "query", "count", "peek"})
+
+    def __init__(self, collection, retries: int, backoff_s: float):
+        self._collection = collection
+        self._retries = retries
+        self._backoff_s = backoff_s
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in self._RETRIED:
+            return attr
+        def call(*args, **kwargs):
+            for attempt in range(self._retries + 1):
+                try:
+                    return attr(*args, **kwargs)
+                except httpx.TransportError as e:
+                    if attempt >= self._retries:
+                        raise
+                    delay = self._backoff_s * (2 ** attempt)
+                    logger.warning(f"Chroma {name} 请求失败({type(e).__name__})，{delay:.2f}s 后第 {attempt + 1} 次重试")
+                    time.sleep(delay)
+        return call
+
+
+def _http_client(config: ChromaConfig):
+    """连接 Chroma 服务的客户端：进程内共用一个 httpx 连接池，设置连接/读写超时"""
+    settings = Settings(anonymized_telemetry=False,
+                        chroma_http_max_connections=config.max_connections,
+                        chroma_http_max_keepalive_connections=config.max_keepalive_connections)
+    client = chromadb.HttpClient(host=config.host, port=config.port, ssl=config.ssl, settings=settings)
+    session = getattr(getattr(client, "_server", None), "_session", None) # chromadb 默认不设超时
+    if isinstance(session, httpx.Client):
+        session.timeout = httpx.Timeout(config.timeout_s, connect=config.connect_timeout_s)
+    return client
+
+def get_chroma_client(db_path:str = DB_PATH):
+    """按 [chroma] 配置返回进程内共享的客户端（persistent 为嵌入式存储，http 连接 Chroma 服务）"""
+    global _chroma_client, _chroma_config, _client_pid
+    if _chroma_client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _chroma_client is None or _client_pid != os.getpid():
+                _chroma_config = load_chroma_config()
+                _chroma_collections.clear()
+                if _chroma_config.mode == "http":
+                    _chroma_client = _http_client(_chroma_config)
+                    logger.info(f"连接 Chroma 服务 {_chroma_config.host}:{_chroma_config.port}")
+                else:
+                    _chroma_client = chromadb.PersistentClient(path=db_path)
+                _client_pid = os.getpid()
     return _chroma_client
 
-def get_chroma_collection(collection_name:str = COLLECTION_NAME):
-    global _chroma_collection
-    if _chroma_collection is None:
-        client = get_chroma_client()
-        _chroma_collection = client.get_or_create_collection(collection_name)
-    return _chroma_collection
+def get_chroma_collection(collection_name:str = COLLECTION_NAME, metadata: dict = None):
+    """metadata 只在集合首次创建时生效（如 {"hnsw:space": "cosine"}）；同一进程内所有引擎共用同一个集合句柄"""
+    client = get_chroma_client()
+    collection = _chroma_collections.get(collection_name)
+    if collection is None:
+        with _client_lock:
+            collection = _chroma_collections.get(collection_name)
+            if collection is None:
+                collection = client.get_or_create_collection(collection_name, metadata=metadata)
+                if _chroma_config.mode == "http":
+                    collection = RetryingCollection(collection, _chroma_config.retries, _chroma_config.retry_backoff_s)
+                _chroma_collections[collection_name] = collection
+    return collection
 def delete_chroma_collection(collection_name: str, db_path: str=DB_PATH) -> bool:
     """删除指定的集合"""
     try:
@@ -25,6 +92,7 @@ def delete_chroma_collection(collection_name: str, db_path: str=DB_PATH) -> bool
         if collection_name in [col.name for col in client.list_collections()]:
             client.delete_collection(collection_name)
             # 如果删除的是当前缓存的集合，清除缓存
+            _chroma_collections.pop(collection_name, None)
             logger.info(f"成功删除chromadb的表: {collection_name}")
             return True
         else:
@@ -36,7 +104,7 @@ def delete_chroma_collection(collection_name: str, db_path: str=DB_PATH) -> bool
 
 
 def close_chroma():
-    global _chroma_client, _chroma_collection
+    global _chroma_client
     if _chroma_client is not None:
         try:
             if hasattr(_chroma_client, 'close'):
@@ -45,7 +113,7 @@ def close_chroma():
             print(f"Error closing ChromaDB client: {e}")
         finally:
             _chroma_client = None
-            _chroma_collection = None
+            _chroma_collections.clear()
 
 def get_all_docs():
     collection = get_chroma_collection()
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import re
+import zlib
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import jieba
+import numpy as np
+from langchain_core.documents import Document
+
+from agent.config.config import RagDedupeConfig
+from agent.rag.indexer import preload_jieba
+
+_MERSENNE = np.uint64((1 << 31) - 1)  # 排列哈希取模的素数，a * h 不会超出 uint64
+_WHITESPACE_RE = re.compile(r"\s+")
+SOURCES_KEY = "sources"  # 合并块的全部来源（JSON 列表）
+COUNT_KEY = "duplicate_sources"  # 合并块的来源数，按来源删除时据此找出合并块
+
+
+@dataclass
+class DedupeStats:
+    seen: int = 0
+    exact: int = 0  # 与已保留块正文完全相同（忽略空白）
+    near: int = 0  # MinHash 估计的 Jaccard 相似度不低于阈值
+
+    @property
+    def dropped(self) -> int:
+        return self.exact + self.near
+
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def shingle_hashes(text: str, size: int) -> np.ndarray:
+    """
+    jieba 精确模式分词（关闭 HMM 新词发现，速度约快 2.5 倍，对去重判定影响可以忽略）后按 size 个词组成 shingle，
+    每个 shingle 用 crc32 映射为 32 位整数（至少返回一个）
+    """
+    words = [word for word in jieba.cut(normalize_text(text), HMM=False) if word.strip()]
+    if len(words) <= size:
+        shingles = {"\x1f".join(words)}
+    else:
+        shingles = {"\x1f".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+
+
+def minhash_signatures(hashes: Sequence[np.ndarray], a: np.ndarray, b: np.ndarray, step: int = 16) -> np.ndarray:
+    """
+    整批计算 MinHash 签名：所有块的 shingle 哈希拼成一个向量，每次对 step 个排列做 (a*h + b) mod p，
+    再用 minimum.reduceat 按块的偏移取最小值，返回 (块数, 排列数) 的 uint32 矩阵
+    """
+    lengths = np.fromiter((len(h) for h in hashes), dtype=np.int64, count=len(hashes))
+    flat = np.concatenate(hashes)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    signatures = np.empty((len(hashes), len(a)), dtype=np.uint32)
+    for start in range(0, len(a), step):
+        permuted = (a[start:start + step, None] * flat[None, :] + b[start:start + step, None]) % _MERSENNE
+        signatures[:, start:start + step] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+
+class Deduplicator:
+    """
+    入库前的块去重，整个流式入库过程共用一个实例，跨来源判重：
+    - 完全重复：忽略空白后正文的哈希相同
+    - 近似重复：jieba 词 shingle 的 MinHash 签名分 bands 段做 LSH，同桶候选再按签名一致比例估计 Jaccard，
+      不低于 threshold 视为重复
+    重复块不再嵌入、写入，其它来源并入保留块：入库结束后由 merge_duplicate_sources 一次性写回保留块的 sources。
+    需要在 ChunkAnnotator 标注之后调用（保留块已有 id），丢弃的块在前后指针中留下空位，保留块的邻接关系与原文一致。
+    只保留每个块的 id 与签名，内存占用与正文大小无关
+    """
+
+    def __init__(self, config: RagDedupeConfig, seed: int = 1):
+        if config.num_perm % config.bands:
+            raise ValueError(f"num_perm({config.num_perm}) 必须是 bands({config.bands}) 的整数倍")
+        preload_jieba()
+        self.config = config
+        self.rows = config.num_perm // config.bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, int(_MERSENNE), size=config.num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, int(_MERSENNE), size=config.num_perm, dtype=np.uint64)
+        self._exact: Dict[str, int] = {}  # 内容哈希 -> 保留块序号
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(config.bands)]
+        self._signatures = np.empty((1024, config.num_perm), dtype=np.uint32)  # 保留块的签名，按需倍增
+        self._sources: List[str] = []  # 保留块的来源
+        self._ids: List[str] = []  # 保留块的 id（ChunkAnnotator 分配）
+        self._extra: Dict[int, List[str]] = {}  # 保留块序号 -> 并入的其它来源
+        self.stats = DedupeStats()
+
+    def _near_duplicate(self, signature: np.ndarray) -> Optional[int]:
+        """同桶候选一次矩阵比较估计 Jaccard，返回达到阈值的最早保留块"""
+        candidates = set()
+        for band, buckets in enumerate(self._buckets):
+            candidates.update(buckets.get(signature[band * self.rows:(band + 1) * self.rows].tobytes(), ()))
+        if not candidates:
+            return None
+        indexes = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similar = indexes[(self._signatures[indexes] == signature).mean(axis=1) >= self.config.threshold]
+        return int(similar.min()) if len(similar) else None
+
+    def _keep(self, doc: Document, signature: np.ndarray) -> int:
+        index = len(self._ids)
+        if index == len(self._signatures):
+            self._signatures = np.concatenate([self._signatures, np.empty_like(self._signatures)])
+        self._signatures[index] = signature
+        for band, buckets in enumerate(self._buckets):
+            buckets.setdefault(signature[band * self.rows:(band + 1) * self.rows].tobytes(), []).append(index)
+        self._sources.append(_source(doc))
+        self._ids.append(doc.id)
+        return index
+
+    def _merge(self, index: int, doc: Document) -> None:
+        source = _source(doc)
+        extra = self._extra.setdefault(index, [])
+        if source and source != self._sources[index] and source not in extra:
+            extra.append(source)
+
+    def filter(self, docs: Sequence[Document]) -> List[Document]:
+        """返回需要入库的块（保持原顺序），重复块的来源记到保留块上"""
+        if not docs:
+            return []
+        signatures = minhash_signatures([shingle_hashes(doc.page_content, self.config.shingle_size) for doc in docs],
+                                        self._a, self._b)
+        kept = []
+        for doc, signature in zip(docs, signatures):
+            self.stats.seen += 1
+            digest = content_hash(doc.page_content)
+            index = self._exact.get(digest)
+            if index is not None:
+                self.stats.exact += 1
+                self._merge(index, doc)
+                continue
+            index = self._near_duplicate(signature)
+            if index is not None:
+                self.stats.near += 1
+                self._merge(index, doc)
+                continue
+            self._exact[digest] = self._keep(doc, signature)
+            kept.append(doc)
+        return kept
+
+    def merged_sources(self) -> Dict[str, List[str]]:
+        """保留块 id -> 全部来源（自身来源在前），只包含并入过其它来源的块"""
+        return {self._ids[index]: [self._sources[index]] + extra for index, extra in self._extra.items() if extra}
+
+
+def _source(doc: Document) -> str:
+    return str((doc.metadata or {}).get("source", ""))
+
+
+def chunk_sources(meta: Optional[Dict[str, Any]]) -> List[str]:
+    """块列出的全部来源：合并过的块读 sources，其余块只有自身的 source"""
+    meta = meta or {}
+    if meta.get(SOURCES_KEY):
+        return json.loads(meta[SOURCES_KEY])
+    return [str(meta.get("source", ""))]
+
+
+def _merged_chunks(collection, batch_size: int = 500) -> Tuple[List[str], List[Dict[str, Any]]]:
+    """分页取出所有并入过其它来源的块（duplicate_sources >= 2）的 id 与 metadata"""
+    ids, metadatas = [], []
+    offset = 0
+    while True:
+        got = collection.get(where={COUNT_KEY: {"$gte": 2}}, include=["metadatas"], limit=batch_size, offset=offset)
+        ids.extend(got["ids"])
+        metadatas.extend(got["metadatas"])
+        if len(got["ids"]) < batch_size:
+            return ids, metadatas
+        offset += batch_size
+
+
+def _write_sources(meta: Dict[str, Any], sources: List[str]) -> Dict[str, Any]:
+    meta = dict(meta or {})
+    meta[SOURCES_KEY] = json.dumps(sources, ensure_ascii=False)
+    meta[COUNT_KEY] = len(sources)
+    return meta
+
+
+def merge_duplicate_sources(collection, deduplicator: Deduplicator, batch_size: int = 500) -> int:
+    """
+    把并入的来源写回保留块的 metadata：sources 为全部来源（JSON 列表，自身来源在前），duplicate_sources 为来源数。
+    保留块此前已经并入过来源（例如刷新其中一个来源）时在原列表上追加
+    """
+    merged = deduplicator.merged_sources()
+    ids = list(merged)
+    for start in range(0, len(ids), batch_size):
+        got = collection.get(ids=ids[start:start + batch_size], include=["metadatas"])
+        metadatas = []
+        for doc_id, meta in zip(got["ids"], got["metadatas"]):
+            sources = chunk_sources(meta)
+            metadatas.append(_write_sources(meta, sources + [s for s in merged[doc_id] if s not in sources]))
+        if got["ids"]:
+            collection.update(ids=got["ids"], metadatas=metadatas)
+    return len(ids)
+
+
+def listed_sources(collection) -> Set[str]:
+    """合并块的 sources 中列出的全部来源；这些来源的内容可能全部存放在其它来源名下的块里"""
+    return {source for meta in _merged_chunks(collection)[1] for source in chunk_sources(meta)}
+
+
+def release_source(collection, source: str, batch_size: int = 500) -> List[str]:
+    """
+    按来源删除之前调用：从合并块的 sources 中去掉该来源；归属该来源（source 字段）且还列有其它来源的块
+    改归列表中的下一个来源，不随该来源删除。之后再按 source 删除的只剩没有其它来源的块。
+    返回接手了块的来源，供刷新文档级质心
+    """
+    ids, metadatas, owners = [], [], set()
+    for doc_id, meta in zip(*_merged_chunks(collection)):
+        sources = chunk_sources(meta)
+        if source not in sources:
+            continue
+        remaining = [s for s in sources if s != source]
+        meta = _write_sources(meta, remaining)
+        if meta.get("source") == source:
+            meta["source"] = remaining[0]
+            owners.add(remaining[0])
+        ids.append(doc_id)
+        metadatas.append(meta)
+    for start in range(0, len(ids), batch_size):
+        collection.update(ids=ids[start:start + batch_size], metadatas=metadatas[start:start + batch_size])
+    return sorted(owners)
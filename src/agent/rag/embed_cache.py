@@ -0,0 +1,68 @@
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from agent.config import DB_PATH
+
+DEFAULT_CACHE_PATH = Path(DB_PATH) / "embedding_cache.sqlite3"
+
+
+class CachedEmbeddings:
+    """
+    嵌入结果的磁盘缓存，包装任意带 embed_documents 的同步嵌入模型：
+    - 键为 命名空间（默认模型名与维度） + 文本 的 sha256，值为 float32 原始向量（归一化仍由引擎按 [rag.vector] 处理）
+    - 一批文本先整体查缓存，未命中的去重后合并为一次 embed_documents 调用
+    调参时不同分块方案切出的相同块、所有方案共用的评测问题都只请求一次嵌入服务，重复运行调参也直接复用
+    """
+
+    def __init__(self, model, path: Optional[str] = None, namespace: Optional[str] = None):
+        self.model = model
+        self.namespace = namespace or f"{getattr(model, 'model_name', type(model).__name__)}:{getattr(model, 'dimensions', '')}"
+        self.path = Path(path) if path else DEFAULT_CACHE_PATH
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.namespace}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: Sequence[str], batch_size: int = 500) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+            found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+        return found
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            found = self._lookup(list(dict.fromkeys(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            vectors = np.asarray(self.model.embed_documents(list(missing.values())), dtype=np.float32)
+            with self._lock, self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                       [(key, vector.tobytes()) for key, vector in zip(missing, vectors)])
+            found.update(zip(missing, vectors))
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
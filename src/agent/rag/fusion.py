@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import functools
+import re
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Sequence, Tuple, Any
+
+import numpy as np
+from agent.config.log import logger
+from agent.rag.timing import stage
+
+# 多路召回共用的线程池：各路检索大多是网络/数据库 IO，线程即可并发
+_RETRIEVER_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rag-retriever")
+
+
+@dataclass
+class RetrieverSpec:
+    """
+    一路召回的描述：
+    - retrieve(question, top_k) 返回按相关度排好序的 chunk id 列表，可以是同步函数也可以是协程函数
+    - weight 为该路在 RRF 中的权重，k 为该路的 RRF 平滑常数
+    - top_k 为该路的召回数量，None 时与融合后的 top_k 相同
+    """
+    name: str
+    retrieve: Callable[[str, int], Any]
+    weight: float = 1.0
+    k: int = 60
+    top_k: Optional[int] = None
+
+
+def weighted_rrf(
+        ranked_lists: Sequence[Sequence[str]],
+        weights: Sequence[float],
+        ks: Sequence[int],
+        top_k: int,
+) -> List[Tuple[str, float]]:
+    """
+    加权 RRF 融合（向量化实现）：score(id) = Σ weight_i / (k_i + rank_i)
+    :param ranked_lists: 每一路召回的有序 id 列表
+    :param weights: 每一路的权重
+    :param ks: 每一路的 RRF 常数
+    :param top_k: 返回数量
+    :return: [(id, 融合分数)]，分数从高到低，同分时按首次出现的顺序
+    """
+    lengths = [len(ids) for ids in ranked_lists]
+    total = sum(lengths)
+    if total == 0 or top_k <= 0:
+        return []
+
+    all_ids = np.empty(total, dtype=object)
+    contributions = np.empty(total, dtype=np.float64)
+    offset = 0
+    for ids, weight, k, length in zip(ranked_lists, weights, ks, lengths):
+        if length == 0:
+            continue
+        all_ids[offset:offset + length] = list(ids)
+        contributions[offset:offset + length] = weight / (k + np.arange(1, length + 1, dtype=np.float64))
+        offset += length
+
+    unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contributions, minlength=len(unique_ids))
+    first_seen = np.full(len(unique_ids), total, dtype=np.int64)
+    np.minimum.at(first_seen, inverse, np.arange(total))
+
+    top_k = min(top_k, len(unique_ids))
+    # 先用 argpartition 取出候选，再只对候选做排序
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(unique_ids) else np.arange(len(unique_ids))
+    order = candidates[np.lexsort((first_seen[candidates], -scores[candidates]))]
+    return [(unique_ids[i], float(scores[i])) for i in order]
+
+
+class FusionEngine:
+    """
+    多路召回融合：并发执行任意数量的召回器（dense / BM25 / 关键词 / 元数据过滤等），
+    再用加权 RRF 合并为一个候选列表。单路失败只记录日志，不影响其它路的结果。
+    """
+
+    def __init__(self, executor: Optional[ThreadPoolExecutor] = None):
+        self.executor = executor or _RETRIEVER_EXECUTOR
+
+    @staticmethod
+    def _active(specs: Sequence[RetrieverSpec]) -> List[RetrieverSpec]:
+        return [spec for spec in specs if spec.weight > 0]
+
+    @staticmethod
+    def _merge(specs: Sequence[RetrieverSpec], results: Sequence[Any], top_k: int) -> List[Tuple[str, float]]:
+        ranked_lists, weights, ks = [], [], []
+        for spec, result in zip(specs, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"召回器 {spec.name} 执行失败，已跳过: {result}")
+                continue
+            ranked_lists.append(list(result or []))
+            weights.append(spec.weight)
+            ks.append(spec.k)
+        with stage("fusion"):
+            return weighted_rrf(ranked_lists, weights, ks, top_k)
+
+    def fuse(self, question: str, specs: Sequence[RetrieverSpec], top_k: int) -> List[Tuple[str, float]]:
+        """同步融合：在线程池中并发执行各路召回"""
+        specs = self._active(specs)
+        # 线程池不会自动传递 ContextVar，这里复制上下文，保证各路召回的阶段耗时能记到当前请求上
+        futures = [self.executor.submit(contextvars.copy_context().run, self._call_sync, spec, question, top_k)
+                   for spec in specs]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return self._merge(specs, results, top_k)
+
+    async def afuse(self, question: str, specs: Sequence[RetrieverSpec], top_k: int) -> List[Tuple[str, float]]:
+        """异步融合：协程召回器直接并发，同步召回器放到线程池执行"""
+        specs = self._active(specs)
+        loop = asyncio.get_running_loop()
+        tasks = []
+        for spec in specs:
+            if inspect.iscoroutinefunction(spec.retrieve):
+                tasks.append(spec.retrieve(question, spec.top_k or top_k))
+            else:
+                call = functools.partial(contextvars.copy_context().run, self._call_sync, spec, question, top_k)
+                tasks.append(loop.run_in_executor(self.executor, call))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return self._merge(specs, results, top_k)
+
+    @staticmethod
+    def _call_sync(spec: RetrieverSpec, question: str, top_k: int) -> List[str]:
+        return spec.retrieve(question, spec.top_k or top_k)
+
+
+# 关键词召回：文件名、引号/书名号内的词、接口名/变量名等需要精确匹配的词
+_FILENAME_RE = re.compile(r"[\w\-]+\.(?:md|txt|pdf|docx|csv|json|html?)\b", re.IGNORECASE)
+_QUOTED_RE = re.compile(r"[\"“'‘《「]([^\"”'’》」]{2,40})[\"”'’》」]")
+_IDENTIFIER_RE = re.compile(r"\b(?:[A-Za-z]+[_.][\w.]+|[a-z]+[A-Z]\w*|[A-Z]{2,}\d*)\b")
+
+
+def extract_keywords(question: str) -> Tuple[List[str], List[str]]:
+    """
+    从问题中提取需要精确匹配的词
+    :return: (文件名列表, 关键词列表)
+    """
+    filenames = list(dict.fromkeys(_FILENAME_RE.findall(question)))
+    keywords = []
+    for term in _QUOTED_RE.findall(question) + _IDENTIFIER_RE.findall(question):
+        term = term.strip()
+        if term and term not in filenames and term not in keywords:
+            keywords.append(term)
+    return filenames, keywords
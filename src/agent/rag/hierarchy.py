@@ -0,0 +1,132 @@
+import hashlib
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from agent.rag.database import get_chroma_collection
+
+DOC_INDEX_SUFFIX = "__docs"  # 文档级索引集合名 = 块集合名 + 后缀
+
+
+def doc_index_name(collection_name: str) -> str:
+    return f"{collection_name}{DOC_INDEX_SUFFIX}"
+
+
+def _source_id(source: str) -> str:
+    return hashlib.md5(source.encode("utf-8")).hexdigest()
+
+
+def _accumulate(sums: Dict[str, np.ndarray], counts: Dict[str, int],
+                metadatas: Sequence[Dict[str, Any]], embeddings: Sequence[Any]) -> None:
+    """按来源累加块向量与块数"""
+    for meta, embedding in zip(metadatas, embeddings):
+        source = str((meta or {}).get("source", ""))
+        vector = np.asarray(embedding, dtype=np.float64)
+        sums[source] = sums[source] + vector if source in sums else vector.copy()
+        counts[source] = counts.get(source, 0) + 1
+
+
+class DocumentIndex:
+    """
+    两级检索的文档级索引：每个来源文件一条记录，向量为该来源所有块向量的均值（质心），
+    metadata 记录 source 与 chunk_count。
+    查询时先在文档级索引中选出最相近的若干来源，再只在这些来源的块中检索（Chroma where 过滤 / BM25 子集打分），
+    检索耗时随来源数而不是块数增长。
+    - 集合使用 cosine 距离，质心不需要归一化，增量入库时可以按块数加权合并
+    - 删除块后按来源重新计算质心
+    """
+
+    def __init__(self, collection_name: str):
+        self.collection = get_chroma_collection(doc_index_name(collection_name), metadata={"hnsw:space": "cosine"})
+        self._lock = threading.Lock()  # 质心的读-改-写需要串行，避免并发入库互相覆盖
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def add(self, metadatas: Sequence[Dict[str, Any]], embeddings: Sequence[Any]) -> None:
+        """把新入库的块并入所属来源的质心"""
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        _accumulate(sums, counts, metadatas, embeddings)
+        if not sums:
+            return
+        with self._lock:
+            ids = [_source_id(source) for source in sums]
+            got = self.collection.get(ids=ids, include=["embeddings", "metadatas"])
+            existing = {doc_id: (np.asarray(emb, dtype=np.float64), int(meta.get("chunk_count", 0)))
+                        for doc_id, emb, meta in zip(got["ids"], got["embeddings"], got["metadatas"])}
+            centroids, metas = [], []
+            for doc_id, source in zip(ids, sums):
+                total, n = sums[source], counts[source]
+                if doc_id in existing:
+                    old_centroid, old_n = existing[doc_id]
+                    total, n = total + old_centroid * old_n, n + old_n
+                centroids.append((total / n).tolist())
+                metas.append({"source": source, "chunk_count": n})
+            self.collection.upsert(ids=ids, embeddings=centroids, metadatas=metas)
+
+    def refresh(self, chunk_collection, sources: Iterable[str]) -> None:
+        """按块集合中剩余的块重新计算这些来源的质心，来源下已没有块时删除记录"""
+        with self._lock:
+            for source in set(sources):
+                got = chunk_collection.get(where={"source": source}, include=["embeddings"])
+                if len(got["ids"]) == 0:
+                    self.collection.delete(ids=[_source_id(source)])
+                    continue
+                centroid = np.asarray(got["embeddings"], dtype=np.float64).mean(axis=0)
+                self.collection.upsert(ids=[_source_id(source)], embeddings=[centroid.tolist()],
+                                       metadatas=[{"source": source, "chunk_count": len(got["ids"])}])
+
+    def rebuild(self, chunk_collection, batch_size: int = 1000) -> int:
+        """从块集合全量重建文档级索引（已有数据首次开启两级检索时使用），返回来源数"""
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        offset = 0
+        while True:
+            got = chunk_collection.get(include=["embeddings", "metadatas"], limit=batch_size, offset=offset)
+            if len(got["ids"]) == 0:
+                break
+            _accumulate(sums, counts, got["metadatas"], got["embeddings"])
+            offset += len(got["ids"])
+        with self._lock:
+            existing = self.collection.get(include=[])["ids"]
+            if existing:
+                self.collection.delete(ids=existing)
+            sources = list(sums)
+            for start in range(0, len(sources), batch_size):
+                batch = sources[start:start + batch_size]
+                self.collection.upsert(
+                    ids=[_source_id(source) for source in batch],
+                    embeddings=[(sums[source] / counts[source]).tolist() for source in batch],
+                    metadatas=[{"source": source, "chunk_count": counts[source]} for source in batch],
+                )
+        logger.info(f"文档级索引重建完成，共 {len(sums)} 个来源、{offset} 个块")
+        return len(sums)
+
+    def select(self, query_embedding: Sequence[float], n_docs: int) -> List[str]:
+        """选出与问题最相近的 n_docs 个来源"""
+        n_docs = min(n_docs, self.count())
+        if n_docs <= 0:
+            return []
+        got = self.collection.query(query_embeddings=[list(query_embedding)], n_results=n_docs, include=["metadatas"])
+        return [meta["source"] for meta in got["metadatas"][0]]
+
+
+def sources_of(chunk_collection, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None) -> List[str]:
+    """删除块之前查出它们所属的来源，删除后据此刷新质心"""
+    if ids:
+        got = chunk_collection.get(ids=ids, include=["metadatas"])
+    elif where:
+        got = chunk_collection.get(where=where, include=["metadatas"])
+    else:
+        return []
+    return list({str((meta or {}).get("source", "")) for meta in got["metadatas"]})
+
+
+def source_filter(sources: Optional[List[str]]) -> Optional[Dict[str, Any]]:
+    """候选来源对应的 Chroma where 条件，None 表示不过滤"""
+    if sources is None:
+        return None
+    return {"source": {"$in": list(sources)}}
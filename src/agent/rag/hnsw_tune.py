@@ -0,0 +1,211 @@
+"""
+HNSW 参数扫描：
+    python -m agent.rag.hnsw_tune --collection my_vector --holdout 200 --k 10
+    python -m agent.rag.hnsw_tune --collection my_vector --queries queries.jsonl --write
+
+把集合中的向量读出后，在内存中的临时 Chroma 集合上按 m × construction_ef × search_ef 网格建索引并查询：
+- 真值为暴力精确检索（numpy 矩阵乘法，按集合的距离空间计算）的前 k 个近邻，指标为 recall@k
+- 延迟为逐条查询的 p50/p95（与线上一次一个问题的调用方式一致），另记录每组参数的建索引耗时
+- 查询集为 --queries 标注集中的问题（用嵌入模型编码，集合存放截断向量时截断到相同维度），
+  或从集合中留出的 --holdout 个块向量（不参与建索引）
+在 召回-p95 延迟 的 Pareto 前沿上选出 recall@k 不低于 --target-recall 且 p95 最低的组合，--write 时写回 config.toml 的 [rag.hnsw]。
+"""
+import argparse
+import json
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import chromadb
+import numpy as np
+
+from agent.config.config import RagHnswConfig, update_config_section
+from agent.config.log import logger
+from agent.rag.alias import resolve_alias
+from agent.rag.database import get_chroma_collection
+from agent.rag.vector_space import (collection_dimensions, collection_metadata, collection_space, normalize_embeddings,
+                                    truncate_embeddings)
+
+CONFIG_PATH = Path(__file__).parent.parent.parent.parent / "config.toml"
+PERCENTILES = (50, 95)
+
+
+def load_vectors(collection, batch_size: int = 1000, limit: Optional[int] = None) -> Tuple[List[str], np.ndarray]:
+    """分页读出集合的 id 与向量"""
+    ids, vectors = [], []
+    while limit is None or len(ids) < limit:
+        size = batch_size if limit is None else min(batch_size, limit - len(ids))
+        got = collection.get(include=["embeddings"], limit=size, offset=len(ids))
+        if len(got["ids"]) == 0:
+            break
+        ids.extend(got["ids"])
+        vectors.append(np.asarray(got["embeddings"], dtype=np.float32))
+    return ids, (np.concatenate(vectors) if vectors else np.empty((0, 0), dtype=np.float32))
+
+
+def exact_neighbors(corpus: np.ndarray, queries: np.ndarray, k: int, space: str, batch_size: int = 256) -> np.ndarray:
+    """暴力精确检索，返回每个查询的前 k 个近邻在 corpus 中的下标（按相似度从高到低）"""
+    if space == "cosine":
+        corpus, queries = normalize_embeddings(corpus), normalize_embeddings(queries)
+    k = min(k, len(corpus))
+    corpus_sq = (corpus ** 2).sum(axis=1)
+    result = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        scores = batch @ corpus.T
+        if space == "l2":
+            scores = 2 * scores - corpus_sq  # -||q - x||^2 去掉与候选无关的 ||q||^2
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind="stable")
+        result[start:start + len(batch)] = np.take_along_axis(top, order, axis=1)
+    return result
+
+
+def _percentiles(samples: Sequence[float]) -> Dict[str, float]:
+    values = np.percentile(np.asarray(samples, dtype=np.float64), PERCENTILES)
+    return {f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, values)}
+
+
+def sweep(
+        corpus_ids: Sequence[str],
+        corpus: np.ndarray,
+        queries: np.ndarray,
+        k: int,
+        space: str,
+        ms: Sequence[int],
+        construction_efs: Sequence[int],
+        search_efs: Sequence[int],
+        batch_size: int = 1000,
+) -> List[Dict[str, Any]]:
+    """
+    按参数网格逐组建索引并评测。search_ef 同样要在建集合时指定：Chroma 对已加载的索引不会应用
+    modify 修改后的 ef_search，在同一个索引上调整会得到错误的结论
+    """
+    truth = exact_neighbors(corpus, queries, k, space)
+    truth_ids = [{corpus_ids[i] for i in row} for row in truth]
+    client = chromadb.EphemeralClient()
+    rows = []
+    for m in ms:
+        for construction_ef in construction_efs:
+            for search_ef in search_efs:
+                name = f"hnsw_tune_{uuid.uuid4().hex[:8]}"
+                params = RagHnswConfig(m=m, construction_ef=construction_ef, search_ef=search_ef)
+                collection = client.create_collection(name, metadata=collection_metadata(space, params))
+                start = time.perf_counter()
+                for offset in range(0, len(corpus), batch_size):
+                    collection.add(ids=list(corpus_ids[offset:offset + batch_size]),
+                                   embeddings=corpus[offset:offset + batch_size])
+                build_s = time.perf_counter() - start
+                latencies, recalls = [], []
+                for query, expected in zip(queries, truth_ids):
+                    start = time.perf_counter()
+                    found = collection.query(query_embeddings=[query], n_results=len(expected), include=[])["ids"][0]
+                    latencies.append((time.perf_counter() - start) * 1000)
+                    recalls.append(len(expected.intersection(found)) / len(expected))
+                client.delete_collection(name)
+                row = {"m": m, "construction_ef": construction_ef, "search_ef": search_ef,
+                       "recall": round(float(np.mean(recalls)), 4), "build_s": round(build_s, 3),
+                       **_percentiles(latencies)}
+                rows.append(row)
+                logger.info(f"HNSW 参数扫描: {row}")
+    return rows
+
+
+def pareto_front(rows: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """召回不低于且 p95 不高于（至少一项严格更优）的组合不存在时，该组合在前沿上"""
+    def dominated(row):
+        return any(other["recall"] >= row["recall"] and other["p95"] <= row["p95"] and
+                   (other["recall"] > row["recall"] or other["p95"] < row["p95"]) for other in rows)
+    return sorted((row for row in rows if not dominated(row)), key=lambda row: row["p95"])
+
+
+def choose(front: Sequence[Dict[str, Any]], target_recall: float) -> Dict[str, Any]:
+    """前沿上达到目标召回的组合中 p95 最低的；都达不到时取召回最高的"""
+    reached = [row for row in front if row["recall"] >= target_recall]
+    if reached:
+        return min(reached, key=lambda row: (row["p95"], row["build_s"]))
+    return max(front, key=lambda row: (row["recall"], -row["p95"]))
+
+
+def write_hnsw_config(params: Dict[str, int], path: Path = CONFIG_PATH) -> None:
+    """把参数写入 config.toml 的 [rag.hnsw]（保留其它内容、注释与换行符），没有该节时追加到文件末尾"""
+    update_config_section("rag.hnsw", params, path)
+
+
+def format_rows(rows: Sequence[Dict[str, Any]], front: Sequence[Dict[str, Any]], best: Dict[str, Any]) -> str:
+    on_front = {id(row) for row in front}
+    lines = [f"{'m':>4} {'c_ef':>5} {'s_ef':>5} {'recall':>7} {'p50ms':>8} {'p95ms':>8} {'build_s':>8}"]
+    for row in rows:
+        mark = "*" if row is best else ("+" if id(row) in on_front else " ")
+        lines.append(f"{row['m']:>4} {row['construction_ef']:>5} {row['search_ef']:>5} {row['recall']:>7.4f} "
+                     f"{row['p50']:>8.3f} {row['p95']:>8.3f} {row['build_s']:>8.3f} {mark}")
+    lines.append("+ Pareto 前沿   * 选中的组合")
+    return "\n".join(lines)
+
+
+def _ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="HNSW 参数扫描（召回-延迟）")
+    parser.add_argument("--collection", required=True, help="提供语料向量的集合名或别名")
+    parser.add_argument("--queries", default=None, help="JSONL 标注集，使用其中的问题作为查询（需要嵌入模型）")
+    parser.add_argument("--holdout", type=int, default=200, help="未提供 --queries 时，从集合中留出作为查询的块数")
+    parser.add_argument("--limit", type=int, default=None, help="最多读取的块数，默认全部")
+    parser.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+    parser.add_argument("--m", default="8,16,32")
+    parser.add_argument("--construction-ef", default="64,128,256")
+    parser.add_argument("--search-ef", default="16,32,64,128,256")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--write", action="store_true", help="把选中的组合写回 config.toml 的 [rag.hnsw]")
+    parser.add_argument("--output", default=None, help="扫描结果 JSON 输出路径")
+    parser.add_argument("--embedding-url", default=None, help="嵌入服务地址（仅 --queries），默认使用配置中的嵌入模型")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    source = get_chroma_collection(resolve_alias(args.collection))
+    space = collection_space(source)
+    ids, vectors = load_vectors(source, limit=args.limit)
+    if len(ids) == 0:
+        parser.error(f"集合 {args.collection} 为空")
+    if args.queries:
+        from agent.rag.benchmark import load_query_set
+        if args.embedding_url:
+            from agent.model import EmbeddingModel
+            embedder = EmbeddingModel(api_url=args.embedding_url, api_key=args.api_key, request_interval=0)
+        else:
+            from agent.rag.instance import embedder
+        questions = [query.question for query in load_query_set(args.queries)]
+        queries = embedder.embed_documents(questions)
+        dimensions = collection_dimensions(source) # 集合存放截断向量时，问题向量按线上 dense_query 的方式截断
+        queries = truncate_embeddings(queries, dimensions) if dimensions > 0 else normalize_embeddings(queries)
+        corpus_ids, corpus = ids, vectors
+    else:
+        rng = np.random.default_rng(args.seed)
+        held = np.zeros(len(ids), dtype=bool)
+        held[rng.choice(len(ids), size=min(args.holdout, len(ids) // 2), replace=False)] = True
+        queries, corpus = vectors[held], vectors[~held]
+        corpus_ids = [doc_id for doc_id, h in zip(ids, held) if not h]
+    logger.info(f"HNSW 参数扫描：语料 {len(corpus_ids)} 个块，查询 {len(queries)} 条，空间 {space}")
+
+    rows = sweep(corpus_ids, corpus, queries, args.k, space, _ints(args.m), _ints(args.construction_ef),
+                 _ints(args.search_ef))
+    front = pareto_front(rows)
+    best = choose(front, args.target_recall)
+    print(format_rows(rows, front, best))
+    params = {"m": best["m"], "construction_ef": best["construction_ef"], "search_ef": best["search_ef"]}
+    if args.write:
+        write_hnsw_config(params)
+        print(f"已写入 {CONFIG_PATH} [rag.hnsw]: {params}（新建集合生效，已有集合需要别名重建）")
+    report = {"space": space, "k": args.k, "corpus": len(corpus_ids), "queries": int(len(queries)),
+              "rows": rows, "pareto": front, "best": params}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,20 @@
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Iterator
 from pathlib import Path
 from bs4 import SoupStrainer
 import os
+import re
 
 
 os.environ.setdefault("USER_AGENT", "PgoAgent/1.0") # 设置网络请求来源
 from agent.config.basic_config import FILE_PATH
+from agent.config.log import logger
 from langchain_community.document_loaders import (
     WebBaseLoader,
     JSONLoader,
-    UnstructuredMarkdownLoader,
     PyPDFLoader,
-    UnstructuredWordDocumentLoader,
     TextLoader
 )
+from langchain_core.document_loaders import BaseLoader
 from langchain_core.documents import Document
 
 # 不用本地的html直接网络搜索即可
@@ -25,6 +26,293 @@ SUPPORTED_EXTENSIONS = {
     'csv': 'csv',
     'json': 'json',
 }
+# 轻量加载器的后端：native为本地直接解析，unstructured为原始的重量级流水线（仅作为兜底）
+LOADER_BACKENDS = {"native", "unstructured"}
+
+# ====================== 轻量加载器 ======================
+_MD_HEADER_RE = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t#]*$")
+_MD_FENCE_RE = re.compile(r"^[ \t]*(```|~~~)")
+
+
+def _header_metadata(header_stack: List[Tuple[int, str]]) -> dict:
+    """把标题栈转换为 metadata：h1~h6 逐级记录，header_path 记录完整层级"""
+    meta = {f"h{level}": title for level, title in header_stack}
+    if header_stack:
+        meta["header_path"] = " > ".join(title for _, title in header_stack)
+        meta["header_level"] = header_stack[-1][0]
+    return meta
+
+
+class MarkdownFastLoader(BaseLoader):
+    """
+    直接解析 Markdown 的轻量加载器（不依赖 unstructured）：
+    - mode="single"：整篇作为一个 Document，交给后续的标题分割器处理
+    - mode="elements"：按标题切成小节，每节保留标题行，并在 metadata 中记录标题层级
+    代码块(```/~~~)内的 # 不会被当成标题
+    """
+
+    def __init__(self, file_path: str, encoding: str = "utf-8", mode: str = "elements"):
+        self.file_path = file_path
+        self.encoding = encoding
+        self.mode = mode
+
+    def lazy_load(self) -> Iterator[Document]:
+        text = Path(self.file_path).read_text(encoding=self.encoding)
+        if self.mode == "single":
+            yield Document(page_content=text, metadata={"source": self.file_path})
+            return
+
+        header_stack: List[Tuple[int, str]] = []
+        section_lines: List[str] = []
+        section_meta = {}
+        in_fence = False
+
+        def flush():
+            content = "\n".join(section_lines).strip()
+            if content:
+                return Document(page_content=content, metadata={"source": self.file_path, **section_meta})
+            return None
+
+        for line in text.splitlines():
+            if _MD_FENCE_RE.match(line):
+                in_fence = not in_fence
+            header = None if in_fence else _MD_HEADER_RE.match(line)
+            if header:
+                doc = flush()
+                if doc is not None:
+                    yield doc
+                level = len(header.group(1))
+                # 弹出同级及更低层级的标题，保持标题栈的层级关系
+                while header_stack and header_stack[-1][0] >= level:
+                    header_stack.pop()
+                header_stack.append((level, header.group(2).strip()))
+                section_meta = _header_metadata(header_stack)
+                section_lines = [line]
+            else:
+                section_lines.append(line)
+
+        doc = flush()
+        if doc is not None:
+            yield doc
+
+
+class DocxFastLoader(BaseLoader):
+    """
+    基于 python-docx 的轻量 Word 加载器：
+    - 按文档顺序提取段落与表格，表格按行输出为 "单元格 | 单元格"
+    - 标题样式(Heading N/标题 N)转换为 Markdown 标题行，便于后续按标题分割
+    - mode="single" 整篇为一个 Document；mode="elements" 按标题切成小节
+    """
+
+    _HEADING_RE = re.compile(r"^(?:Heading|标题)\s*(\d)$", re.IGNORECASE)
+
+    def __init__(self, file_path: str, mode: str = "elements"):
+        self.file_path = file_path
+        self.mode = mode
+
+    def _iter_blocks(self) -> Iterator[Tuple[int, str]]:
+        """按顺序返回 (标题级别, 文本)，非标题的级别为0"""
+        import docx  # python-docx，只有加载 docx 时才导入
+        from docx.table import Table
+        from docx.text.paragraph import Paragraph
+
+        document = docx.Document(self.file_path)
+        for child in document.element.body.iterchildren():
+            tag = child.tag.rsplit("}", 1)[-1]
+            if tag == "p":
+                paragraph = Paragraph(child, document)
+                text = paragraph.text.strip()
+                if not text:
+                    continue
+                style_name = paragraph.style.name if paragraph.style is not None else ""
+                heading = self._HEADING_RE.match(style_name or "")
+                if heading:
+                    yield int(heading.group(1)), text
+                elif style_name == "Title":
+                    yield 1, text
+                else:
+                    yield 0, text
+            elif tag == "tbl":
+                rows = []
+                for row in Table(child, document).rows:
+                    cells = []
+                    for cell in row.cells:
+                        cell_text = cell.text.strip().replace("\n", " ")
+                        # 合并单元格在 python-docx 里会重复出现，跳过相邻的重复值
+                        if not cells or cells[-1] != cell_text:
+                            cells.append(cell_text)
+                    if any(cells):
+                        rows.append(" | ".join(cells))
+                if rows:
+                    yield 0, "\n".join(rows)
+
+    def lazy_load(self) -> Iterator[Document]:
+        header_stack: List[Tuple[int, str]] = []
+        section_parts: List[str] = []
+        section_meta = {}
+        base_meta = {"source": self.file_path}
+
+        def flush():
+            content = "\n\n".join(section_parts).strip()
+            if content:
+                return Document(page_content=content, metadata={**base_meta, **section_meta})
+            return None
+
+        for level, text in self._iter_blocks():
+            if level and self.mode != "single":
+                doc = flush()
+                if doc is not None:
+                    yield doc
+                while header_stack and header_stack[-1][0] >= level:
+                    header_stack.pop()
+                header_stack.append((level, text))
+                section_meta = _header_metadata(header_stack)
+                section_parts = [f"{'#' * level} {text}"]
+            elif level:
+                section_parts.append(f"{'#' * level} {text}")
+            else:
+                section_parts.append(text)
+
+        doc = flush()
+        if doc is not None:
+            yield doc
+
+
+class TextFastLoader(BaseLoader):
+    """纯文本的轻量加载器：直接读取文件，编码不匹配时依次尝试常见中文编码"""
+
+    FALLBACK_ENCODINGS = ("utf-8", "utf-8-sig", "gb18030")
+
+    def __init__(self, file_path: str, encoding: str = "utf-8"):
+        self.file_path = file_path
+        self.encoding = encoding
+
+    def lazy_load(self) -> Iterator[Document]:
+        raw = Path(self.file_path).read_bytes()
+        encodings = [self.encoding] + [e for e in self.FALLBACK_ENCODINGS if e != self.encoding]
+        for encoding in encodings:
+            try:
+                text = raw.decode(encoding)
+                break
+            except (UnicodeDecodeError, LookupError):
+                continue
+        else:
+            raise RuntimeError(f"无法解码文本文件：{self.file_path}")
+        yield Document(page_content=text, metadata={"source": self.file_path})
+
+
+class _FallbackLoader(BaseLoader):
+    """先用轻量加载器，解析失败时再退回到 unstructured 等重量级加载器（按需才导入）"""
+
+    def __init__(self, primary: BaseLoader, fallback_factory):
+        self.primary = primary
+        self.fallback_factory = fallback_factory
+
+    def lazy_load(self) -> Iterator[Document]:
+        try:
+            # 先完整解析，避免解析到一半失败时重复输出文档
+            documents = list(self.primary.lazy_load())
+        except Exception as e:
+            logger.warning(f"轻量加载器解析失败，退回到兜底加载器：{e}")
+            documents = None
+        if documents is None:
+            yield from self.fallback_factory().lazy_load()
+        else:
+            yield from documents
+
+
+class CSVChunkLoader(BaseLoader):
+    """
+    大表格 CSV 的流式加载器：
+    - pandas 按 chunksize 分块读取，内存占用只与块大小有关，与文件行数无关
+    - 每 rows_per_doc 行合成一个 Document，文本为 "列名: 值 | 列名: 值"，全部用向量化的字符串操作拼接
+    - metadata 记录来源、行号范围与列名；rows_per_doc=1 时可把 metadata_columns 的值写入 metadata
+    """
+
+    def __init__(
+            self,
+            file_path: str,
+            encoding: str = "utf-8",
+            chunksize: int = 10000,
+            rows_per_doc: int = 1,
+            content_columns: Optional[List[str]] = None,
+            metadata_columns: Optional[List[str]] = None,
+            delimiter: str = ",",
+    ):
+        if rows_per_doc < 1:
+            raise ValueError("rows_per_doc 必须大于等于1")
+        self.file_path = file_path
+        self.encoding = encoding
+        self.chunksize = max(chunksize, rows_per_doc)
+        self.rows_per_doc = rows_per_doc
+        self.content_columns = content_columns
+        self.metadata_columns = metadata_columns or []
+        self.delimiter = delimiter
+
+    def _render_rows(self, chunk, columns: List[str]):
+        """向量化地把每一行拼接成 "列名: 值" 的文本；缺列的短行（NaN）按空值处理"""
+        if not columns:
+            raise ValueError(f"CSV 文件 {self.file_path} 没有可作为正文的列（所有列都在 metadata_columns 中）")
+        text = None
+        for column in columns:
+            part = chunk[column].fillna("").str.strip().radd(f"{column}: ")
+            text = part if text is None else text.str.cat(part, sep=" | ")
+        return text
+
+    def lazy_load(self) -> Iterator[Document]:
+        import numpy as np
+        import pandas as pd
+
+        reader = pd.read_csv(
+            self.file_path,
+            sep=self.delimiter,
+            encoding=self.encoding,
+            dtype=str,
+            keep_default_na=False,  # 空单元格保持为空字符串
+            chunksize=self.chunksize,
+        )
+        row_offset = 0
+        with reader:
+            for chunk in reader:
+                columns = self.content_columns or [c for c in chunk.columns if c not in self.metadata_columns]
+                column_meta = ",".join(map(str, columns))
+                texts = self._render_rows(chunk, columns)
+
+                if self.rows_per_doc == 1:
+                    extra = chunk[self.metadata_columns].fillna("").to_dict("records") if self.metadata_columns else None
+                    for i, text in enumerate(texts.tolist()):
+                        # 先放列值再写加载器字段，名为 source / row_start / columns 的列不会覆盖来源与行号
+                        metadata = dict(extra[i]) if extra is not None else {}
+                        metadata.update(
+                            source=self.file_path,
+                            row_start=row_offset + i,
+                            row_end=row_offset + i,
+                            columns=column_meta,
+                        )
+                        yield Document(page_content=text, metadata=metadata)
+                else:
+                    group_ids = np.arange(len(texts)) // self.rows_per_doc
+                    grouped = texts.groupby(group_ids, sort=False).agg("\n".join)
+                    for group_id, text in zip(grouped.index.tolist(), grouped.tolist()):
+                        start = row_offset + group_id * self.rows_per_doc
+                        end = min(start + self.rows_per_doc, row_offset + len(texts)) - 1
+                        yield Document(
+                            page_content=text,
+                            metadata={"source": self.file_path, "row_start": start, "row_end": end, "columns": column_meta},
+                        )
+                row_offset += len(chunk)
+
+
+def _unstructured_markdown_loader(file_path: str, encoding: str, mode: str) -> BaseLoader:
+    from langchain_community.document_loaders import UnstructuredMarkdownLoader  # 重量级依赖，按需导入
+    return UnstructuredMarkdownLoader(file_path=file_path, encoding=encoding, mode=mode)
+
+
+def _unstructured_word_loader(file_path: str, mode: str, strategy: str) -> BaseLoader:
+    from langchain_community.document_loaders import UnstructuredWordDocumentLoader  # 重量级依赖，按需导入
+    return UnstructuredWordDocumentLoader(file_path=file_path, mode=mode, strategy=strategy)
+
+
 # ====================== 文件类 ======================
 def _get_loader(file_path: Path, file_type: str, encoding: str, **kwargs):
     """
@@ -32,10 +320,13 @@ def _get_loader(file_path: Path, file_type: str, encoding: str, **kwargs):
     :param file_path: 文件路径对象
     :param file_type: 文件类型
     :param encoding: 文件编码
-    :param kwargs: 其他参数
+    :param kwargs: 其他参数，loader_backend 可选 native(默认，失败时自动退回unstructured)/unstructured
     :return: 对应的加载器实例
     """
     file_path_str = str(file_path)
+    backend = kwargs.get('loader_backend', 'native')
+    if backend not in LOADER_BACKENDS:
+        raise ValueError(f"不支持的加载后端：{backend}")
     if file_type == 'json':
         jq_schema = kwargs.get('jq_schema', '.')
         text_content = kwargs.get('text_content', True)  # 默认为True
@@ -50,25 +341,36 @@ def _get_loader(file_path: Path, file_type: str, encoding: str, **kwargs):
         return loader_json
     elif file_type == 'markdown':
         markdown_mode = kwargs.get('markdown_mode', 'elements')
-        return UnstructuredMarkdownLoader(
-            file_path=file_path_str,
-            encoding=encoding,
-            mode=markdown_mode
-        )
+        fallback = lambda: _unstructured_markdown_loader(file_path_str, encoding, markdown_mode)
+        if backend == 'unstructured':
+            return fallback()
+        return _FallbackLoader(MarkdownFastLoader(file_path_str, encoding=encoding, mode=markdown_mode), fallback)
     elif file_type == 'word':
         mode_word = kwargs.get('word_mode', 'elements')
         strategy = kwargs.get('word_strategy', 'fast')
-        return UnstructuredWordDocumentLoader(
-            file_path=file_path_str,
-            mode=mode_word ,  # 将文档拆分为元素
-            strategy=strategy,  # 使用快速策略
-    )
+        fallback = lambda: _unstructured_word_loader(file_path_str, mode_word, strategy)
+        if backend == 'unstructured':
+            return fallback()
+        return _FallbackLoader(DocxFastLoader(file_path_str, mode=mode_word), fallback)
+    elif file_type == 'csv':
+        return CSVChunkLoader(
+            file_path_str,
+            encoding=encoding,
+            chunksize=kwargs.get('csv_chunksize', 10000),
+            rows_per_doc=kwargs.get('csv_rows_per_doc', 1),
+            content_columns=kwargs.get('csv_content_columns'),
+            metadata_columns=kwargs.get('csv_metadata_columns'),
+            delimiter=kwargs.get('csv_delimiter', ','),
+        )
     elif file_type == 'pdf':
         extract_images = kwargs.get('extract_images', False)
         return PyPDFLoader(file_path=file_path_str, extract_images=extract_images)
 
     elif file_type == 'text':
-        return TextLoader(file_path=file_path_str, encoding=encoding)
+        fallback = lambda: TextLoader(file_path=file_path_str, encoding=encoding, autodetect_encoding=True)
+        if backend == 'unstructured':
+            return fallback()
+        return _FallbackLoader(TextFastLoader(file_path_str, encoding=encoding), fallback)
     else:
         raise ValueError(f"不支持的文件类型：{file_type}")
 
@@ -80,7 +382,7 @@ def load_web_page(
     **kwargs
 ) -> List[Document]:
     """
-    资源访问方法：加载网页内容
+    资源访问方法：加载网页内容（单个页面、同步、不缓存；批量抓取与增量刷新见 web_loader.py）
     :param url: 网页URL
     :param encoding: 编码，默认为'utf-8'
     :param css_selector: CSS选择器，用于只解析特定内容（如class_="md-content"）
@@ -121,6 +423,18 @@ class DocumentLoader:
         :param kwargs: 其他加载器特定参数
         :return: Document列表
         """
+        return list(self.lazy_load_file(file_path, file_type=file_type, encoding=encoding, **kwargs))
+
+    def lazy_load_file(self, file_path: str, file_type: Optional[str] = None, encoding: str = 'utf-8', **kwargs) -> Iterator[
+        Document]:
+        """
+        资源访问方法：流式加载单个文件，逐个返回 Document（大文件如 CSV 不会一次性读入内存）
+        :param file_path: 文件路径（可以是相对路径或绝对路径）
+        :param file_type: 文件类型，如果为None则自动推断
+        :param encoding: 文件编码，默认为'utf-8'
+        :param kwargs: 其他加载器特定参数
+        :return: Document迭代器
+        """
         file_path_obj = Path(file_path) # 当成路径来操作
         
         # 如果是相对路径，则基于base_path解析
@@ -137,9 +451,7 @@ class DocumentLoader:
         
         # 根据文件类型选择对应的加载器
         data_loader = _get_loader(file_path_obj, file_type, encoding, **kwargs)
-        documents = data_loader.load()
-        
-        return documents
+        return data_loader.lazy_load()
 
     def load_folder(
             self,
@@ -0,0 +1,147 @@
+"""
+降维存储与全维重打分（Matryoshka 类嵌入模型的前若干维本身就是可用的低维表示）：
+- 集合（HNSW 索引）只存截断到 dimensions 维并重新归一化的向量，索引内存与向量检索耗时按维度比例下降
+- 全维向量按块 id 存放在 DB_PATH/full_vectors/<集合名>.sqlite3，只在重打分时按 id 读取，不占常驻内存
+- 查询时用截断后的问题向量召回 top_k × candidates 个候选，再按全维余弦相似度重新排序取前 top_k
+截断维度记录在集合 metadata 中（见 vector_space.DIMENSIONS_KEY），已有集合沿用创建时的维度，
+维度的召回损失可用 python -m agent.rag.matryoshka_bench 在本地语料上测量。
+"""
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from agent.config import DB_PATH
+from agent.rag.vector_space import (collection_dimensions, collection_space, distance_to_similarity,
+                                    normalize_embeddings, truncate_embeddings)
+
+
+def full_vectors_path(collection_name: str) -> Path:
+    """物理集合对应的全维向量文件"""
+    return Path(DB_PATH) / "full_vectors" / f"{collection_name}.sqlite3"
+
+
+class FullVectorStore:
+    """块 id -> 全维 float32 向量（已归一化）的磁盘存储，按 id 批量读写"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (id TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._lock = threading.Lock()
+
+    def add(self, ids: Sequence[str], vectors: np.ndarray) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO vectors (id, vector) VALUES (?, ?)",
+                                   [(doc_id, vector.tobytes()) for doc_id, vector in zip(ids, vectors)])
+
+    def get(self, ids: Sequence[str], batch_size: int = 500) -> Dict[str, np.ndarray]:
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for start in range(0, len(ids), batch_size):
+                batch = list(ids[start:start + batch_size])
+                rows = self._conn.execute(
+                    f"SELECT id, vector FROM vectors WHERE id IN ({','.join('?' * len(batch))})", batch).fetchall()
+                found.update((doc_id, np.frombuffer(blob, dtype=np.float32)) for doc_id, blob in rows)
+        return found
+
+    def delete(self, ids: Sequence[str]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM vectors WHERE id = ?", [(doc_id,) for doc_id in ids])
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def backup(self, path: Path) -> None:
+        """用 sqlite 在线备份复制到 path（快照导出），复制期间的写入不会产生不一致的文件"""
+        target = sqlite3.connect(str(path))
+        try:
+            with self._lock:
+                self._conn.backup(target)
+        finally:
+            target.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class MatryoshkaIndex:
+    """
+    存放截断向量的集合的配套索引：入库时把全维向量写入 FullVectorStore 并返回截断向量，
+    召回后按全维向量对候选重新打分。缺少全维向量的候选（例如从快照导入的集合）沿用截断向量的相似度
+    """
+
+    def __init__(self, collection_name: str, dimensions: int, candidates: int = 4, path: Optional[Path] = None):
+        self.dimensions = dimensions
+        self.candidates = max(1, candidates)
+        self.store = FullVectorStore(path or full_vectors_path(collection_name))
+
+    def reduce(self, embeddings: Sequence[Any]) -> np.ndarray:
+        return truncate_embeddings(embeddings, self.dimensions)
+
+    def add(self, ids: Sequence[str], embeddings: Sequence[Any]) -> np.ndarray:
+        """保存全维向量，返回写入集合的截断向量"""
+        self.store.add(ids, normalize_embeddings(embeddings))
+        return self.reduce(embeddings)
+
+    def delete(self, ids: Sequence[str]) -> None:
+        self.store.delete(ids)
+
+    def candidate_k(self, top_k: int) -> int:
+        return top_k * self.candidates
+
+    def rescore(self, query_embeddings: Sequence[Any], result: Dict[str, Any], space: str, top_k: int) -> Dict[str, Any]:
+        """
+        对一次（可以是批量）collection.query 的结果按全维余弦相似度重新排序并截取前 top_k，
+        结果中的各列表字段按新顺序对齐，similarities 为重打分后的相似度（越大越相关）
+        """
+        queries = normalize_embeddings(query_embeddings)
+        full = self.store.get(list({doc_id for ids in result["ids"] for doc_id in ids}))
+        fields = [key for key, value in result.items() if key != "included" and value is not None]
+        rescored: Dict[str, Any] = {**result, **{key: [] for key in fields}, "similarities": []}
+        missing = 0
+        for i, (query, ids) in enumerate(zip(queries, result["ids"])):
+            similarities = distance_to_similarity(result["distances"][i], space)
+            for j, doc_id in enumerate(ids):
+                vector = full.get(doc_id)
+                if vector is None:
+                    missing += 1
+                else:
+                    similarities[j] = float(query @ vector)
+            order = np.argsort(-similarities, kind="stable")[:top_k]
+            for key in fields:
+                rescored[key].append([result[key][i][j] for j in order])
+            rescored["similarities"].append(similarities[order].tolist())
+        if missing:
+            logger.debug(f"全维重打分：{missing} 个候选缺少全维向量，沿用截断向量的相似度")
+        return rescored
+
+
+def open_matryoshka(collection, collection_name: str, candidates: int) -> Optional[MatryoshkaIndex]:
+    """集合存放截断向量时打开配套的全维向量存储，否则返回 None"""
+    dimensions = collection_dimensions(collection)
+    return MatryoshkaIndex(collection_name, dimensions, candidates) if dimensions > 0 else None
+
+
+def dense_query(collection, matryoshka: Optional[MatryoshkaIndex], query_embeddings: Sequence[Any], top_k: int,
+                include: List[str], where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    向量召回（可批量）：普通集合直接查询；存放截断向量的集合先用截断后的问题向量召回 top_k × candidates 个候选，
+    再按全维向量重新打分取前 top_k。include 含 distances 或走了重打分时返回与 ids 对齐的 similarities
+    """
+    query = {"where": where} if where else {}
+    space = collection_space(collection)
+    if matryoshka is None:
+        result = collection.query(query_embeddings=query_embeddings, n_results=top_k, include=include, **query)
+        if result.get("distances") is not None:
+            result["similarities"] = [distance_to_similarity(distances, space).tolist() for distances in result["distances"]]
+        return result
+    result = collection.query(query_embeddings=matryoshka.reduce(query_embeddings), n_results=matryoshka.candidate_k(top_k),
+                              include=list(dict.fromkeys([*include, "distances"])), **query)
+    return matryoshka.rescore(query_embeddings, result, space, top_k)
@@ -0,0 +1,177 @@
+"""
+截断维度评测：
+    python -m agent.rag.matryoshka_bench --collection my_vector --dims 128,256,512 --k 10
+    python -m agent.rag.matryoshka_bench --collection my_vector --queries queries.jsonl --candidates 1,2,4,8 --write
+
+从集合读出全维向量（集合本身存放截断向量时从全维向量存储读出），每个截断维度在内存中的临时 Chroma 集合上
+按 [rag.hnsw] 参数建索引，与线上一致地经 dense_query 逐条查询（召回 k × candidates 个候选后读全维向量重打分）：
+- 真值为全维向量暴力精确检索的前 k 个近邻，recall 为 recall@k；candidates = 1 即只用截断向量召回、不扩大候选
+- 延迟为逐条查询（含读取全维向量与重打分）的 p50/p95，index_mb 为 HNSW 中向量数据的大小（块数 × 维度 × 4 字节）
+- 全维一行（dims = 全维，不重打分）作为基准
+在 recall 不低于 --target-recall 的组合中选 index_mb 最小（同维度取 p95 最低）的，--write 时写回 [rag.matryoshka]；
+新建集合生效，已有集合通过别名重建迁移。
+"""
+import argparse
+import json
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import chromadb
+import numpy as np
+
+from agent.config.config import load_rag_hnsw, update_config_section
+from agent.config.log import logger
+from agent.rag.alias import resolve_alias
+from agent.rag.database import get_chroma_collection
+from agent.rag.hnsw_tune import CONFIG_PATH, exact_neighbors, load_vectors
+from agent.rag.matryoshka import MatryoshkaIndex, dense_query, full_vectors_path
+from agent.rag.vector_space import collection_dimensions, collection_metadata, collection_space, normalize_embeddings
+
+PERCENTILES = (50, 95)
+
+
+def load_full_vectors(collection, collection_name: str, limit: Optional[int] = None):
+    """读出集合的 id 与全维向量：存放截断向量的集合从全维向量存储按 id 读取"""
+    ids, vectors = load_vectors(collection, limit=limit)
+    if collection_dimensions(collection) == 0:
+        return ids, vectors
+    index = MatryoshkaIndex(collection_name, collection_dimensions(collection))
+    try:
+        full = index.store.get(ids)
+    finally:
+        index.store.close()
+    missing = len(ids) - len(full)
+    if missing:
+        raise ValueError(f"集合 {collection_name} 有 {missing} 个块缺少全维向量（{full_vectors_path(collection_name)}）")
+    return ids, np.stack([full[doc_id] for doc_id in ids])
+
+
+def _measure(collection, matryoshka: Optional[MatryoshkaIndex], queries: np.ndarray, truth: Sequence[set],
+             k: int) -> Dict[str, float]:
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = dense_query(collection, matryoshka, [query], k, [])["ids"][0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(expected.intersection(found)) / len(expected))
+    values = np.percentile(np.asarray(latencies, dtype=np.float64), PERCENTILES)
+    return {"recall": round(float(np.mean(recalls)), 4),
+            **{f"p{p}": round(float(v), 3) for p, v in zip(PERCENTILES, values)}}
+
+
+def benchmark(corpus_ids: Sequence[str], corpus: np.ndarray, queries: np.ndarray, k: int, space: str,
+              dims: Sequence[int], candidates: Sequence[int], batch_size: int = 1000) -> List[Dict[str, Any]]:
+    """每个截断维度建一次索引，在同一个索引上依次评测各候选倍数；第一行为全维基准"""
+    full_dim = corpus.shape[1]
+    k = min(k, len(corpus))
+    truth = [{corpus_ids[i] for i in row} for row in exact_neighbors(corpus, queries, k, space)]
+    client = chromadb.EphemeralClient()
+    hnsw = load_rag_hnsw()
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="matryoshka_bench_") as tmp:
+        for dim in [full_dim] + sorted({d for d in dims if 0 < d < full_dim}):
+            name = f"matryoshka_bench_{uuid.uuid4().hex[:8]}"
+            reduced = dim < full_dim
+            collection = client.create_collection(name, metadata=collection_metadata(space, hnsw, dim if reduced else 0))
+            matryoshka = MatryoshkaIndex(name, dim, path=Path(tmp) / f"{name}.sqlite3") if reduced else None
+            start = time.perf_counter()
+            for offset in range(0, len(corpus), batch_size):
+                ids = list(corpus_ids[offset:offset + batch_size])
+                vectors = corpus[offset:offset + batch_size]
+                collection.add(ids=ids, embeddings=matryoshka.add(ids, vectors) if reduced else vectors)
+            build_s = round(time.perf_counter() - start, 3)
+            index_mb = round(len(corpus) * dim * 4 / 2 ** 20, 2)
+            for candidate in (sorted(set(candidates)) if reduced else [1]):
+                if reduced:
+                    matryoshka.candidates = candidate
+                row = {"dims": dim, "candidates": candidate, "index_mb": index_mb, "build_s": build_s,
+                       **_measure(collection, matryoshka, queries, truth, k)}
+                rows.append(row)
+                logger.info(f"截断维度评测: {row}")
+            client.delete_collection(name)
+            if matryoshka is not None:
+                matryoshka.store.close()
+    return rows
+
+
+def choose(rows: Sequence[Dict[str, Any]], target_recall: float) -> Dict[str, Any]:
+    """达到目标召回的组合中向量数据最小、同维度 p95 最低的；都达不到时取全维基准"""
+    reached = [row for row in rows if row["recall"] >= target_recall]
+    if not reached:
+        return rows[0]
+    return min(reached, key=lambda row: (row["index_mb"], row["p95"]))
+
+
+def format_rows(rows: Sequence[Dict[str, Any]], best: Dict[str, Any]) -> str:
+    lines = [f"{'dims':>5} {'cand':>5} {'index_mb':>9} {'recall':>7} {'p50ms':>8} {'p95ms':>8} {'build_s':>8}"]
+    for row in rows:
+        lines.append(f"{row['dims']:>5} {row['candidates']:>5} {row['index_mb']:>9.2f} {row['recall']:>7.4f} "
+                     f"{row['p50']:>8.3f} {row['p95']:>8.3f} {row['build_s']:>8.3f} {'*' if row is best else ' '}")
+    lines.append("第一行为全维基准（不重打分）   * 选中的组合")
+    return "\n".join(lines)
+
+
+def _ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="截断维度评测（召回损失-索引大小-延迟）")
+    parser.add_argument("--collection", required=True, help="提供语料向量的集合名或别名")
+    parser.add_argument("--queries", default=None, help="JSONL 标注集，使用其中的问题作为查询（需要嵌入模型）")
+    parser.add_argument("--holdout", type=int, default=200, help="未提供 --queries 时，从集合中留出作为查询的块数")
+    parser.add_argument("--limit", type=int, default=None, help="最多读取的块数，默认全部")
+    parser.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+    parser.add_argument("--dims", default="128,256,512")
+    parser.add_argument("--candidates", default="1,2,4,8", help="重打分的候选倍数，1 表示只用截断向量")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--write", action="store_true", help="把选中的组合写回 config.toml 的 [rag.matryoshka]")
+    parser.add_argument("--output", default=None, help="评测结果 JSON 输出路径")
+    parser.add_argument("--embedding-url", default=None, help="嵌入服务地址（仅 --queries），默认使用配置中的嵌入模型")
+    parser.add_argument("--api-key", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    physical = resolve_alias(args.collection)
+    source = get_chroma_collection(physical)
+    space = collection_space(source)
+    ids, vectors = load_full_vectors(source, physical, limit=args.limit)
+    if len(ids) == 0:
+        parser.error(f"集合 {args.collection} 为空")
+    if args.queries:
+        from agent.rag.benchmark import load_query_set
+        if args.embedding_url:
+            from agent.model import EmbeddingModel
+            embedder = EmbeddingModel(api_url=args.embedding_url, api_key=args.api_key, request_interval=0)
+        else:
+            from agent.rag.instance import embedder
+        questions = [query.question for query in load_query_set(args.queries)]
+        queries = normalize_embeddings(embedder.embed_documents(questions))
+        corpus_ids, corpus = ids, vectors
+    else:
+        rng = np.random.default_rng(args.seed)
+        held = np.zeros(len(ids), dtype=bool)
+        held[rng.choice(len(ids), size=min(args.holdout, len(ids) // 2), replace=False)] = True
+        queries, corpus = vectors[held], vectors[~held]
+        corpus_ids = [doc_id for doc_id, h in zip(ids, held) if not h]
+    logger.info(f"截断维度评测：语料 {len(corpus_ids)} 个块，全维 {corpus.shape[1]}，查询 {len(queries)} 条，空间 {space}")
+
+    rows = benchmark(corpus_ids, corpus, queries, args.k, space, _ints(args.dims), _ints(args.candidates))
+    best = choose(rows, args.target_recall)
+    print(format_rows(rows, best))
+    params = {"dimensions": 0 if best is rows[0] else best["dims"], "candidates": best["candidates"]}
+    if args.write:
+        update_config_section("rag.matryoshka", params, CONFIG_PATH)
+        print(f"已写入 {CONFIG_PATH} [rag.matryoshka]: {params}（新建集合生效，已有集合需要别名重建）")
+    report = {"space": space, "k": args.k, "corpus": len(corpus_ids), "queries": int(len(queries)),
+              "full_dimensions": int(corpus.shape[1]), "rows": rows, "best": params}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+from typing import Any, List, Sequence
+
+import numpy as np
+
+
+def mmr_select(embeddings: Sequence[Any], relevance: Sequence[float], top_n: int,
+               lambda_mult: float = 0.5) -> List[int]:
+    """
+    最大边际相关(MMR)：每一步选 lambda * 相关度 - (1 - lambda) * 与已选块的最大相似度 最大的候选
+    - 相关度用召回/融合分数（min-max 归一化到 [0, 1]），混合检索时同样保留 BM25 的贡献
+    - 相似度为候选向量两两之间的余弦相似度，整个相似度矩阵一次矩阵乘法算出
+    :param embeddings: 与候选对齐的向量（召回时通过 include=["embeddings"] 一并取回）
+    :param relevance: 与候选对齐的分数，越大越相关
+    :param top_n: 保留的候选数
+    :param lambda_mult: 1 为只看相关度，0 为只看多样性
+    :return: 选中候选的下标，保持原来的相关度顺序
+    """
+    n = len(relevance)
+    if top_n <= 0 or n <= top_n:
+        return list(range(n))
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1.0, norms)
+    similarity = vectors @ vectors.T
+
+    rel = np.asarray(relevance, dtype=np.float32)
+    spread = rel.max() - rel.min()
+    rel = (rel - rel.min()) / spread if spread > 0 else np.ones(n, dtype=np.float32)
+
+    first = int(np.argmax(rel))
+    selected = [first]
+    chosen = np.zeros(n, dtype=bool)
+    chosen[first] = True
+    max_sim = similarity[first].copy()  # 每个候选与已选集合的最大相似度，每选一个增量更新
+    while len(selected) < top_n:
+        scores = lambda_mult * rel - (1 - lambda_mult) * max_sim
+        scores[chosen] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        chosen[best] = True
+        np.maximum(max_sim, similarity[best], out=max_sim)
+    return sorted(selected)
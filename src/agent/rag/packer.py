@@ -0,0 +1,198 @@
+import hashlib
+import re
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from agent.rag.adjacency import section_id
+from agent.utils.token_utils import DEFAULT_ENCODING, count_tokens, truncate_tokens
+
+_WHITESPACE_RE = re.compile(r"\s+")
+MAX_OVERLAP_CHARS = 200  # 相邻块合并时最多查找的重叠长度（大于常用的 chunk_overlap）
+MIN_FILL_TOKENS = 16     # 剩余预算小于该值时不再尝试放入新的块
+
+
+class ChunkAnnotator:
+    """
+    入库前为每个块分配 id（doc.id）并补充 metadata：
+    - token_count：块的 token 数，检索后打包上下文时不用重新计数
+    - chunk_index：块在同一来源中的顺序
+    - prev_id / next_id：同一来源中前后块的 id，检索后一次批量 get 即可取回相邻块，打包时据此合并相邻块
+      （next_id 预先分配，来源的最后一块的 next_id 指向不存在的块，取回时自然忽略）
+    - parent_id：所在小节的 id（标题路径/页码），用于扩展到整个小节
+    同一个实例在整个流式入库过程中共用，保证同一来源的序号与前后指针跨批次连续；已有的字段不会被覆盖
+    """
+
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING):
+        self.encoding_name = encoding_name
+        self._next_index: Dict[str, int] = {}
+        self._last_id: Dict[str, str] = {}
+        self._pending_id: Dict[str, str] = {}
+
+    def __call__(self, docs: Iterable[Document]) -> Iterator[Document]:
+        for doc in docs:
+            meta = doc.metadata if doc.metadata is not None else {}
+            source = str(meta.get("source", ""))
+            pending = self._pending_id.pop(source, None)
+            if doc.id is None:
+                doc.id = pending or str(uuid.uuid4())
+            if "chunk_index" not in meta:
+                meta["chunk_index"] = self._next_index.get(source, 0)
+            self._next_index[source] = int(meta["chunk_index"]) + 1
+            if "token_count" not in meta:
+                meta["token_count"] = count_tokens(doc.page_content, self.encoding_name)
+            if source in self._last_id:
+                meta.setdefault("prev_id", self._last_id[source])
+            self._pending_id[source] = str(uuid.uuid4())
+            meta.setdefault("next_id", self._pending_id[source])
+            self._last_id[source] = doc.id
+            parent = section_id(source, meta)
+            if parent is not None:
+                meta.setdefault("parent_id", parent)
+            doc.metadata = meta
+            yield doc
+
+
+@dataclass
+class PackedChunk:
+    """打包后的一段上下文，可能由同一来源的多个相邻块合并而成"""
+    text: str
+    source: str
+    score: float
+    token_count: int
+    ids: List[str] = field(default_factory=list)
+    chunk_index: Optional[int] = None
+    last_index: Optional[int] = None
+    next_id: Optional[str] = None # 最后一块的 next_id，合并相邻块时据此判断下一块是否紧接其后
+
+
+def _shingles(text: str, n: int = 3) -> set:
+    compact = _WHITESPACE_RE.sub("", text)
+    if len(compact) <= n:
+        return {compact} if compact else set()
+    return {compact[i:i + n] for i in range(len(compact) - n + 1)}
+
+
+def _overlap(left: str, right: str) -> int:
+    """left 的后缀与 right 的前缀重合的最大长度（切分时的 chunk_overlap）"""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def dedupe(chunks: Sequence[PackedChunk], threshold: float = 0.8) -> List[PackedChunk]:
+    """
+    去掉重复与近似重复的块（保留分数高的）：
+    - 规范化空白后内容完全相同
+    - 字符 3-gram 的包含度 |A∩B| / min(|A|,|B|) >= threshold，覆盖一个块几乎被另一个块包含的情况
+    """
+    kept: List[Tuple[PackedChunk, set]] = []
+    seen_hashes = set()
+    for chunk in sorted(chunks, key=lambda c: c.score, reverse=True):
+        digest = hashlib.md5(_WHITESPACE_RE.sub(" ", chunk.text).strip().encode("utf-8")).hexdigest()
+        if digest in seen_hashes:
+            continue
+        shingles = _shingles(chunk.text)
+        duplicated = False
+        for _, other in kept:
+            smaller = min(len(shingles), len(other))
+            if smaller and len(shingles & other) / smaller >= threshold:
+                duplicated = True
+                break
+        if duplicated:
+            continue
+        seen_hashes.add(digest)
+        kept.append((chunk, shingles))
+    return [chunk for chunk, _ in kept]
+
+
+def _join(left: PackedChunk, right: PackedChunk, encoding_name: str) -> PackedChunk:
+    text = left.text + right.text[_overlap(left.text, right.text):]
+    return PackedChunk(text=text, source=left.source, score=max(left.score, right.score),
+                       token_count=count_tokens(text, encoding_name), ids=left.ids + right.ids,
+                       chunk_index=left.chunk_index, last_index=right.last_index, next_id=right.next_id)
+
+
+def _merge_adjacent(chunks: List[PackedChunk], encoding_name: str) -> List[PackedChunk]:
+    """
+    合并同一来源中前后相连的块（前一块的 next_id 就是后一块的 id），去掉切分时的重叠部分。
+    只按入库时写入的链接合并，不看 chunk_index 是否连续：同一来源分多次入库或重新入库后 chunk_index 会重复，
+    没有链接的块原样保留，不会被丢掉
+    """
+    position: Dict[str, int] = {}
+    for i, chunk in enumerate(chunks):
+        if len(chunk.ids) == 1:
+            position.setdefault(chunk.ids[0], i) # 重复的 chroma_id 只有第一个参与链接，其余单独保留
+    pointed = {position[chunk.next_id] for chunk in chunks if chunk.next_id in position}
+    used: set = set()
+    merged: List[PackedChunk] = []
+    for heads_only in (True, False): # 先从链头开始合并，第二遍收尾没有链头的块（例如链接成环的异常数据）
+        for i, chunk in enumerate(chunks):
+            if i in used or (heads_only and i in pointed):
+                continue
+            used.add(i)
+            current = chunk
+            while current.next_id in position and position[current.next_id] not in used:
+                j = position[current.next_id]
+                if chunks[j].source != current.source:
+                    break
+                used.add(j)
+                current = _join(current, chunks[j], encoding_name)
+            merged.append(current)
+    merged.sort(key=lambda c: c.score, reverse=True)
+    return merged
+
+
+def pack_context(
+        results: Sequence[Tuple[str, Dict[str, Any]]],
+        scores: Sequence[float],
+        token_budget: int,
+        dedupe_threshold: float = 0.8,
+        merge_adjacent: bool = True,
+        encoding_name: str = DEFAULT_ENCODING,
+) -> List[PackedChunk]:
+    """
+    把检索结果打包到 token 预算内：去重 → 按分数贪心装入预算 → 合并相邻块
+    - 分数最高的块单独超出预算时截断后放入，保证最相关的内容不会被整体丢掉
+    - 放不下的块跳过，继续尝试后面更短的块
+    :param results: (文档内容, 元数据)，元数据中的 token_count/chunk_index/next_id 由入库时的 ChunkAnnotator 写入
+    :param scores: 与 results 对齐的分数，越大越相关
+    :param token_budget: 上下文的 token 预算，<=0 表示不限制
+    :return: 按分数从高到低排列的上下文块
+    """
+    chunks = []
+    for (text, meta), score in zip(results, scores):
+        meta = meta or {}
+        index = meta.get("chunk_index")
+        index = int(index) if index is not None and index != "" else None
+        token_count = meta.get("token_count")
+        chunks.append(PackedChunk(
+            text=text,
+            source=str(meta.get("source", "")),
+            score=float(score),
+            token_count=int(token_count) if token_count not in (None, "") else count_tokens(text, encoding_name),
+            ids=[meta["chroma_id"]] if meta.get("chroma_id") else [],
+            chunk_index=index,
+            last_index=index,
+            next_id=meta.get("next_id") or None,
+        ))
+    chunks = dedupe(chunks, dedupe_threshold)
+
+    if token_budget > 0:
+        selected, remaining = [], token_budget
+        for chunk in chunks:
+            if remaining < MIN_FILL_TOKENS:
+                break
+            if chunk.token_count <= remaining:
+                selected.append(chunk)
+                remaining -= chunk.token_count
+            elif not selected:
+                chunk.text = truncate_tokens(chunk.text, remaining, encoding_name)
+                chunk.token_count = count_tokens(chunk.text, encoding_name)
+                selected.append(chunk)
+                remaining -= chunk.token_count
+        chunks = selected
+    return _merge_adjacent(chunks, encoding_name) if merge_adjacent else chunks
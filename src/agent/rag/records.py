@@ -0,0 +1,70 @@
+from array import array
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+class ChunkTable:
+    """
+    列式的块集合，用于全量遍历（如构建 BM25 索引）：
+    - ids / texts 为两个列表，正文直接引用 Chroma 返回的字符串，不复制
+    - 来源按出现顺序编码为整数存放在 array('i') 中，每个来源的字符串只存一份
+    - 不保留 metadata，避免为每个块复制一份字典
+    """
+    __slots__ = ("ids", "texts", "source_codes", "sources", "_source_index")
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.source_codes = array("i")
+        self.sources: List[str] = []
+        self._source_index: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def append(self, doc_id: str, text: str, source: str = "") -> None:
+        code = self._source_index.get(source)
+        if code is None:
+            code = self._source_index[source] = len(self.sources)
+            self.sources.append(source)
+        self.ids.append(doc_id)
+        self.texts.append(text)
+        self.source_codes.append(code)
+
+    def extend_from_get(self, got: Dict[str, Any]) -> int:
+        """追加一页 collection.get(include=["documents", "metadatas"]) 的结果，返回追加的块数"""
+        metadatas = got.get("metadatas") or [None] * len(got["ids"])
+        for doc_id, text, meta in zip(got["ids"], got["documents"], metadatas):
+            self.append(doc_id, text or "", str((meta or {}).get("source", "")))
+        return len(got["ids"])
+
+    @classmethod
+    def from_documents(cls, docs: Iterable[Document]) -> "ChunkTable":
+        """Document 列表（metadata 中带 chroma_id）转为列式集合"""
+        table = cls()
+        for doc in docs:
+            meta = doc.metadata or {}
+            doc_id = meta.get("chroma_id")
+            if not doc_id:
+                raise ValueError("ChunkTable: 缺少 chroma_id（请在 iterate_vector_store函数内注入）")
+            table.append(doc_id, doc.page_content, str(meta.get("source", "")))
+        return table
+
+    @classmethod
+    def from_collection(cls, collection, batch_size: int = 1000, where: Optional[Dict[str, Any]] = None) -> "ChunkTable":
+        """分页读出集合中的块（只取正文与来源）"""
+        table = cls()
+        while True:
+            got = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=len(table),
+                                 **({"where": where} if where else {}))
+            if table.extend_from_get(got) == 0:
+                return table
+
+    def source_positions(self) -> Dict[str, np.ndarray]:
+        """来源 -> 该来源的块在表中的位置（升序），按来源编码一次稳定排序后切分"""
+        codes = np.asarray(self.source_codes)
+        order = np.argsort(codes, kind="stable").astype(np.int64)
+        bounds = np.cumsum(np.bincount(codes, minlength=len(self.sources)))[:-1]
+        return {source: positions for source, positions in zip(self.sources, np.split(order, bounds))}
@@ -0,0 +1,286 @@
+"""
+知识库快照导出/导入，新节点直接加载快照，不需要重新切分与嵌入：
+    python -m agent.rag.snapshot export --collection my_vector --out ./snapshots/my_vector
+    python -m agent.rag.snapshot verify --bundle ./snapshots/my_vector
+    python -m agent.rag.snapshot import --bundle ./snapshots/my_vector --alias my_vector
+
+快照是一个目录：
+    manifest.json   格式版本、集合名、块数、向量维度、集合 metadata、各文件的 sha256
+    records.jsonl   每行一个块 {"id", "document", "metadata"}，与向量按行对齐
+    vectors.npy     float32 向量矩阵 (块数, 维度)，导入时内存映射读取
+    bm25.json.gz    BM25 索引（可选，词频与块 id 的 JSON，不含 pickle），导入后引擎直接加载，不用重新分词
+    full_vectors.sqlite3  全维向量（集合存放截断向量时），导入后继续用于召回后的重打分（见 matryoshka.py）
+导入写入一个新的物理集合，校验块数后切换别名（见 alias.py），失败时别名保持不变。
+"""
+import argparse
+import hashlib
+import json
+import shutil
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Sequence
+
+import numpy as np
+from loguru import logger
+
+from agent.config import DB_PATH
+from agent.rag.alias import get_alias_registry
+from agent.rag.database import get_chroma_client, get_chroma_collection, delete_chroma_collection
+from agent.rag.indexer import BM25Indexer, id_digest
+from agent.rag.matryoshka import FullVectorStore, full_vectors_path
+from agent.rag.records import ChunkTable
+from agent.rag.vector_space import collection_dimensions
+
+SNAPSHOT_FORMAT = "agent-rag-snapshot"
+SNAPSHOT_VERSION = 2 # v2：BM25 索引由 pickle 改为 JSON
+MANIFEST = "manifest.json"
+RECORDS = "records.jsonl"
+VECTORS = "vectors.npy"
+BM25 = "bm25.json.gz"
+FULL_VECTORS = "full_vectors.sqlite3"
+
+
+class SnapshotError(RuntimeError):
+    """快照不完整、校验和不一致或版本不兼容"""
+
+
+@dataclass
+class SnapshotReport:
+    collection: str
+    bundle: str
+    chunks: int
+    dimension: int
+    bm25: bool
+    elapsed_s: float
+    swapped: bool = False
+
+
+def bm25_snapshot_path(collection_name: str) -> Path:
+    """物理集合对应的 BM25 快照文件，引擎构建 BM25 索引时优先加载"""
+    return Path(DB_PATH) / "bm25" / f"{collection_name}.json.gz"
+
+
+def _sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def export_snapshot(collection_name: str, out_dir: str, batch_size: int = 1000, include_bm25: bool = True,
+                    indexer: Optional[BM25Indexer] = None) -> SnapshotReport:
+    """
+    分页读出集合写入快照目录，向量按行写入预先分配的 .npy 内存映射，内存占用与集合大小无关
+    （include_bm25 时需要全文构建 BM25 索引，传入已构建的 indexer 可以直接保存）
+    :param collection_name: 集合名或别名
+    """
+    start = time.perf_counter()
+    physical = get_alias_registry().resolve(collection_name)
+    collection = get_chroma_collection(physical)
+    total = collection.count()
+    if total == 0:
+        raise SnapshotError(f"集合 {physical} 为空")
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+
+    vectors = None
+    table = ChunkTable() if include_bm25 and indexer is None else None
+    written = 0
+    with open(out / RECORDS, "w", encoding="utf-8") as records:
+        while written < total:
+            got = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=written)
+            if len(got["ids"]) == 0:
+                break
+            batch = np.asarray(got["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(out / VECTORS, mode="w+", dtype=np.float32,
+                                                    shape=(total, batch.shape[1]))
+            vectors[written:written + len(batch)] = batch
+            for doc_id, text, meta in zip(got["ids"], got["documents"], got["metadatas"]):
+                records.write(json.dumps({"id": doc_id, "document": text, "metadata": meta or {}},
+                                         ensure_ascii=False) + "\n")
+            if table is not None:
+                table.extend_from_get(got)
+            written += len(got["ids"])
+    if written != total:
+        raise SnapshotError(f"导出期间集合发生变化：预期 {total} 个块，实际读出 {written} 个")
+    dimension = int(vectors.shape[1])
+    vectors.flush()
+    del vectors
+
+    if table is not None:
+        indexer = BM25Indexer()
+        indexer.build_table(table)
+    has_bm25 = indexer is not None and indexer.is_built()
+    if has_bm25:
+        indexer.save(str(out / BM25))
+
+    has_full = collection_dimensions(collection) > 0 and full_vectors_path(physical).exists()
+    if has_full:
+        (out / FULL_VECTORS).unlink(missing_ok=True)
+        store = FullVectorStore(full_vectors_path(physical))
+        try:
+            store.backup(out / FULL_VECTORS)
+        finally:
+            store.close()
+
+    files = [RECORDS, VECTORS] + ([BM25] if has_bm25 else []) + ([FULL_VECTORS] if has_full else [])
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "collection": physical,
+        "count": total,
+        "dimension": dimension,
+        "dtype": "float32",
+        "collection_metadata": collection.metadata or {},
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "files": {name: _sha256(out / name) for name in files},
+    }
+    (out / MANIFEST).write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    logger.info(f"集合 {physical} 已导出到 {out}：{total} 个块，维度 {dimension}")
+    return SnapshotReport(collection=physical, bundle=str(out), chunks=total, dimension=dimension,
+                          bm25=has_bm25, elapsed_s=time.perf_counter() - start)
+
+
+def verify_snapshot(bundle: str) -> Dict[str, Any]:
+    """检查格式版本与各文件的 sha256，返回 manifest"""
+    path = Path(bundle)
+    try:
+        manifest = json.loads((path / MANIFEST).read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        raise SnapshotError(f"{bundle} 下没有 {MANIFEST}")
+    if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+        raise SnapshotError(f"不支持的快照格式: {manifest.get('format')} v{manifest.get('version')}")
+    for name, checksum in manifest["files"].items():
+        if not (path / name).exists():
+            raise SnapshotError(f"快照缺少文件 {name}")
+        if _sha256(path / name) != checksum:
+            raise SnapshotError(f"快照文件 {name} 校验和不一致")
+    return manifest
+
+
+def import_snapshot(bundle: str, alias: str, batch_size: int = 5000, swap: bool = True,
+                    verify: bool = True) -> SnapshotReport:
+    """
+    把快照批量写入新的物理集合 <别名>__<时间戳>_<随机后缀>，块数校验通过后切换别名；全程不调用嵌入模型
+    :param batch_size: 每次 add 的块数，不超过 Chroma 允许的最大批次
+    :param swap: False 时只导入不切换别名
+    """
+    start = time.perf_counter()
+    path = Path(bundle)
+    manifest = verify_snapshot(bundle) if verify else json.loads((path / MANIFEST).read_text(encoding="utf-8"))
+    vectors = np.load(path / VECTORS, mmap_mode="r")
+    if vectors.shape != (manifest["count"], manifest["dimension"]):
+        raise SnapshotError(f"向量形状 {vectors.shape} 与 manifest 不一致")
+    batch_size = max(1, min(batch_size, get_chroma_client().get_max_batch_size()))
+
+    registry = get_alias_registry()
+    new_name = f"{alias}__{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    collection = get_chroma_collection(new_name, metadata=manifest.get("collection_metadata") or None)
+    try:
+        written = 0
+        with open(path / RECORDS, "r", encoding="utf-8") as records:
+            while True:
+                lines = list(islice(records, batch_size))
+                if not lines:
+                    break
+                rows = [json.loads(line) for line in lines]
+                collection.add(ids=[row["id"] for row in rows],
+                               embeddings=vectors[written:written + len(rows)],
+                               documents=[row["document"] for row in rows],
+                               metadatas=[row["metadata"] or None for row in rows])
+                written += len(rows)
+                logger.info(f"快照导入：已写入 {written}/{manifest['count']} 个块")
+        if written != manifest["count"] or collection.count() != manifest["count"]:
+            raise SnapshotError(f"块数校验失败: 写入 {written}，集合 {collection.count()}，期望 {manifest['count']}")
+        has_bm25 = BM25 in manifest["files"]
+        if has_bm25:
+            target = bm25_snapshot_path(new_name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path / BM25, target)
+        if FULL_VECTORS in manifest["files"]:
+            target = full_vectors_path(new_name)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(path / FULL_VECTORS, target)
+    except Exception:
+        logger.error(f"快照导入失败，删除未完成的集合 {new_name}")
+        delete_chroma_collection(new_name)
+        bm25_snapshot_path(new_name).unlink(missing_ok=True)
+        full_vectors_path(new_name).unlink(missing_ok=True)
+        raise
+
+    if swap:
+        registry.swap(alias, new_name)
+    return SnapshotReport(collection=new_name, bundle=str(path), chunks=written, dimension=manifest["dimension"],
+                          bm25=has_bm25, elapsed_s=time.perf_counter() - start, swapped=swap)
+
+
+def collection_ids(collection, batch_size: int = 5000) -> Iterator[str]:
+    """分页读出集合的全部块 id（不取正文与向量）"""
+    offset = 0
+    while True:
+        ids = collection.get(include=[], limit=batch_size, offset=offset)["ids"]
+        if not ids:
+            return
+        yield from ids
+        offset += len(ids)
+
+
+def load_bm25_snapshot(collection, collection_name: str) -> Optional[BM25Indexer]:
+    """
+    加载导入快照时留下的 BM25 索引；块数或块 id 集合的摘要与集合不一致（导入后又有增删，包括增删数量相同的情况）
+    时视为过期，返回 None 由调用方重新构建
+    """
+    path = bm25_snapshot_path(collection_name)
+    if not path.exists():
+        return None
+    indexer = BM25Indexer()
+    try:
+        count = indexer.load(str(path))
+    except Exception as e:
+        logger.warning(f"BM25 快照 {path} 加载失败，重新构建: {e}")
+        return None
+    if count != collection.count():
+        logger.info(f"BM25 快照 {path} 已过期（{count} != {collection.count()}），重新构建")
+        return None
+    if indexer.ids_digest != id_digest(collection_ids(collection)):
+        logger.info(f"BM25 快照 {path} 已过期（块 id 与集合不一致），重新构建")
+        return None
+    return indexer
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="知识库快照导出/导入")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export", help="导出集合到快照目录")
+    export.add_argument("--collection", required=True, help="集合名或别名")
+    export.add_argument("--out", required=True, help="快照目录")
+    export.add_argument("--batch-size", type=int, default=1000)
+    export.add_argument("--no-bm25", action="store_true", help="不导出 BM25 索引")
+    verify = sub.add_parser("verify", help="校验快照")
+    verify.add_argument("--bundle", required=True)
+    load = sub.add_parser("import", help="导入快照到新集合并切换别名")
+    load.add_argument("--bundle", required=True)
+    load.add_argument("--alias", required=True)
+    load.add_argument("--batch-size", type=int, default=5000)
+    load.add_argument("--no-swap", action="store_true", help="只导入，不切换别名")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        report = export_snapshot(args.collection, args.out, args.batch_size, include_bm25=not args.no_bm25)
+    elif args.command == "verify":
+        manifest = verify_snapshot(args.bundle)
+        print(f"快照校验通过：{manifest['collection']}，{manifest['count']} 个块，维度 {manifest['dimension']}")
+        return
+    else:
+        report = import_snapshot(args.bundle, args.alias, args.batch_size, swap=not args.no_swap)
+    print(json.dumps(asdict(report), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import re
-from typing import Literal, Sequence, Any
+from functools import partial
+from typing import Literal, Sequence, Any, Optional, List
 import json
 
+from langchain_core.documents import Document
 from langchain_experimental.text_splitter import SemanticChunker
 from langchain_text_splitters import (
     HTMLHeaderTextSplitter,
@@ -17,6 +19,7 @@ try:
 except Exception:
     default_embedder = None  # 允许外部注入
     FILE_PATH = "../../file"
+from agent.utils.token_utils import DEFAULT_ENCODING, count_tokens
 
 # 统一的分隔符配置
 DEFAULT_SEPARATORS: list[str] = [
@@ -48,20 +51,28 @@ DEFAULT_HTML_HEADERS = [
     ("h3", "小点 3"),
     ("h4", "子点 4"),
 ]
+# clean_text 的清洗规则（模块加载时预编译）
+_NEWLINES_RE = re.compile(r"\n+")
+_EXTRA_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
 class TextSplitter:
     """
     多策略分割器封装，统一暴露 split_text / split_documents。
-    - strategy（mode）描述“怎么切”：semantic / recursive
+    - strategy（mode）描述“怎么切”：semantic / recursive / token
+        * token 模式与 recursive 相同，但 chunk_size/chunk_overlap 按 token 计数（tiktoken）
     - file_type 仅做文件类型提示：
-        * markdown/html 自动走标题切分
+        * markdown/html 自动走标题切分，超过 chunk_size 的标题小节会继续递归切分
         * 其它（txt/json/csv/word/pdf等）默认递归字符切分
     """
 
     def __init__(
         self,
-        mode: Literal["semantic", "recursive"] | None = "recursive",
+        mode: Literal["semantic", "recursive", "token", "markdown", "html"] | None = "recursive",
         *,
         file_type: Optional[str] = None,
+        length_unit: Literal["char", "token"] | None = None,
+        encoding_name: str = DEFAULT_ENCODING,
         embedder=None,
         chunk_size: int = 200,
         chunk_overlap: int = 20,
@@ -71,8 +82,10 @@ class TextSplitter:
     ):
         """
         初始化分割器，根据mode选择对应的分割器
-        :param mode: 分割策略["semantic", "recursive"]；None 则依据 file_type 推断,markdown/html 自动走标题切分
+        :param mode: 分割策略["semantic", "recursive", "token"]；None 则依据 file_type 推断,markdown/html 自动走标题切分
         :param file_type: 文件类型提示（如 "txt" / "json" / "md" / "html" / "pdf" 等），md/html 自动走标题切分
+        :param length_unit: 块大小的计量单位 char/token，默认 token 模式按 token，其余按字符
+        :param encoding_name: token 计数使用的 tiktoken 编码
         :param embedder: 语义模型
         :param chunk_size: 块大小
         :param chunk_overlap: 块重叠
@@ -97,8 +110,12 @@ class TextSplitter:
         self.chunk_overlap = chunk_overlap
         self.markdown_headers = markdown_headers or DEFAULT_MARKDOWN_HEADERS
         self.html_headers = html_headers or DEFAULT_HTML_HEADERS
+        self.length_unit = length_unit or ("token" if self.mode == "token" else "char")
+        self.encoding_name = encoding_name
 
         self.splitter = self._create_splitter() # 创建对应的分割器
+        # 标题切分后对超长小节做二次递归切分，保证每个块都在 chunk_size 以内
+        self.section_splitter = self._create_recursive_splitter() if self.mode in {"markdown", "html"} else None
 
     # ============ 公共方法 ============
     def split_text(self, text: str) -> List[Document]: # 输入纯文本，输出 Document 列表。
@@ -108,8 +125,8 @@ class TextSplitter:
         if self.mode in {"semantic"}:
             return self.splitter.create_documents([text]) # 直接返回 SemanticChunker 的结果
         if self.mode in {"markdown", "html"}:
-            return self.splitter.split_text(text) # 按照标题和段落分割
-        # 默认recursive模式分割
+            return self._cap_sections(self.splitter.split_text(text)) # 按照标题和段落分割
+        # 默认recursive/token模式分割
         chunks = self.splitter.split_text(text) # 这里是其它情况都不满足默认使用递归分割
         return [Document(page_content=chunk) for chunk in chunks] # 强制转换为document
 
@@ -132,14 +149,14 @@ class TextSplitter:
                     d.metadata.setdefault("source", source)
             return semantic_docs
 
-        if self.mode == "recursive":
+        if self.mode in {"recursive", "token"}:
             return self.splitter.split_documents(docs) # 按照递归分块
 
         if self.mode in {"markdown", "html"}:
             # 合并所有文档内容，用双换行符保持文档间的分隔
             combined_text = "\n\n".join(self._ensure_text(doc.page_content) for doc in docs)
             # 对合并后的文本进行分割
-            split_docs = self.splitter.split_text(combined_text)
+            split_docs = self._cap_sections(self.splitter.split_text(combined_text))
             # 保留原始文档的 metadata
             source = docs[0].metadata.get("source") if docs[0].metadata else None
             if source:
@@ -155,14 +172,8 @@ class TextSplitter:
                 raise ValueError("语义分块需要提供嵌入模型embedder")
             return SemanticChunker(self.embedder, breakpoint_threshold_type="percentile")
 
-        if self.mode == "recursive":
-            return RecursiveCharacterTextSplitter(
-                chunk_size=self.chunk_size,
-                chunk_overlap=self.chunk_overlap,
-                length_function=len,
-                separators=self.separators,
-                is_separator_regex=False,
-            )
+        if self.mode in {"recursive", "token"}:
+            return self._create_recursive_splitter()
 
         if self.mode == "markdown":
             return MarkdownHeaderTextSplitter(self.markdown_headers)
@@ -171,6 +182,35 @@ class TextSplitter:
             return HTMLHeaderTextSplitter(self.html_headers)
 
         raise ValueError(f"不支持的该分割模式:{self.mode}")
+
+    def _create_recursive_splitter(self) -> RecursiveCharacterTextSplitter:
+        return RecursiveCharacterTextSplitter(
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            length_function=self.length_function,
+            separators=self.separators,
+            is_separator_regex=False,
+        )
+
+    @property
+    def length_function(self):
+        """块大小的计量函数：char 直接用 len，token 用 count_tokens（编码文件不可用时退化为近似计数）"""
+        if self.length_unit == "char":
+            return len
+        if self.length_unit == "token":
+            return partial(count_tokens, encoding_name=self.encoding_name)
+        raise ValueError(f"不支持的长度单位:{self.length_unit}")
+
+    def _cap_sections(self, sections: List[Document]) -> List[Document]:
+        """标题小节超过 chunk_size 时递归切分，小节的标题 metadata 会带到每个子块上；每个小节只计量一次长度"""
+        length = self.length_function
+        capped: List[Document] = []
+        for section in sections:
+            if length(section.page_content) <= self.chunk_size:
+                capped.append(section)
+            else:
+                capped.extend(self.section_splitter.split_documents([section]))
+        return capped
     @staticmethod
     def _ensure_text(content: Any) -> str:
         """确保内容为字符串，处理 JSONLoader 返回的 dict/list 场景。"""
@@ -191,13 +231,12 @@ class TextSplitter:
         return chunk_list
     @staticmethod
     def clean_text(text: str) -> str:  # 清洗不必要的文本换行符
-        """清理文本，去除多余的空白字符"""
-        # 去除多余的换行符
-        text = re.sub(r'\n+', '\n', text)
-        # 去除行首行尾的空白
-        text = '\n'.join(line.strip() for line in text.split('\n'))
-        # 去除段落间的多余空格
-        text = re.sub(r'\n\s*\n', '\n\n', text)
+        """清理文本，去除多余的空白字符：合并多余换行、去掉行首行尾空白、保留段落分隔"""
+        # 合并连续换行后再逐行去掉首尾空白，split/strip/join 都在 C 层完成
+        text = '\n'.join(line.strip() for line in _NEWLINES_RE.sub('\n', text).split('\n'))
+        # 仅含空白的行被清空后可能出现连续空行，压缩为一个段落分隔
+        if '\n\n\n' in text:
+            text = _EXTRA_BLANK_LINES_RE.sub('\n\n', text)
         return text
 
 
@@ -0,0 +1,76 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+# 当前请求的阶段计时器：通过 ContextVar 传递，异步任务与 copy_context 后的线程都能拿到同一个计时器
+_current_timer: ContextVar[Optional["StageTimer"]] = ContextVar("rag_stage_timer", default=None)
+
+
+class StageTimer:
+    """
+    记录一次检索请求中各阶段的耗时（毫秒），阶段名如 embed / dense / bm25 / keyword / fusion / fetch / rerank
+    - 同一阶段执行多次时累加
+    - 多路召回在线程池中并发执行，写入时加锁
+    - paths 记录有分支的阶段实际走了哪条路径，如 {"rerank": "timeout_fallback"}
+    用法：
+        with StageTimer() as timer:
+            engine.query_hybrid_search(question, top_k=10)
+        print(timer.stages)
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.paths: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._token = None
+        self._start = 0.0
+        self.total_ms = 0.0
+
+    def add(self, name: str, elapsed_ms: float) -> None:
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed_ms
+
+    def mark(self, name: str, path: str) -> None:
+        self.paths[name] = path
+
+    def __enter__(self) -> "StageTimer":
+        self._token = _current_timer.set(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.total_ms = (time.perf_counter() - self._start) * 1000
+        _current_timer.reset(self._token)
+        self._token = None
+        return False
+
+
+def current_timer() -> Optional[StageTimer]:
+    """返回当前上下文中的计时器，没有开启计时时为 None"""
+    return _current_timer.get()
+
+
+def mark_path(name: str, path: str) -> None:
+    """记录当前请求某个阶段走的路径，没有开启计时时忽略"""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.mark(name, path)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    统计一个阶段的耗时，写入当前上下文的 StageTimer；
+    没有开启计时时只多一次 ContextVar 读取，可以放在热路径上
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, (time.perf_counter() - start) * 1000)
@@ -0,0 +1,243 @@
+"""
+分块与检索参数调优：
+    python -m agent.rag.tune --corpus ./data/sample --queries queries.jsonl --collection my_vector
+    python -m agent.rag.tune --corpus ./data/sample --queries queries.jsonl --collection my_vector --write
+
+按候选分块方案（chunk_size × chunk_overlap）把样本语料重新切分写入临时集合，嵌入走磁盘缓存（embed_cache.py），
+不同方案切出的相同块与所有方案共用的评测问题只请求一次嵌入服务。每个分块方案再按检索参数网格评测：
+- vector：min_similarity；hybrid：alpha（dense 权重，bm25 为 1-alpha）× RRF 常数 K；两者都再乘以重排序分数阈值
+- 召回为打包进上下文的块覆盖的相关来源比例（重新切分后 chunk id 不再有效，一律按来源文件判定），另记录 MRR
+- token 成本为打包（去重、合并相邻块、[rag.budget] 预算内）后上下文 token 数的均值，延迟为单次检索的 p50/p95
+  （评测前先把问题整体嵌入一遍写入缓存，各组合的延迟不含嵌入请求，可以横向比较）
+在 召回-token 成本 的 Pareto 前沿上，取召回与最高值相差不超过 --tolerance 的组合中 token 最少的，
+--write 时写回 config.toml 的 [rag.profile.<集合>]（分块与阈值）与 [rag.fusion.<集合>]（K 与权重，选中 hybrid 时）。
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from agent.config.config import update_config_section
+from agent.config.log import logger
+from agent.rag.RagEngine import RagEngine
+from agent.rag.alias import iter_file_documents
+from agent.rag.benchmark import LabeledQuery, load_query_set, recall_at_k, reciprocal_rank
+from agent.rag.database import delete_chroma_collection
+from agent.rag.embed_cache import CachedEmbeddings
+from agent.rag.hierarchy import doc_index_name
+
+PERCENTILES = (50, 95)
+
+
+def source_queries(queries: Sequence[LabeledQuery]) -> List[LabeledQuery]:
+    """只保留标注了来源文件的问题，并去掉 chunk id 标注（重新切分后失效）"""
+    kept = [LabeledQuery(query.qid, query.question, sources=list(query.sources)) for query in queries if query.sources]
+    if len(kept) < len(queries):
+        logger.warning(f"参数调优：{len(queries) - len(kept)} 个问题只标注了 chunk id，重新切分后无法判定，已跳过")
+    return kept
+
+
+def chunking_grid(sizes: Sequence[int], overlaps: Sequence[int]) -> List[Dict[str, int]]:
+    return [{"chunk_size": size, "chunk_overlap": overlap} for size in sizes for overlap in overlaps if overlap < size]
+
+
+def retrieval_grid(strategies: Sequence[str], min_similarities: Sequence[float], alphas: Sequence[float],
+                   ks: Sequence[int]) -> List[Dict[str, Any]]:
+    """检索参数组合（重排序阈值只影响打包，在同一次检索结果上分别计算，不在这里展开）"""
+    grid: List[Dict[str, Any]] = []
+    if "vector" in strategies:
+        grid += [{"strategy": "vector", "min_similarity": similarity} for similarity in min_similarities]
+    if "hybrid" in strategies:
+        grid += [{"strategy": "hybrid", "alpha": alpha, "K": k} for alpha in alphas for k in ks]
+    return grid
+
+
+def evaluate(engine: RagEngine, queries: Sequence[LabeledQuery], params: Dict[str, Any], thresholds: Sequence[float],
+             top_k: int, use_rerank: bool, rerank_top_n: int) -> List[Dict[str, Any]]:
+    """在一个分块方案的集合上评测一组检索参数，每个重排序阈值产出一行"""
+    hybrid = params["strategy"] == "hybrid"
+    if hybrid:
+        engine.fusion_config.K = params["K"]
+    else:
+        engine.vector_config.min_similarity = params["min_similarity"]
+    outcomes, latencies = [], []
+    for query in queries:
+        outcome = engine.retrieve(query.question, top_k=top_k, use_hybrid=hybrid, alpha=params.get("alpha"),
+                                  use_rerank=use_rerank, rerank_top_n=rerank_top_n)
+        outcomes.append(outcome)
+        latencies.append(outcome.elapsed_ms)
+    latency = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))}
+    rows = []
+    for threshold in thresholds:
+        engine.profile.rerank_threshold = threshold
+        recalls, rrs, tokens = [], [], []
+        for query, outcome in zip(queries, outcomes):
+            packed = engine.pack_outcome(outcome)
+            units = [os.path.basename(chunk.source) for chunk in packed]
+            recalls.append(recall_at_k(units, query.relevant, len(units)))
+            rrs.append(reciprocal_rank(units, query.relevant))
+            tokens.append(sum(chunk.token_count for chunk in packed))
+        rows.append({**params, "rerank_threshold": threshold, "recall": round(float(np.mean(recalls)), 4),
+                     "mrr": round(float(np.mean(rrs)), 4), "tokens": round(float(np.mean(tokens)), 1), **latency})
+    return rows
+
+
+def tune(corpus: str, queries: Sequence[LabeledQuery], embedding_model, reranker=None, mode: str = "recursive",
+         chunkings: Sequence[Dict[str, int]] = (), retrievals: Sequence[Dict[str, Any]] = (),
+         thresholds: Sequence[float] = (0.1,), top_k: int = 10, rerank_top_n: int = 3) -> List[Dict[str, Any]]:
+    """
+    逐个分块方案建临时集合并评测全部检索参数，评测完立即删除集合
+    :param embedding_model: 建议传入 CachedEmbeddings，重复的块与问题不再请求嵌入服务
+    """
+    rows: List[Dict[str, Any]] = []
+    embedding_model.embed_documents([query.question for query in queries])  # 问题先整体嵌入，写入缓存
+    for chunking in chunkings:
+        name = f"tune_{uuid.uuid4().hex[:8]}"
+        engine = RagEngine(collection_name=name, **chunking)
+        engine.embedding_model = embedding_model
+        engine.reranker = reranker
+        try:
+            start = time.perf_counter()
+            chunks = engine.embed_stream(iter_file_documents(corpus, mode, **chunking))
+            ingest_s = round(time.perf_counter() - start, 2)
+            for params in retrievals:
+                for row in evaluate(engine, queries, params, thresholds, top_k, reranker is not None, rerank_top_n):
+                    row = {**chunking, "chunks": chunks, "ingest_s": ingest_s, **row}
+                    rows.append(row)
+                    logger.info(f"参数调优: {row}")
+        finally:
+            engine.cleanup()
+            delete_chroma_collection(name)
+            if engine.hierarchy_config.enabled:
+                delete_chroma_collection(doc_index_name(name))
+    return rows
+
+
+def pareto_front(rows: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """召回不低于且 token 不高于（至少一项严格更优）的组合不存在时，该组合在前沿上"""
+    def dominated(row):
+        return any(other["recall"] >= row["recall"] and other["tokens"] <= row["tokens"] and
+                   (other["recall"] > row["recall"] or other["tokens"] < row["tokens"]) for other in rows)
+    return sorted((row for row in rows if not dominated(row)), key=lambda row: row["tokens"])
+
+
+def choose(front: Sequence[Dict[str, Any]], tolerance: float) -> Dict[str, Any]:
+    """召回与前沿最高召回相差不超过 tolerance 的组合中 token 最少的，同 token 时取 p95 低的"""
+    best_recall = max(row["recall"] for row in front)
+    return min((row for row in front if row["recall"] >= best_recall - tolerance),
+               key=lambda row: (row["tokens"], row["p95"]))
+
+
+def profile_sections(collection: str, best: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """选中的组合对应要写入 config.toml 的各节"""
+    profile = {"chunk_size": best["chunk_size"], "chunk_overlap": best["chunk_overlap"],
+               "rerank_threshold": best["rerank_threshold"]}
+    sections = {f"rag.profile.{collection}": profile}
+    if best["strategy"] == "vector":
+        profile["min_similarity"] = best["min_similarity"]
+    else:
+        sections[f"rag.fusion.{collection}"] = {"K": best["K"], "dense": best["alpha"],
+                                                "bm25": round(1.0 - best["alpha"], 4)}
+    return sections
+
+
+def format_rows(rows: Sequence[Dict[str, Any]], front: Sequence[Dict[str, Any]], best: Dict[str, Any]) -> str:
+    on_front = {id(row) for row in front}
+    lines = [f"{'size':>5} {'ovl':>4} {'chunks':>6} {'strategy':<8} {'param':<14} {'rr_thr':>6} "
+             f"{'recall':>7} {'mrr':>6} {'tokens':>7} {'p50ms':>8} {'p95ms':>8}"]
+    for row in rows:
+        param = f"sim={row['min_similarity']}" if row["strategy"] == "vector" else f"a={row['alpha']},K={row['K']}"
+        mark = "*" if row is best else ("+" if id(row) in on_front else " ")
+        lines.append(f"{row['chunk_size']:>5} {row['chunk_overlap']:>4} {row['chunks']:>6} {row['strategy']:<8} "
+                     f"{param:<14} {row['rerank_threshold']:>6} {row['recall']:>7.4f} {row['mrr']:>6.3f} "
+                     f"{row['tokens']:>7.1f} {row['p50']:>8.2f} {row['p95']:>8.2f} {mark}")
+    lines.append("+ Pareto 前沿（召回-token）   * 选中的组合")
+    return "\n".join(lines)
+
+
+def _ints(text: str) -> List[int]:
+    return [int(x) for x in text.split(",") if x.strip()]
+
+
+def _floats(text: str) -> List[float]:
+    return [float(x) for x in text.split(",") if x.strip()]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="分块与检索参数调优（召回-token 成本-延迟）")
+    parser.add_argument("--corpus", required=True, help="样本语料目录或文件")
+    parser.add_argument("--queries", required=True, help="JSONL 标注集（需标注 sources）")
+    parser.add_argument("--collection", required=True, help="选中的方案写入该集合的 [rag.profile.<集合>]")
+    parser.add_argument("--mode", default="recursive", help="切分模式，与入库时一致")
+    parser.add_argument("--chunk-sizes", default="200,400,800")
+    parser.add_argument("--chunk-overlaps", default="0,20,50")
+    parser.add_argument("--strategies", default="vector,hybrid")
+    parser.add_argument("--min-similarities", default="0.2,0.3,0.4")
+    parser.add_argument("--alphas", default="0.4,0.6,0.8")
+    parser.add_argument("--ks", default="20,60", help="RRF 常数 K 的候选值")
+    parser.add_argument("--rerank-thresholds", default="0.05,0.1,0.2", help="重排序分数阈值（未配置重排序时只取第一个）")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--rerank-top-n", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.01, help="允许比最高召回低多少来换更少的 token")
+    parser.add_argument("--write", action="store_true", help="把选中的方案写回 config.toml")
+    parser.add_argument("--output", default=None, help="调优结果 JSON 输出路径")
+    parser.add_argument("--cache", default=None, help="嵌入缓存路径，默认 DB_PATH/embedding_cache.sqlite3")
+    parser.add_argument("--embedding-url", default=None, help="嵌入服务地址，默认使用配置中的嵌入模型")
+    parser.add_argument("--rerank-url", default=None, help="重排序服务地址，默认使用配置中的重排序模型")
+    parser.add_argument("--api-key", default="EMPTY")
+    parser.add_argument("--no-rerank", action="store_true", help="不使用重排序")
+    args = parser.parse_args(argv)
+
+    queries = source_queries(load_query_set(args.queries))
+    if not queries:
+        parser.error("标注集中没有标注 sources 的问题")
+    if args.embedding_url:
+        from agent.model import EmbeddingModel
+        base_model = EmbeddingModel(api_url=args.embedding_url, api_key=args.api_key, request_interval=0)
+    else:
+        from agent.rag.instance import embedder as base_model
+    reranker = None
+    if not args.no_rerank:
+        if args.rerank_url:
+            from agent.model import RerankModel
+            reranker = RerankModel(api_url=args.rerank_url, api_key=args.api_key)
+        else:
+            from agent.rag.instance import reranker
+    thresholds = _floats(args.rerank_thresholds)
+    if reranker is None:
+        thresholds = thresholds[:1]  # 不重排序时阈值不起作用
+    strategies = [s.strip() for s in args.strategies.split(",") if s.strip()]
+
+    cached = CachedEmbeddings(base_model, path=args.cache)
+    try:
+        rows = tune(args.corpus, queries, cached, reranker, args.mode,
+                    chunking_grid(_ints(args.chunk_sizes), _ints(args.chunk_overlaps)),
+                    retrieval_grid(strategies, _floats(args.min_similarities), _floats(args.alphas), _ints(args.ks)),
+                    thresholds, args.top_k, args.rerank_top_n)
+    finally:
+        cached.close()
+    if not rows:
+        parser.error("没有可评测的参数组合")
+    front = pareto_front(rows)
+    best = choose(front, args.tolerance)
+    print(format_rows(rows, front, best))
+    print(f"嵌入缓存: {cached.stats()}")
+    sections = profile_sections(args.collection, best)
+    if args.write:
+        for section, values in sections.items():
+            update_config_section(section, values)
+        print(f"已写入 config.toml: {sections}（新的分块大小对重新入库/别名重建后的数据生效）")
+    report = {"queries": len(queries), "rows": rows, "pareto": front, "best": best, "profile": sections,
+              "cache": cached.stats()}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    return report
+
+
+if __name__ == "__main__":
+    main()
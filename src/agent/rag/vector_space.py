@@ -0,0 +1,58 @@
+from typing import Any, Dict, Sequence
+
+import numpy as np
+
+SPACES = ("cosine", "ip", "l2")
+DEFAULT_SPACE = "l2"  # 创建时未指定 hnsw:space 的集合使用 Chroma 的默认 L2 空间
+DIMENSIONS_KEY = "matryoshka:dimensions"  # 集合存放截断向量时记录截断维度，全维向量另存（见 matryoshka.py）
+
+
+def collection_metadata(space: str, hnsw=None, dimensions: int = 0) -> Dict[str, Any]:
+    """
+    新建集合时的 metadata（距离空间、HNSW 参数与截断维度，hnsw 为 RagHnswConfig），只在集合首次创建时生效
+    :param dimensions: 大于 0 时集合存放截断到该维度的向量
+    """
+    if space not in SPACES:
+        raise ValueError(f"未知的向量空间: {space}，可选 {SPACES}")
+    metadata = {"hnsw:space": space}
+    if hnsw is not None:
+        metadata.update({"hnsw:M": hnsw.m, "hnsw:construction_ef": hnsw.construction_ef,
+                         "hnsw:search_ef": hnsw.search_ef})
+    if dimensions > 0:
+        metadata[DIMENSIONS_KEY] = int(dimensions)
+    return metadata
+
+
+def collection_space(collection) -> str:
+    """集合实际使用的距离空间（以创建时的 metadata 为准）"""
+    return (collection.metadata or {}).get("hnsw:space", DEFAULT_SPACE)
+
+
+def collection_dimensions(collection) -> int:
+    """集合存放的截断维度（以创建时的 metadata 为准），0 表示存放全维向量"""
+    return int((collection.metadata or {}).get(DIMENSIONS_KEY, 0))
+
+
+def normalize_embeddings(embeddings: Sequence[Any]) -> np.ndarray:
+    """一次矩阵运算把整批向量 L2 归一化（零向量保持不变），返回 float32 矩阵"""
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def truncate_embeddings(embeddings: Sequence[Any], dimensions: int) -> np.ndarray:
+    """Matryoshka 截断：取每个向量的前 dimensions 维后重新 L2 归一化（截断后的范数不再为 1）"""
+    return normalize_embeddings(np.asarray(embeddings, dtype=np.float32)[..., :dimensions])
+
+
+def distance_to_similarity(distances: Sequence[float], space: str) -> np.ndarray:
+    """
+    把 Chroma 返回的距离换算为相似度（1 为完全相同），阈值统一按相似度表达：
+    - cosine：距离 = 1 - cos
+    - ip：距离 = 1 - 点积，向量归一化后与 cosine 相同
+    - l2：距离为欧氏距离的平方，向量归一化后 = 2 - 2cos
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    if space == "l2":
+        return 1.0 - distances / 2.0
+    return 1.0 - distances
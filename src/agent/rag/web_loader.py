@@ -0,0 +1,305 @@
+"""
+网页异步批量抓取与增量刷新：
+    python -m agent.rag.web_loader --url https://docs.example.com/guide/ --crawl --collection my_vector
+    python -m agent.rag.web_loader --urls urls.txt --collection my_vector --css-selector md-content
+
+- 一次抓取共用一个 httpx.AsyncClient 连接池（长连接复用），全局最多 concurrency 个并发请求，每个主机最多 per_host 个
+- 响应缓存在 DB_PATH/web_cache.sqlite3（ETag / Last-Modified / 正文哈希 / 压缩后的原始响应），再次抓取时带
+  If-None-Match / If-Modified-Since 条件请求，304 直接使用缓存；服务端不支持条件请求时按抽取后正文的哈希判断是否变化
+- crawl 从起始页面广度优先发现同主机、同路径前缀的链接，最多抓取 max_pages 个页面（304 的页面从缓存中取链接）
+只有新增或正文变化的页面需要重新切分与嵌入（见 RagEngine.refresh_web_pages）。
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+import httpx
+from bs4 import BeautifulSoup
+from langchain_core.documents import Document
+from loguru import logger
+
+from agent.config import DB_PATH
+from agent.config.config import RagWebConfig, load_rag_web
+
+DEFAULT_CACHE_PATH = Path(DB_PATH) / "web_cache.sqlite3"
+_RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+# 页面状态：new / changed 需要（重新）嵌入，其余不需要
+PAGE_NEW = "new"
+PAGE_CHANGED = "changed"
+PAGE_UNCHANGED = "unchanged"  # 200，但抽取后的正文与缓存一致
+PAGE_NOT_MODIFIED = "not_modified"  # 304，直接使用缓存
+PAGE_FAILED = "failed"
+
+
+@dataclass
+class CachedPage:
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content_hash: str
+    body: bytes
+    encoding: Optional[str]
+
+
+@dataclass
+class WebPage:
+    url: str
+    status: str
+    document: Optional[Document] = None
+    links: List[str] = field(default_factory=list)
+    error: str = ""
+
+    @property
+    def changed(self) -> bool:
+        return self.status in (PAGE_NEW, PAGE_CHANGED)
+
+
+@dataclass
+class WebRefreshReport:
+    pages: int
+    new: int
+    changed: int
+    unchanged: int
+    failed: int
+    chunks: int
+    elapsed_s: float
+
+
+def summarize(pages: Sequence[WebPage], chunks: int, elapsed_s: float) -> WebRefreshReport:
+    counts = {status: 0 for status in (PAGE_NEW, PAGE_CHANGED, PAGE_UNCHANGED, PAGE_NOT_MODIFIED, PAGE_FAILED)}
+    for page in pages:
+        counts[page.status] += 1
+    return WebRefreshReport(pages=len(pages), new=counts[PAGE_NEW], changed=counts[PAGE_CHANGED],
+                            unchanged=counts[PAGE_UNCHANGED] + counts[PAGE_NOT_MODIFIED], failed=counts[PAGE_FAILED],
+                            chunks=chunks, elapsed_s=round(elapsed_s, 3))
+
+
+class WebCache:
+    """url -> 校验头、正文哈希与压缩后的原始响应，SQLite 存储，可在线程池中并发读写"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = Path(path) if path else DEFAULT_CACHE_PATH
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, "
+                           "content_hash TEXT NOT NULL, body BLOB NOT NULL, encoding TEXT, fetched_at REAL)")
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> Optional[CachedPage]:
+        with self._lock:
+            row = self._conn.execute("SELECT etag, last_modified, content_hash, body, encoding FROM pages WHERE url = ?",
+                                     (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_hash, body, encoding = row
+        return CachedPage(url, etag, last_modified, content_hash, zlib.decompress(body), encoding)
+
+    def put(self, page: CachedPage) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (page.url, page.etag, page.last_modified, page.content_hash, zlib.compress(page.body),
+                                page.encoding, time.time()))
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def normalize_url(url: str) -> str:
+    """去掉锚点，同一页面的不同锚点只抓取一次"""
+    return urldefrag(url.strip())[0]
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def parse_page(url: str, body: bytes, encoding: Optional[str] = None, css_selector: Optional[str] = None,
+               base_url: Optional[str] = None) -> Tuple[Document, List[str]]:
+    """
+    抽取正文与链接：css_selector 为 class 名时只取这些元素的文本（与 load_web_page 一致），链接取自整个页面。
+    metadata 与 WebBaseLoader 一致：source / title / description / language
+    """
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding)
+    links = [urljoin(base_url or url, a["href"]) for a in soup.find_all("a", href=True)]
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    regions = soup.find_all(class_=css_selector) if css_selector else [soup]
+    lines = (line.strip() for region in regions for line in region.get_text("\n").splitlines())
+    metadata = {"source": url}
+    if soup.title and soup.title.string:
+        metadata["title"] = soup.title.string.strip()
+    description = soup.find("meta", attrs={"name": "description"})
+    if description and description.get("content"):
+        metadata["description"] = description["content"].strip()
+    if soup.html and soup.html.get("lang"):
+        metadata["language"] = soup.html["lang"]
+    return Document(page_content="\n".join(line for line in lines if line), metadata=metadata), links
+
+
+class AsyncWebLoader:
+    """
+    并发抓取网页：共享连接池、全局与按主机的并发上限、条件请求与磁盘缓存、传输错误与 429/5xx 指数退避重试。
+    作为 async 上下文管理器使用，一次抓取共用一个客户端：
+        async with AsyncWebLoader() as loader:
+            pages = await loader.crawl(["https://docs.example.com/"])
+    """
+
+    def __init__(self, config: Optional[RagWebConfig] = None, cache: Optional[WebCache] = None,
+                 css_selector: Optional[str] = None):
+        self.config = config or load_rag_web()
+        self.cache = cache or WebCache()
+        self.css_selector = css_selector
+        self._client: Optional[httpx.AsyncClient] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._hosts: Dict[str, asyncio.Semaphore] = {}
+
+    async def __aenter__(self):
+        config = self.config
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(config.timeout_s, connect=config.connect_timeout_s),
+            limits=httpx.Limits(max_connections=config.concurrency, max_keepalive_connections=config.concurrency),
+            headers={"User-Agent": config.user_agent},
+            follow_redirects=True,
+        )
+        self._slots = asyncio.Semaphore(config.concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._client.aclose()
+        self._client = None
+        return False
+
+    async def _request(self, url: str, headers: Dict[str, str]) -> httpx.Response:
+        host = self._hosts.setdefault(urlsplit(url).netloc, asyncio.Semaphore(self.config.per_host))
+        for attempt in range(self.config.retries + 1):
+            try:
+                async with host, self._slots: # 先占主机名额，排队等同一主机时不占用全局名额
+                    response = await self._client.get(url, headers=headers)
+                if response.status_code not in _RETRY_STATUS or attempt >= self.config.retries:
+                    return response
+                reason = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                if attempt >= self.config.retries:
+                    raise
+                reason = type(e).__name__
+            delay = self.config.retry_backoff_s * (2 ** attempt)
+            logger.warning(f"抓取 {url} 失败({reason})，{delay:.2f}s 后第 {attempt + 1} 次重试")
+            await asyncio.sleep(delay)
+
+    async def fetch(self, url: str) -> WebPage:
+        """抓取单个页面；有缓存时发条件请求，解析在线程池中进行，不阻塞事件循环"""
+        try:
+            cached = await asyncio.to_thread(self.cache.get, url)
+            headers = {}
+            if cached is not None and cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached is not None and cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+            response = await self._request(url, headers)
+            if response.status_code == 304 and cached is not None:
+                document, links = await asyncio.to_thread(parse_page, url, cached.body, cached.encoding,
+                                                          self.css_selector)
+                return WebPage(url, PAGE_NOT_MODIFIED, document, links)
+            response.raise_for_status()
+            base_url = str(response.url)
+            document, links = await asyncio.to_thread(parse_page, url, response.content, response.encoding,
+                                                      self.css_selector, base_url)
+            content_hash = _text_hash(document.page_content)
+            if cached is None:
+                status = PAGE_NEW
+            else:
+                status = PAGE_UNCHANGED if cached.content_hash == content_hash else PAGE_CHANGED
+            await asyncio.to_thread(self.cache.put, CachedPage(
+                url, response.headers.get("ETag"), response.headers.get("Last-Modified"), content_hash,
+                response.content, response.encoding))
+            return WebPage(url, status, document, links)
+        except Exception as e:
+            logger.warning(f"抓取 {url} 失败: {e}")
+            return WebPage(url, PAGE_FAILED, error=str(e))
+
+    async def load(self, urls: Iterable[str]) -> List[WebPage]:
+        """并发抓取给定的页面，结果按去重后的输入顺序返回"""
+        urls = list(dict.fromkeys(normalize_url(url) for url in urls))
+        return list(await asyncio.gather(*(self.fetch(url) for url in urls)))
+
+    async def crawl(self, start_urls: Iterable[str], max_pages: Optional[int] = None) -> List[WebPage]:
+        """
+        从起始页面广度优先抓取同主机、以起始页面所在目录为前缀的链接，页面一返回就调度它的新链接，
+        最多抓取 max_pages（默认 [rag.web] max_pages）个页面
+        """
+        max_pages = max_pages or self.config.max_pages
+        starts = list(dict.fromkeys(normalize_url(url) for url in start_urls))
+        prefixes = [url.rsplit("/", 1)[0] + "/" for url in starts]
+        seen = set(starts[:max_pages])
+        pending = {asyncio.create_task(self.fetch(url)) for url in starts[:max_pages]}
+        pages: List[WebPage] = []
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                page = task.result()
+                pages.append(page)
+                for link in map(normalize_url, page.links):
+                    if len(seen) >= max_pages:
+                        break
+                    if link not in seen and any(link.startswith(prefix) for prefix in prefixes):
+                        seen.add(link)
+                        pending.add(asyncio.create_task(self.fetch(link)))
+        return pages
+
+
+async def fetch_web_pages(urls: Iterable[str], crawl: bool = False, css_selector: Optional[str] = None,
+                          max_pages: Optional[int] = None, config: Optional[RagWebConfig] = None,
+                          cache: Optional[WebCache] = None) -> List[WebPage]:
+    """抓取（crawl 时从这些页面出发发现同站链接）并返回全部页面及其状态"""
+    async with AsyncWebLoader(config, cache, css_selector) as loader:
+        if crawl:
+            return await loader.crawl(urls, max_pages)
+        return await loader.load(urls)
+
+
+def _read_urls(args) -> List[str]:
+    urls = list(args.url or [])
+    if args.urls:
+        urls += [line.strip() for line in Path(args.urls).read_text(encoding="utf-8").splitlines()
+                 if line.strip() and not line.startswith("#")]
+    return urls
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="网页异步抓取与增量入库")
+    parser.add_argument("--url", action="append", help="起始页面，可重复")
+    parser.add_argument("--urls", default=None, help="每行一个 url 的文件")
+    parser.add_argument("--crawl", action="store_true", help="从起始页面发现同站、同路径前缀的链接")
+    parser.add_argument("--max-pages", type=int, default=None, help="crawl 最多抓取的页面数，默认 [rag.web] max_pages")
+    parser.add_argument("--css-selector", default=None, help="只取该 class 元素内的文本")
+    parser.add_argument("--collection", default=None, help="把新增/变化的页面写入该集合；不指定时只抓取并更新缓存")
+    args = parser.parse_args(argv)
+    urls = _read_urls(args)
+    if not urls:
+        parser.error("需要 --url 或 --urls")
+
+    if args.collection:
+        from agent.rag.RagEngine import RagEngine
+        with RagEngine(collection_name=args.collection) as engine:
+            report = engine.refresh_web_pages(urls, crawl=args.crawl, css_selector=args.css_selector,
+                                              max_pages=args.max_pages)
+    else:
+        start = time.perf_counter()
+        pages = asyncio.run(fetch_web_pages(urls, args.crawl, args.css_selector, args.max_pages))
+        report = summarize(pages, 0, time.perf_counter() - start)
+    print(json.dumps(asdict(report), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -70,7 +70,7 @@ PLANNER_PROMPT = """
     • none：纯思考/文本生成-无需工具
     • list_dir：列出文件及遍历文件目录
     • search：本地文件搜索
-    • rag_retrieve：知识库检索执行（LLM会根据问题自动选择合适的检索策略和参数，失败时可调用rag_rewrite_query重写query后重试）
+    • rag_retrieve：知识库检索执行（LLM会根据问题自动选择合适的检索策略和参数，工具内已自动降级重试，仍失败时可调用rag_rewrite_query重写query后重试）
     • read_file：读取文件内容（包括read_file、read_json、search_in_file）
     • write_file：写入或修改文件（包括write_file、write_json、append_file，追加内容也算write_file）
     • create_file：创建新文件
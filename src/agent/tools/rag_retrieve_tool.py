@@ -1,5 +1,12 @@
-from typing import Type, Literal
+import asyncio
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Sequence, Type, Literal
+from agent.config.config import load_rag_fallback, load_rag_multi_query, RagFallbackConfig, RagMultiQueryConfig
+from agent.config.log import logger
 from agent.rag.RagEngine import RagEngine
+from agent.rag.budget import RetrievalOutcome
+from agent.rag.indexer import preload_jieba
 from langchain_core.messages import HumanMessage
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel, Field
@@ -48,6 +55,7 @@ RAG_TOOL_NAMES = {"rag_rewrite_query", "rag_retrieve"}
 import threading
 _engine = None
 _engine_lock = threading.Lock()
+preload_jieba(background=True) # 工具加载时在后台预热jieba词典，避免首个查询等待词典加载
 
 def get_engine() -> RagEngine:
     global _engine
@@ -76,6 +84,40 @@ class RagRewriteArgs(BaseModel):
 class RagRewriteOut(BaseModel):
     refined_query: str = Field(..., description="更适合检索的改写query")
 
+
+async def rewrite_query(question: str, failure_reason: str = "") -> str:
+    """用 LLM 把问题改写为更适合检索的短 query，rag_rewrite_query 工具与 rag_retrieve 的降级链共用"""
+    model = llm.with_structured_output(RagRewriteOut)
+    prompt = (
+        "你是检索query改写器。请把用户问题改写为更适合在知识库中检索的短query。\n"
+        "要求：\n"
+        "- query尽量短（<=20字/英文<=12词）\n"
+        "- 尽量包含实体名、模块名、接口名、关键术语\n"
+        "- 保留核心语义，去除冗余表达\n\n"
+        f"原始: {question}\n"
+        f"失败原因: {failure_reason}\n"
+    )
+    out = await model.ainvoke([HumanMessage(content=prompt)])
+    return out.refined_query
+
+
+class RagMultiQueryOut(BaseModel):
+    queries: List[str] = Field(..., description="互不相同、适合检索的改写query列表")
+
+
+async def generate_query_variants(question: str, count: int) -> List[str]:
+    """一次结构化 LLM 调用生成 count 个检索改写（多 query 融合用），不含原问题"""
+    model = llm.with_structured_output(RagMultiQueryOut)
+    prompt = (
+        f"你是检索query改写器。请把用户问题改写为{count}个适合在知识库中检索的短query，用于多路召回后融合。\n"
+        "要求：\n"
+        "- 每个query尽量短（<=20字/英文<=12词），彼此角度不同：同义词/术语、实体名与模块名、拆分子问题\n"
+        "- 保留核心语义，不要引入问题中没有的事实\n\n"
+        f"原始: {question}\n"
+    )
+    out = await model.ainvoke([HumanMessage(content=prompt)])
+    return [q.strip() for q in out.queries if q and q.strip()][:count]
+
 # 重写必要时的使用
 class rag_rewrite_query(BaseTool):
     name: str = "rag_rewrite_query"
@@ -83,18 +125,7 @@ class rag_rewrite_query(BaseTool):
     args_schema: Type[BaseModel] = RagRewriteArgs
 
     async def _arun(self, question: str, failure_reason: str = "") -> dict:
-        model = llm.with_structured_output(RagRewriteOut)
-        prompt = (
-            "你是检索query改写器。请把用户问题改写为更适合在知识库中检索的短query。\n"
-            "要求：\n"
-            "- query尽量短（<=20字/英文<=12词）\n"
-            "- 尽量包含实体名、模块名、接口名、关键术语\n"
-            "- 保留核心语义，去除冗余表达\n\n"
-            f"原始: {question}\n"
-            f"失败原因: {failure_reason}\n"
-        )
-        out = await model.ainvoke([HumanMessage(content=prompt)])
-        return out.model_dump()
+        return RagRewriteOut(refined_query=await rewrite_query(question, failure_reason)).model_dump()
 
     def _run(self, question: str, failure_reason: str = "") -> dict:
         import asyncio
@@ -108,6 +139,86 @@ class RagRetrieveArgs(BaseModel):
     alpha: float = Field(default=0.6, ge=0.0, le=1.0, description="混合检索权重,如果检索策略设置为vector，则该参数无效")
     use_rerank: bool = Field(default=True, description="是否重排序")
     rerank_top_n: int = Field(default=3, ge=2, le=5, description="重排序后保留数量")
+    expand: Literal["none", "neighbors", "parent"] = Field(
+        default="none", description="命中片段的上下文扩展：neighbors补前后相邻片段，parent补所在小节")
+    fallback: bool = Field(default=True, description="结果为空或不相关时是否自动降级重试（扩大混合检索→关键词→改写query）")
+    multi_query: Optional[bool] = Field(
+        default=None, description="多query融合：一次生成多个改写并行召回后融合，问题表述模糊/口语化时开启；不填使用系统默认")
+
+
+# === 检索降级链 ===
+FALLBACK_REQUESTED = "requested"  # 按调用方请求的策略与参数
+FALLBACK_HYBRID_WIDE = "hybrid_wide"  # 混合检索，top_k 放大
+FALLBACK_KEYWORD = "keyword"  # 仅关键词召回（文件名/接口名/引号内的词）
+FALLBACK_REWRITE = "rewrite"  # LLM 改写一次 query 后混合检索
+_fallback_config: Optional[RagFallbackConfig] = None
+_multi_query_config: Optional[RagMultiQueryConfig] = None
+
+
+class FallbackStage(NamedTuple):
+    level: str
+    query: str
+    top_k: int
+    use_hybrid: bool
+    keyword_only: bool = False
+    variants: Sequence[str] = ()  # 多 query 融合的改写
+
+
+def get_fallback_config() -> RagFallbackConfig:
+    global _fallback_config
+    if _fallback_config is None:
+        _fallback_config = load_rag_fallback()
+    return _fallback_config
+
+
+def get_multi_query_config() -> RagMultiQueryConfig:
+    global _multi_query_config
+    if _multi_query_config is None:
+        _multi_query_config = load_rag_multi_query()
+    return _multi_query_config
+
+
+def is_accepted(outcome: RetrievalOutcome, packed: List[Any], config: RagFallbackConfig) -> bool:
+    """非空，且走了重排序时第一名的重排序分数达到阈值（向量召回已按 min_similarity 过滤，融合分数没有绝对尺度）"""
+    if not packed:
+        return False
+    if outcome.reranked and config.min_rerank_score > 0:
+        return bool(outcome.scores) and outcome.scores[0] >= config.min_rerank_score
+    return True
+
+
+async def fallback_stages(query: str, top_k: int, use_hybrid: bool, config: RagFallbackConfig,
+                          enabled: bool = True, variants: Sequence[str] = ()) -> AsyncIterator[FallbackStage]:
+    """
+    依次产出各级检索：请求的策略 → 混合检索放大 top_k → 仅关键词 → 改写后混合检索。
+    调用方拿到可用结果就停止迭代，改写只在前几级都失败时才调用 LLM；
+    已有多 query 改写时前两级带上改写，不再单独改写
+    """
+    yield FallbackStage(FALLBACK_REQUESTED, query, top_k, use_hybrid, variants=variants)
+    if not (enabled and config.enabled):
+        return
+    wide_top_k = max(top_k, min(top_k * config.widen, config.max_top_k))
+    if not use_hybrid or wide_top_k > top_k:
+        yield FallbackStage(FALLBACK_HYBRID_WIDE, query, wide_top_k, True, variants=variants)
+    yield FallbackStage(FALLBACK_KEYWORD, query, wide_top_k, False, keyword_only=True)
+    if config.rewrite and not variants:
+        try:
+            refined = (await rewrite_query(query, "检索结果为空或不相关")).strip()
+        except Exception as e:
+            logger.warning(f"检索降级：改写 query 失败，跳过改写: {e}")
+            return
+        if refined and refined != query.strip():
+            yield FallbackStage(FALLBACK_REWRITE, refined, wide_top_k, True)
+
+
+def format_contexts(packed: List[Any]) -> str:
+    contexts = []
+    for chunk in packed:  # 结果已按重排序/融合分数排列
+        source_name = os.path.basename(chunk.source) if chunk.source else "unknown"  # 直接赋值未知来源
+        contexts.append(f"[{chunk.text} | 摘自:{source_name}] ")
+    # 统一拼接成提示词文本
+    joined_ctx = "\n\n".join(f"{i + 1}.{ctx}" for i, ctx in enumerate(contexts))
+    return f"Rag检索结果按重要性依次排序如下:\n{joined_ctx}"
 
 # === 检索程序 ===
 class rag_retrieve(BaseTool):
@@ -120,8 +231,11 @@ class rag_retrieve(BaseTool):
         "- alpha: 0.6（仅hybrid有效，越接近1越偏向向量）\n"
         "- use_rerank: 是否使用重排序\n"
         "- rerank_top_n: 3（重排序后保留数量）\n"
-        "返回格式: {contexts: [文档内容...], count: 数量}，contexts为空表示无相关内容。\n"
-        "如果检索失败，可先调用rag_rewrite_query重写query后再次检索。"
+        "- expand: 'none'；片段过短、缺少上下文时用 'neighbors'，需要整节内容时用 'parent'，避免反复检索\n"
+        "- fallback: 默认开启，结果为空或不相关时工具内自动依次降级：扩大top_k的混合检索→仅关键词→改写一次query\n"
+        "- multi_query: 问题表述模糊/口语化/包含多个方面时设为true，一次生成多个改写并行召回后融合，代替重写后重试\n"
+        "返回格式: {contexts: [文档内容...], count: 数量, tokens: 上下文token数, path: 检索路径, attempts: 各级尝试}，"
+        "path.fallback为最终采用的级别，contexts为空表示降级后仍无相关内容，无需再重写query重试。"
     )
     args_schema: Type[BaseModel] = RagRetrieveArgs
 
@@ -132,63 +246,62 @@ class rag_retrieve(BaseTool):
             top_k: int = 10,
             alpha: float = 0.6,
             use_rerank: bool = True,
-            rerank_top_n: int = 3
+            rerank_top_n: int = 3,
+            expand: str = "none",
+            fallback: bool = True,
+            multi_query: Optional[bool] = None,
     ) -> dict:
         engine =None
         try:
             # 每次调用都用全局变量
             engine = get_engine()
+            config = get_fallback_config()
+            start = time.perf_counter()
+            attempts: List[Dict[str, Any]] = []
+            low_confidence = None  # 第一个非空但未达到阈值的结果，降级全部失败时作为参考返回
 
             use_hybrid = (strategy == "hybrid")
-
-            if use_hybrid:
-                search_results = engine.query_hybrid_search(
-                    question=query,
-                    top_k=top_k,
-                    alpha=alpha
+            variants = await self._variants(query, multi_query)
+            async for level, stage_query, stage_top_k, stage_hybrid, keyword_only, stage_variants in fallback_stages(
+                    query, top_k, use_hybrid, config, enabled=fallback, variants=variants):
+                # 召回+重排序在延迟预算内完成：融合分数足够明确时跳过重排序，重排序超时则退回融合顺序
+                # 同步引擎放到线程中执行，避免阻塞事件循环
+                outcome = await asyncio.to_thread(
+                    engine.retrieve,
+                    stage_query,
+                    top_k=stage_top_k,
+                    use_hybrid=stage_hybrid,
+                    alpha=alpha,
+                    use_rerank=use_rerank,
+                    rerank_top_n=rerank_top_n,
+                    expand=expand,
+                    keyword_only=keyword_only,
+                    variants=stage_variants,
                 )
-            else:
-                search_results = engine.query_embedded_store(query, top_k=top_k)  # 这里返回的是list，两个参数documents和 metadata
-
-            if not search_results:  # 如果为空，则返回无内容
-                return {
-                    "contexts": "", 
-                    "count": 0,  
-                    "message": "知识库中未找到相关内容"
-                }
-
-            doc_to_metadata = {doc: metadata for doc, metadata in search_results}
-            contents = list(doc_to_metadata.keys())  # 返回内容
-
-            contexts = []
-
-            # 使用重排序功能
-            if use_rerank and contents:  # 上述不为空进行执行
-                rerank_result = engine.rerank(query, contents, top_n=rerank_top_n)
-                reranked_docs = rerank_result.get("results", [])  # 获得重排序结果
-
-                for doc in reranked_docs:
-                    text = doc["document"]["text"]
-                    metadata = doc_to_metadata.get(text, {})  # 哈希表获取文档知识库来源
-                    source = metadata.get("source", "unknown")
-
-                    import os
-                    source_name = os.path.basename(source) if source != "unknown" else "unknown"  # 直接赋值未知来源
-                    contexts.append(f"[{text} | 摘自:{source_name}] ")
-
-            else:
-                for doc, metadata in search_results:  # 返回文本本身检索的长度
-                    source = metadata.get("source", "unknown")
-                    import os
-                    source_name = os.path.basename(source) if source != "unknown" else "unknown"
-                    contexts.append(f"[{doc} | 摘自: {source_name}] ")
-            # 统一拼接成提示词文本
-            joined_ctx = "\n\n".join(f"{i + 1}.{ctx}" for i, ctx in enumerate(contexts))
-            contexts_text = f"Rag检索结果按重要性依次排序如下:\n{joined_ctx}"
-            # print("-----检索结果-----："+contexts_text)
+                outcome.mark("fallback", level)
+                # 去重、合并同一来源的相邻块后按分数装入 token 预算，下游不再需要按字符截断
+                packed = engine.pack_outcome(outcome)
+                accepted = is_accepted(outcome, packed, config)
+                attempts.append({"level": level, "query": stage_query, "top_k": stage_top_k, "count": len(packed),
+                                 "accepted": accepted, "latency_ms": round(outcome.elapsed_ms, 1),
+                                 **({"variants": list(stage_variants)} if stage_variants else {})})
+                if accepted:
+                    return self._result(query, stage_query, outcome, packed, attempts, start)
+                if packed and low_confidence is None:
+                    low_confidence = (stage_query, outcome, packed)
+                logger.info(f"rag_retrieve 第 {len(attempts)} 级({level})结果为空或低于阈值，继续降级")
+
+            if low_confidence is not None:
+                result = self._result(query, *low_confidence, attempts, start)
+                result["message"] = "检索结果的相关度低于阈值，仅供参考"
+                return result
             return {
-                "contexts": contexts_text,
-                "count": len(contexts)
+                "contexts": "",
+                "count": 0,
+                "message": "知识库中未找到相关内容",
+                "path": outcome.path,
+                "attempts": attempts,
+                "latency_ms": round((time.perf_counter() - start) * 1000, 1),
             }
         except Exception as e:
             return {
@@ -196,15 +309,46 @@ class rag_retrieve(BaseTool):
                 "error": f"本次系统检索失败: {str(e)}"
             }
 
+    @staticmethod
+    async def _variants(query: str, multi_query: Optional[bool]) -> List[str]:
+        """multi_query 开启时一次 LLM 调用生成改写，失败时退回单 query 检索"""
+        config = get_multi_query_config()
+        if not (config.enabled if multi_query is None else multi_query):
+            return []
+        try:
+            return await generate_query_variants(query, config.variants)
+        except Exception as e:
+            logger.warning(f"多 query 改写生成失败，按单 query 检索: {e}")
+            return []
+
+    @staticmethod
+    def _result(query: str, stage_query: str, outcome: RetrievalOutcome, packed: List[Any],
+                attempts: List[Dict[str, Any]], start: float) -> dict:
+        result = {
+            "contexts": format_contexts(packed),
+            "count": len(packed),
+            "tokens": sum(chunk.token_count for chunk in packed),
+            "path": outcome.path,  # 各阶段实际走的路径，如 {"retrieve": "hybrid", "rerank": "timeout_fallback", "fallback": "requested"}
+            "attempts": attempts,
+            "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        if stage_query != query:
+            result["refined_query"] = stage_query
+        return result
+
     def _run(self,
             query: str,
             strategy: str = "vector",
             top_k: int = 10,
             alpha: float = 0.6,
             use_rerank: bool = True,
-            rerank_top_n: int = 3) -> dict:
+            rerank_top_n: int = 3,
+            expand: str = "none",
+            fallback: bool = True,
+            multi_query: Optional[bool] = None) -> dict:
         import asyncio
-        return asyncio.run(self._arun(query, strategy, top_k, alpha, use_rerank, rerank_top_n))
+        return asyncio.run(self._arun(query, strategy, top_k, alpha, use_rerank, rerank_top_n, expand, fallback,
+                                      multi_query))
 
 async def _test_rag_tools():
     # 测试 rag_decide_strategy
@@ -1,5 +1,5 @@
 __version__ ="0.0.1"
 from .base_utils import *
-
+from .token_utils import get_encoder, count_tokens, truncate_tokens, approximate_tokens
 
 
@@ -0,0 +1,61 @@
+import re
+from functools import lru_cache
+from typing import Optional
+
+import tiktoken
+from loguru import logger
+
+DEFAULT_ENCODING = "cl100k_base" # 与嵌入/重排序模型的分词器不完全一致，但足够用于预算估计
+# 编码文件需要联网下载，离线环境加载失败时退化为近似计数：中文按字、英文/数字按词、其它可见字符按个
+_APPROX_TOKEN_RE = re.compile(r"[A-Za-z0-9_]+|\S")
+_unavailable_encodings: set[str] = set()
+
+
+@lru_cache(maxsize=8)
+def get_encoder(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    """获取 tiktoken 编码器，同一编码只会加载一次"""
+    return tiktoken.get_encoding(encoding_name)
+
+
+def _try_encoder(encoding_name: str) -> Optional[tiktoken.Encoding]:
+    if encoding_name in _unavailable_encodings:
+        return None
+    try:
+        return get_encoder(encoding_name)
+    except Exception as e:
+        _unavailable_encodings.add(encoding_name)
+        logger.warning(f"tiktoken 编码 {encoding_name} 加载失败，改用近似 token 计数: {e}")
+        return None
+
+
+def approximate_tokens(text: str) -> int:
+    """不依赖编码文件的近似 token 数"""
+    return len(_APPROX_TOKEN_RE.findall(text)) if text else 0
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """统计文本的 token 数（特殊 token 按普通文本处理）"""
+    if not text:
+        return 0
+    encoder = _try_encoder(encoding_name)
+    if encoder is None:
+        return approximate_tokens(text)
+    return len(encoder.encode_ordinary(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, encoding_name: str = DEFAULT_ENCODING) -> str:
+    """把文本截断到 max_tokens 个 token 以内，未超长时原样返回"""
+    if max_tokens <= 0:
+        return ""
+    if not text:
+        return text
+    encoder = _try_encoder(encoding_name)
+    if encoder is None:
+        for i, match in enumerate(_APPROX_TOKEN_RE.finditer(text), 1):
+            if i == max_tokens:
+                return text[:match.end()]
+        return text
+    tokens = encoder.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoder.decode(tokens[:max_tokens])
@@ -0,0 +1,48 @@
+from agent.rag.packer import PackedChunk, _merge_adjacent, pack_context
+
+
+def _chunk(text, chunk_id, index, next_id=None, source="a.md", score=1.0):
+    return PackedChunk(text=text, source=source, score=score, token_count=len(text), ids=[chunk_id],
+                       chunk_index=index, last_index=index, next_id=next_id)
+
+
+def _meta(chunk_id, index, next_id=None, source="a.md"):
+    return {"chroma_id": chunk_id, "chunk_index": index, "next_id": next_id, "source": source, "token_count": 4}
+
+
+def test_linked_neighbors_are_merged_without_overlap():
+    merged = _merge_adjacent([_chunk("第二块内容。第三段", "b", 1, "c", score=0.5),
+                              _chunk("第一段开头。第二块内容。", "a", 0, "b", score=0.9)], "cl100k_base")
+    assert len(merged) == 1
+    assert merged[0].text == "第一段开头。第二块内容。第三段"
+    assert merged[0].ids == ["a", "b"]
+    assert (merged[0].chunk_index, merged[0].last_index, merged[0].score) == (0, 1, 0.9)
+
+
+def test_duplicate_indexes_from_separate_ingests_are_kept():
+    # 同一来源分两次 embed_data，两次的 chunk_index 都从 0 开始
+    chunks = [_chunk("第一次入库的开头", "a0", 0, "a1"), _chunk("第二次入库的开头", "b0", 0, "b1"),
+              _chunk("第一次入库的结尾", "a1", 1, "a2"), _chunk("第二次入库的结尾", "b1", 1, "b2")]
+    merged = _merge_adjacent(chunks, "cl100k_base")
+    assert sorted(chunk.ids for chunk in merged) == [["a0", "a1"], ["b0", "b1"]]
+
+
+def test_gapped_and_unlinked_consecutive_indexes_are_not_merged():
+    chunks = [_chunk("甲", "x0", 0, "x1"), _chunk("丙", "x2", 2, "x3"), _chunk("乙", "y1", 1, "y2")]
+    merged = _merge_adjacent(chunks, "cl100k_base")
+    assert sorted(chunk.text for chunk in merged) == ["丙", "乙", "甲"]
+
+
+def test_overlapping_indexes_and_duplicate_ids_are_not_dropped():
+    chunks = [_chunk("开头", "a", 0, "b"), _chunk("中间", "b", 1, "c"),
+              _chunk("重新入库的中间", "r1", 1, "r2"), _chunk("重复 id 的副本", "b", 1, "c")]
+    merged = _merge_adjacent(chunks, "cl100k_base")
+    assert sorted(chunk.text for chunk in merged) == sorted(["开头中间", "重新入库的中间", "重复 id 的副本"])
+
+
+def test_pack_context_merges_only_linked_chunks():
+    results = [("alpha beta gamma", _meta("a", 0, "b")), ("delta epsilon zeta", _meta("b", 1, "c")),
+               ("eta theta iota", _meta("r", 1, "s")), ("kappa lambda mu", _meta("k", 0, "l", source="b.md"))]
+    packed = pack_context(results, [0.9, 0.8, 0.7, 0.6], token_budget=0)
+    assert [chunk.ids for chunk in packed] == [["a", "b"], ["r"], ["k"]]
+    assert packed[0].text == "alpha beta gammadelta epsilon zeta"